@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Семантический кэш ответов для похожих по смыслу вопросов"""
+import re
+import threading
+import time
+
+import numpy as np
+
+# Слова-отсылки к предыдущим репликам: вопрос с ними без диалога не понять
+REFERENCE_WORDS = {
+    "это", "этот", "эта", "эти", "этого", "этой", "этом", "эту", "этих", "тот", "та", "те", "того",
+    "той", "том", "тех", "он", "она", "оно", "они", "его", "ее", "их", "ему", "ей", "им", "него",
+    "нее", "них", "там", "туда", "оттуда", "тогда", "такой", "такая", "такие", "тоже", "также",
+    "it", "this", "that", "these", "those", "they", "them", "there", "then",
+}
+# Первые слова уточняющего вопроса («а если...», «и сколько?», «ещё...»)
+FOLLOW_UP_WORDS = {"а", "и", "но", "еще", "тогда", "так", "ну", "and", "but", "also"}
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def is_self_contained(question: str, min_words: int = 3) -> bool:
+    """Вопрос понятен без предыдущих реплик: не короче min_words слов, без отсылок и не начинается как уточнение"""
+    words = WORD_RE.findall(question.lower().replace("ё", "е"))
+    return (len(words) >= min_words and words[0] not in FOLLOW_UP_WORDS
+            and not any(word in REFERENCE_WORDS for word in words))
+
+
+def context_allows(previous_turns: int, idle: float, question: str,
+                   max_turns: int = 0, idle_after: float = 1800) -> bool:
+    """Можно ли ответить из общего кэша при такой истории диалога.
+
+    Да, если предыдущих реплик не больше max_turns, если с прошлой реплики
+    прошло не меньше idle_after секунд (новая тема) или если вопрос
+    понятен сам по себе (is_self_contained).
+    """
+    if previous_turns <= max_turns:
+        return True
+    if idle is not None and idle >= idle_after:
+        return True
+    return is_self_contained(question)
+
+
+class SemanticAnswerCache:
+    """Кэш (эмбеддинг вопроса, id использованных знаний, ответ).
+
+    Ответ отдаётся, если косинусная близость нового вопроса к сохранённому
+    не ниже threshold. Векторы лежат в одной матрице float32, поэтому
+    поиск - одно матричное умножение. Старые записи вытесняются по ttl,
+    при переполнении - наименее используемые.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_items: int = 2000, ttl: float = 6 * 3600):
+        self.threshold = threshold
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._vectors = None                       # (max_items, dim), нормированные
+        self._valid = np.zeros(max_items, dtype=bool)
+        self._created = np.zeros(max_items)
+        self._last_used = np.zeros(max_items)
+        self._entries = [None] * max_items         # слот -> {"question", "answer", "point_ids"}
+        self._by_point = {}                        # id знания -> множество слотов
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, slot: int):
+        entry = self._entries[slot]
+        if entry is not None:
+            for point_id in entry["point_ids"]:
+                slots = self._by_point.get(point_id)
+                if slots:
+                    slots.discard(slot)
+                    if not slots:
+                        del self._by_point[point_id]
+        self._entries[slot] = None
+        self._valid[slot] = False
+
+    def _expire(self):
+        expired = np.flatnonzero(self._valid & (self._created < time.time() - self.ttl))
+        for slot in expired:
+            self._drop(int(slot))
+
+    def _scores(self, vector):
+        """Близость ко всем живым записям (просроченные удаляются)"""
+        self._expire()
+        scores = self._vectors @ vector
+        scores[~self._valid] = -1.0
+        return scores
+
+    def lookup(self, vector):
+        """Сохранённый ответ для похожего вопроса или None"""
+        with self._lock:
+            if self._vectors is None or not self._valid.any():
+                self.misses += 1
+                return None
+            scores = self._scores(self._normalize(vector))
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[slot] = time.time()
+            self.hits += 1
+            return self._entries[slot]["answer"]
+
+    def store(self, question: str, vector, point_ids: list, answer: str):
+        """Сохранение ответа"""
+        vector = self._normalize(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_items, len(vector)), dtype=np.float32)
+            free = np.flatnonzero(~self._valid)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._drop(slot)
+            now = time.time()
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+            self._created[slot] = now
+            self._last_used[slot] = now
+            self._entries[slot] = {"question": question, "answer": answer, "point_ids": list(point_ids)}
+            for point_id in point_ids:
+                self._by_point.setdefault(point_id, set()).add(slot)
+
+    def invalidate_points(self, point_ids) -> int:
+        """Удаление ответов, опиравшихся на изменённые знания"""
+        with self._lock:
+            slots = set()
+            for point_id in point_ids:
+                slots |= self._by_point.get(point_id, set())
+            for slot in slots:
+                self._drop(slot)
+            self.invalidated += len(slots)
+            return len(slots)
+
+    def invalidate_similar(self, vectors, threshold: float) -> int:
+        """Удаление ответов на вопросы, близкие к любому из новых знаний"""
+        with self._lock:
+            if self._vectors is None or not self._valid.any() or not len(vectors):
+                return 0
+            matrix = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1, norms)
+            self._expire()
+            scores = (matrix @ self._vectors.T).max(axis=0)
+            slots = np.flatnonzero(self._valid & (scores >= threshold))
+            for slot in slots:
+                self._drop(int(slot))
+            self.invalidated += len(slots)
+            return len(slots)
+
+    def clear(self):
+        """Сброс всех ответов (например, после смены размера эмбеддингов)"""
+        with self._lock:
+            self._vectors = None
+            self._valid[:] = False
+            self._entries = [None] * self.max_items
+            self._by_point.clear()
+
+    def stats(self) -> dict:
+        """Размер и доля попаданий"""
+        total = self.hits + self.misses
+        return {
+            "size": int(self._valid.sum()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
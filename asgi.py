@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""ASGI-точка входа с асинхронной обработкой вопросов.
+
+Запуск:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Обычные вопросы проходят весь путь (эмбеддинг, поиск, LLM, отправка)
+в event loop без блокировки потоков. Команды и прочие обновления
+выполняются синхронными обработчиками из bot.py в пуле потоков.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import telebot
+
+import async_pipeline
+import bot
+from coalescer import MessageCoalescer
+
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", 500))  # одновременных обновлений
+
+_inflight = set()
+_chat_locks = {}  # chat_id -> [asyncio.Lock, число ожидающих]
+_coalescer = None  # склейка сообщений, создаётся при старте (нужен event loop)
+
+
+async def _process_update(update, chat_id):
+    """Обработка обновления с сохранением порядка внутри чата"""
+    entry = _chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            started = time.perf_counter()
+            message = update.message
+            if message and async_pipeline.is_plain_question(message):
+                await async_pipeline.handle_message_async(message)
+            else:
+                await asyncio.to_thread(bot.bot.process_new_updates, [update])
+            bot.metrics.observe("update", time.perf_counter() - started)
+    except Exception as e:
+        logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _chat_locks.pop(chat_id, None)
+
+
+bot.metrics.gauge("async_inflight", lambda: {"": len(_inflight)})
+
+
+def _start(update, key):
+    task = asyncio.create_task(_process_update(update, key))
+    _inflight.add(task)
+    task.add_done_callback(_inflight.discard)
+
+
+def _schedule(update) -> bool:
+    """Запуск обработки в фоне; False, если достигнут предел одновременных обновлений"""
+    if len(_inflight) >= ASYNC_MAX_INFLIGHT:
+        return False
+    chat_id = bot.update_chat_id(update)
+    key = chat_id if chat_id is not None else update.update_id
+    coalesce = bot.coalesce_key(update) if _coalescer is not None else None
+    if coalesce is not None:
+        if bot.is_coalescable(update):
+            _coalescer.add(coalesce, update)
+            return True
+        # Накопленные вопросы автора обрабатываются раньше его команды
+        pending = _coalescer.take(coalesce)
+        if pending:
+            _start(bot.merge_updates(pending), chat_id)
+    _start(update, key)
+    return True
+
+
+def _start_coalescer():
+    global _coalescer
+    if bot.COALESCE_WINDOW <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    _coalescer = MessageCoalescer(
+        lambda key, updates: loop.call_soon_threadsafe(_start, bot.merge_updates(updates), key[0]),
+        window=bot.COALESCE_WINDOW,
+        max_wait=bot.COALESCE_MAX_WAIT,
+        max_items=bot.COALESCE_MAX_MESSAGES,
+        name="async-coalescer"
+    )
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+
+async def _respond(send, status: int, body: bytes = b"", content_type: str = "text/plain; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            try:
+                bot.check_settings()
+                bot.start_runtime()
+                _start_coalescer()
+            except RuntimeError as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            if _inflight:
+                await asyncio.wait(set(_inflight), timeout=10)
+            await async_pipeline.close_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI-приложение: те же маршруты, что и у Flask-приложения"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+
+    if path == "/" and method == "GET":
+        await _respond(send, 200, "Asuna Knowledge Bot is running! Model: Nemotron Nano 9B".encode())
+        return
+
+    if path == f"/{bot.TELEGRAM_TOKEN}" and method == "POST":
+        try:
+            json_data = json.loads(await _read_body(receive) or b"null")
+            if json_data:
+                logging.info("Получен webhook от Telegram")
+                update = telebot.types.Update.de_json(json_data)
+                if not _schedule(update):
+                    logging.warning(f"Слишком много обновлений, {update.update_id} отклонено")
+                    chat_id = bot.update_chat_id(update)
+                    if chat_id is not None and update.message:
+                        body = json.dumps({"method": "sendMessage", "chat_id": chat_id, "text": bot.BUSY_TEXT})
+                        await _respond(send, 200, body.encode(), "application/json")
+                        return
+            await _respond(send, 200)
+        except Exception as e:
+            logging.error(f"Ошибка webhook: {e}")
+            await _respond(send, 500)
+        return
+
+    if path == "/metrics" and method == "GET":
+        await _respond(send, 200, bot.metrics.render_prometheus().encode(), "text/plain; version=0.0.4")
+        return
+
+    await _respond(send, 404, b"Not Found")
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Асинхронный путь ответа: эмбеддинг -> поиск -> LLM -> отправка в Telegram"""
+import asyncio
+import logging
+import time
+
+import httpx
+from openai import AsyncOpenAI
+from qdrant_client import AsyncQdrantClient
+
+import bot
+
+_clients = {}
+
+
+def openai_client() -> AsyncOpenAI:
+    """Асинхронный клиент OpenAI (создаётся при первом обращении внутри event loop)"""
+    if "openai" not in _clients:
+        _clients["openai"] = AsyncOpenAI(api_key=bot.OPENAI_API_KEY)
+    return _clients["openai"]
+
+
+def qdrant_client() -> AsyncQdrantClient:
+    """Асинхронный клиент Qdrant"""
+    if "qdrant" not in _clients:
+        if bot.QDRANT_URL == ":memory:":
+            _clients["qdrant"] = AsyncQdrantClient(location=":memory:")
+        else:
+            _clients["qdrant"] = AsyncQdrantClient(url=bot.QDRANT_URL, api_key=bot.QDRANT_API_KEY,
+                                                   timeout=bot.QDRANT_TIMEOUT)
+    return _clients["qdrant"]
+
+
+def http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент с пулом соединений для OpenRouter (Telegram - через bot.outbox)"""
+    if "http" not in _clients:
+        _clients["http"] = httpx.AsyncClient(
+            timeout=httpx.Timeout(bot.LLM_TIMEOUT, connect=10),
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+        )
+    return _clients["http"]
+
+
+async def close_clients():
+    """Закрытие клиентов при остановке приложения"""
+    for name, client in list(_clients.items()):
+        try:
+            close = getattr(client, "aclose", None) or client.close
+            await close()
+        except Exception as e:
+            logging.warning(f"Ошибка закрытия клиента {name}: {e}")
+    _clients.clear()
+
+
+# ----------------- Эмбеддинги и поиск -----------------
+async def create_embedding_async(text: str):
+    """Создание эмбеддинга через OpenAI (с общим кэшем)"""
+    try:
+        # Чтение кэша может пойти в SQLite - в пуле потоков, чтобы не блокировать цикл событий
+        cached = await asyncio.to_thread(bot.embedding_cache.get, text, bot.embedding_cache_key())
+        if cached is not None:
+            return cached
+
+        with bot.metrics.stage("embedding"):
+            response = await openai_client().embeddings.create(
+                model=bot.EMBEDDING_MODEL,
+                input=text.strip(),
+                **bot.embedding_params()
+            )
+        vector = response.data[0].embedding
+        # Запись в SQLite - в пуле потоков, чтобы не блокировать цикл событий
+        await asyncio.to_thread(bot.embedding_cache.put, text, bot.embedding_cache_key(), vector)
+        return vector
+    except Exception as e:
+        logging.error(f"Ошибка создания эмбеддинга: {e}")
+        return None
+
+
+async def search_knowledge_async(vector, threshold: float = 0.1, limit: int = 5, query: str = None):
+    """Поиск точек базы знаний по готовому вектору.
+
+    Если вектор не того размера, что рабочая коллекция (алиас переключён
+    миграцией), эмбеддинг query считается заново.
+    """
+    if not vector:
+        return []
+    stale = bool(bot.vector_size) and len(vector) != bot.vector_size
+    if not stale:
+        if bot.LOCAL_INDEX == "primary" and bot.local_index_ready() and bot.vector_mirror.dim == len(vector):
+            with bot.metrics.stage("search-local"):
+                return bot.vector_mirror.search(vector, limit, threshold)
+        try:
+            with bot.metrics.stage("search"):
+                response = await qdrant_client().query_points(
+                    collection_name=bot.COLLECTION_NAME,
+                    query=vector,
+                    limit=limit,
+                    score_threshold=threshold,
+                    search_params=bot.SEARCH_PARAMS
+                )
+            return response.points
+        except Exception as e:
+            # Возможно, алиас переключён на коллекцию с другим размером векторов
+            stale = await asyncio.to_thread(bot.refresh_vector_size)
+            if not stale:
+                if bot.local_index_ready() and bot.vector_mirror.dim == len(vector):
+                    logging.warning(f"Qdrant недоступен ({e}), поиск по локальному зеркалу")
+                    with bot.metrics.stage("search-local"):
+                        return bot.vector_mirror.search(vector, limit, threshold)
+                logging.error(f"Ошибка поиска в базе знаний: {e}")
+                return []
+    if query is None:
+        return []
+    vector = await create_embedding_async(query)
+    return await search_knowledge_async(vector, threshold, limit) if vector else []
+
+
+# ----------------- LLM -----------------
+async def ask_nemotron_async(messages: list):
+    """Запрос к модели через OpenRouter"""
+    try:
+        with bot.metrics.stage("llm"):
+            response = await http_client().post(
+                bot.OPENROUTER_URL,
+                headers=bot.openrouter_headers(),
+                json=bot.openrouter_payload(messages)
+            )
+        if response.status_code == 200:
+            return response.json()["choices"][0]["message"]["content"]
+        logging.error(f"Ошибка OpenRouter: {response.status_code} - {response.text}")
+        bot.metrics.inc("errors", "llm")
+        return bot.LLM_ERROR_TEXT
+    except httpx.TimeoutException:
+        logging.error("Таймаут запроса к Nemotron")
+        bot.metrics.inc("timeouts", "llm")
+        return bot.LLM_TIMEOUT_TEXT
+    except Exception as e:
+        logging.error(f"Ошибка запроса к Nemotron: {e}")
+        return bot.LLM_FAILURE_TEXT
+
+
+async def ask_nemotron_stream_async(messages: list):
+    """Потоковый запрос к модели: асинхронный генератор фрагментов ответа"""
+    payload = bot.openrouter_payload(messages)
+    payload["stream"] = True
+    async with http_client().stream(
+        "POST", bot.OPENROUTER_URL, headers=bot.openrouter_headers(), json=payload
+    ) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            raise RuntimeError(f"OpenRouter {response.status_code}: {body.decode(errors='replace')}")
+        async for line in response.aiter_lines():
+            delta = bot.parse_sse_line(line)
+            if delta:
+                yield delta
+
+
+# ----------------- Telegram -----------------
+async def send_message_async(chat_id: int, text: str, reply_to_message_id: int = None, wait: bool = False):
+    """Отправка через общую очередь bot.outbox (темп, retry_after, повторы).
+
+    wait=True - дождаться отправки и вернуть message_id (None при ошибке).
+    """
+    future = bot.outbox.send(chat_id, text, reply_to=reply_to_message_id)
+    if not wait:
+        return None
+    try:
+        return (await asyncio.wrap_future(future))["message_id"]
+    except Exception as e:
+        logging.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+        return None
+
+
+def edit_message(chat_id: int, message_id: int, text: str):
+    """Правка сообщения через очередь (ожидающая правка того же сообщения заменяется)"""
+    bot.outbox.edit(chat_id, message_id, text)
+
+
+async def stream_reply_async(message, messages: list) -> tuple:
+    """Асинхронный аналог bot.stream_reply: (текст, получен ли целиком)"""
+    chat_id = message.chat.id
+    placeholder_id = await send_message_async(chat_id, bot.STREAM_PLACEHOLDER, message.message_id, wait=True)
+    if placeholder_id is None:
+        response = await ask_nemotron_async(messages)
+        await send_message_async(chat_id, response, message.message_id)
+        return response, True
+
+    text = ""
+    shown = ""
+    complete = True
+    started = time.perf_counter()
+    next_edit = time.monotonic() + bot.STREAM_EDIT_INTERVAL
+    try:
+        async for delta in ask_nemotron_stream_async(messages):
+            if not text:
+                bot.metrics.observe("llm-first-token", time.perf_counter() - started)
+            text += delta
+            if time.monotonic() >= next_edit and text.strip() != shown:
+                shown = text.strip()
+                next_edit = time.monotonic() + bot.STREAM_EDIT_INTERVAL
+                edit_message(chat_id, placeholder_id,
+                             shown[:bot.MESSAGE_LIMIT - len(bot.STREAM_CURSOR)] + bot.STREAM_CURSOR)
+    except Exception as e:
+        logging.error(f"Ошибка потокового ответа: {e}")
+        bot.metrics.inc("errors", "llm-stream")
+        if not text.strip():
+            text = await ask_nemotron_async(messages)
+        else:
+            complete = False
+            text = text.strip() + bot.STREAM_CUT_TEXT
+    else:
+        bot.metrics.observe("llm", time.perf_counter() - started)
+
+    text = text.strip() or bot.LLM_ERROR_TEXT
+    edit_message(chat_id, placeholder_id, text)
+    return text, complete
+
+
+def is_plain_question(message) -> bool:
+    """Обычный текстовый вопрос (не команда и не «запомни»)"""
+    text = (message.text or "").strip()
+    return bool(text) and not text.startswith("/") and not bot.is_remember_command(text)
+
+
+async def acquire_llm_async(user_id: int):
+    """Лимиты модели без блокировки event loop (ожидание только общего лимита)"""
+    deadline = time.monotonic() + bot.LLM_GLOBAL_MAX_WAIT
+    while True:
+        decision = bot.llm_limiter.try_acquire(user_id)
+        if decision.allowed or decision.scope == "user" or decision.retry_after > deadline - time.monotonic():
+            return decision
+        await asyncio.sleep(decision.retry_after)
+
+
+async def handle_message_async(message):
+    """Асинхронный аналог bot.handle_message для обычных вопросов.
+
+    Эмбеддинг запрашивается одновременно с записью вопроса и загрузкой
+    контекста пользователя (они идут в пуле потоков, пока запрос к OpenAI в полёте).
+    """
+    user_id = message.from_user.id
+    user_text = message.text.strip()
+    logging.info(f"Сообщение от {user_id}: {user_text}")
+    try:
+        # Уверенное лексическое совпадение (например, код брони) - без эмбеддинга и кэша ответов
+        lexical_hits, lexical_confident = bot.lexical_lookup(user_text, bot.retrieval_policy.candidates)
+        def remember_question():
+            bot.add_to_user_context(user_id, user_text)
+            return bot.get_user_context(user_id), bot.get_user_idle(user_id)
+
+        context_task = asyncio.to_thread(remember_question)
+        if lexical_confident:
+            question_vector, (user_context, idle) = None, await context_task
+        else:
+            question_vector, (user_context, idle) = await asyncio.gather(create_embedding_async(user_text), context_task)
+
+        # Похожий вопрос уже задавали - отвечаем из кэша без LLM
+        cacheable = question_vector and bot.answer_cacheable(user_context, user_text, idle)
+        response = bot.answer_cache.lookup(question_vector) if cacheable else None
+        if response:
+            logging.info(f"Ответ из семантического кэша для: {user_text}")
+            await send_message_async(message.chat.id, response, message.message_id)
+        else:
+            decision = await acquire_llm_async(user_id)
+            if not decision.allowed:
+                logging.warning(f"Лимит запросов ({decision.scope}) для {user_id}, повтор через {decision.retry_after:.0f} с")
+                bot.metrics.inc("limited", decision.scope)
+                await send_message_async(message.chat.id, bot.limit_text(decision), message.message_id)
+                return
+            policy = bot.retrieval_policy
+            if policy.skips(user_text):
+                decision = "skip"
+                knowledge_points = []
+            elif lexical_confident:
+                logging.info(f"Лексическое совпадение для запроса: {user_text}")
+                decision = "lexical"
+                knowledge_points = lexical_hits[:policy.limit]
+            else:
+                dense = await search_knowledge_async(question_vector, policy.min_score, policy.candidates, user_text)
+                knowledge_points, decision = policy.combine(user_text, dense, lexical_hits)
+            bot.metrics.inc("retrieval", decision)
+            knowledge_results = [point.payload["text"] for point in knowledge_points]
+            # Резюме и окно контекста читаются из SQLite - не в цикле событий
+            summary = await asyncio.to_thread(bot.get_user_summary, user_id)
+            messages = bot.build_messages(user_text, knowledge_results, user_context, summary)
+
+            complete = True
+            if bot.STREAM_RESPONSES:
+                response, complete = await stream_reply_async(message, messages)
+            else:
+                response = await ask_nemotron_async(messages)
+                await send_message_async(message.chat.id, response, message.message_id)
+
+            # Оборванный или аварийный ответ в кэш не попадает
+            if cacheable and complete and response not in bot.LLM_FALLBACK_TEXTS:
+                bot.answer_cache.store(user_text, question_vector, [point.id for point in knowledge_points], response)
+            if knowledge_results:
+                logging.info(f"Ответ дан с использованием {len(knowledge_results)} записей из базы знаний")
+
+        await asyncio.to_thread(bot.add_to_user_context, user_id, response, True)
+    except Exception as e:
+        logging.error(f"Ошибка обработки сообщения: {e}")
+        await send_message_async(message.chat.id, "Произошла ошибка. Попробуй еще раз.", message.message_id)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Выгрузка базы знаний в сжатый JSONL и восстановление из него.
+
+Запуск из консоли:
+    python backup.py export knowledge.jsonl.gz --vectors
+    python backup.py restore knowledge.jsonl.gz --collection knowledge_base_restored
+
+Первая строка файла - заголовок {"format", "collection", "vector_size",
+"vectors", "exported_at"}, дальше по строке на точку: {"id", "payload"}
+и, с --vectors, "vector" - float32 little-endian в base64 (в несколько раз
+короче десятичной записи). Коллекция читается и пишется страницами, память
+не зависит от её размера. Точки без векторов (или с векторами другого
+размера) при восстановлении получают эмбеддинги заново.
+"""
+import argparse
+import base64
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from qdrant_client.models import PointStruct
+
+import ingest
+
+FORMAT_VERSION = 1
+
+
+def encode_vector(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_vector(data: str) -> list:
+    return np.frombuffer(base64.b64decode(data), dtype="<f4").tolist()
+
+
+def export_collection(qdrant, collection: str, path: str, with_vectors: bool = False,
+                      page_size: int = 1000, progress=None) -> dict:
+    """Выгрузка всех точек коллекции в path (.jsonl.gz) постранично.
+
+    Файл пишется во временный и подменяется в конце, так что оборванная
+    выгрузка не портит предыдущую. progress(stats) - после каждой страницы.
+    """
+    size = qdrant.get_collection(collection).config.params.vectors.size
+    stats = {"points": 0, "started": time.time()}
+    tmp = f"{path}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        header = {"format": FORMAT_VERSION, "collection": collection, "vector_size": size,
+                  "vectors": with_vectors, "exported_at": time.time()}
+        f.write(json.dumps(header) + "\n")
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
+                collection_name=collection,
+                limit=page_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=with_vectors
+            )
+            for point in points:
+                record = {"id": point.id, "payload": point.payload}
+                if with_vectors:
+                    record["vector"] = encode_vector(point.vector)
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            stats["points"] += len(points)
+            if progress:
+                progress(dict(stats))
+            if offset is None:
+                break
+    os.replace(tmp, path)
+    stats["bytes"] = os.path.getsize(path)
+    stats["elapsed"] = time.time() - stats["started"]
+    return stats
+
+
+def read_backup(path: str):
+    """Заголовок выгрузки и генератор её записей"""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(f.readline() or "{}")
+    if header.get("format") != FORMAT_VERSION:
+        f.close()
+        raise ValueError(f"{path} - не выгрузка базы знаний (формат {header.get('format')})")
+
+    def records():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header, records()
+
+
+def restore_collection(qdrant, collection: str, path: str, embed=None, batch_size: int = 256,
+                       concurrency: int = 4, quantization: str = None, progress=None, on_points=None) -> dict:
+    """Загрузка выгрузки в коллекцию (точки с теми же id перезаписываются).
+
+    Векторы из файла берутся, если их размер совпадает с коллекцией,
+    остальным точкам embed(texts) -> векторы считает эмбеддинги. Коллекции
+    нет - она создаётся по размеру первых векторов. Одновременно идёт не
+    больше concurrency пакетов upsert; on_points(points) - после каждого.
+    """
+    header, records = read_backup(path)
+    size = None
+    if ingest.collection_exists(qdrant, collection):
+        size = qdrant.get_collection(collection).config.params.vectors.size
+    stats = {"points": 0, "embedded": 0, "batches": 0, "failed": 0, "started": time.time()}
+
+    def process(batch: list):
+        vectors = [decode_vector(record["vector"]) if record.get("vector") else None for record in batch]
+        if size is not None:
+            vectors = [vector if vector is not None and len(vector) == size else None for vector in vectors]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            if embed is None:
+                raise ValueError("в выгрузке нет подходящих векторов, а эмбеддинги считать нечем")
+            for i, vector in zip(missing, embed([batch[i]["payload"].get("text") or "" for i in missing])):
+                vectors[i] = vector
+        points = [PointStruct(id=record["id"], vector=vector, payload=record["payload"])
+                  for record, vector in zip(batch, vectors)]
+        ingest.upsert_points(qdrant, collection, points)
+        if on_points:
+            on_points(points)
+        return len(points), len(missing)
+
+    in_flight = set()
+
+    def collect(done_futures):
+        for future in done_futures:
+            in_flight.discard(future)
+            try:
+                count, embedded = future.result()
+                stats["points"] += count
+                stats["embedded"] += embedded
+                stats["batches"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"Пакет не восстановлен: {e}")
+        if progress:
+            progress(dict(stats))
+
+    batches = ingest.batched(records, batch_size)
+    first = next(batches, None)
+    if first is not None:
+        if size is None:
+            # Коллекция создаётся до параллельных upsert - по размеру первого вектора
+            vector = first[0].get("vector")
+            size = len(decode_vector(vector)) if vector else len(embed([first[0]["payload"].get("text") or ""])[0])
+            ingest.ensure_collection(qdrant, collection, size, quantization)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for batch in itertools.chain([first], batches):
+                # Ограничиваем число пакетов в полёте, чтобы не держать весь файл в памяти
+                while len(in_flight) >= concurrency * 2:
+                    done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done_futures)
+                in_flight.add(pool.submit(process, batch))
+            while in_flight:
+                done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done_futures)
+
+    stats["source"] = header.get("collection")
+    stats["elapsed"] = time.time() - stats["started"]
+    return stats
+
+
+def format_stats(stats: dict) -> str:
+    """Строка итога для логов и сообщений"""
+    text = f"точек {stats['points']}"
+    if stats.get("bytes") is not None:
+        text += f", {stats['bytes'] / 1024 / 1024:.1f} МБ"
+    if stats.get("embedded"):
+        text += f", заново посчитано эмбеддингов {stats['embedded']}"
+    if stats.get("failed"):
+        text += f", ошибок пакетов {stats['failed']}"
+    return text
+
+
+# ----------------- Запуск из консоли -----------------
+def main():
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Выгрузка и восстановление базы знаний (.jsonl.gz)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="выгрузить коллекцию в файл")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--collection", default=ingest.DEFAULT_COLLECTION)
+    export_parser.add_argument("--vectors", action="store_true", help="сохранить векторы (восстановление без OpenAI)")
+    export_parser.add_argument("--page-size", type=int, default=1000)
+    restore_parser = commands.add_parser("restore", help="загрузить файл в коллекцию")
+    restore_parser.add_argument("path")
+    restore_parser.add_argument("--collection", default=ingest.DEFAULT_COLLECTION)
+    restore_parser.add_argument("--batch-size", type=int, default=256)
+    restore_parser.add_argument("--concurrency", type=int, default=4)
+    restore_parser.add_argument("--quantization", default=os.getenv("QDRANT_QUANTIZATION", "none"),
+                                choices=["none", "scalar", "binary"], help="для новой коллекции")
+    restore_parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", ingest.DEFAULT_MODEL))
+    restore_parser.add_argument("--dimensions", type=int, default=int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None,
+                                help="размер эмбеддингов для новой коллекции")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qdrant = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=60)
+    last_report = [0.0]
+
+    def progress(stats):
+        if time.time() - last_report[0] > 2:
+            last_report[0] = time.time()
+            logging.info(f"обработано {stats['points']} точек")
+
+    if args.command == "export":
+        stats = export_collection(qdrant, args.collection, args.path, with_vectors=args.vectors,
+                                  page_size=args.page_size, progress=progress)
+        logging.info(f"✅ {args.collection} -> {args.path}: {format_stats(stats)} за {stats['elapsed']:.1f} с")
+        return
+
+    dimensions = args.dimensions
+    if ingest.collection_exists(qdrant, args.collection):
+        dimensions = qdrant.get_collection(args.collection).config.params.vectors.size
+    openai_client = []
+
+    def embed(texts):
+        # Клиент OpenAI нужен, только если в выгрузке нет подходящих векторов
+        if not openai_client:
+            from openai import OpenAI
+            openai_client.append(OpenAI(api_key=os.getenv("OPENAI_API_KEY")))
+        return ingest.embed_texts(openai_client[0], texts, args.model, dimensions=dimensions)
+
+    stats = restore_collection(qdrant, args.collection, args.path, embed=embed, batch_size=args.batch_size,
+                               concurrency=args.concurrency, quantization=args.quantization, progress=progress)
+    logging.info(f"✅ {args.path} -> {args.collection}: {format_stats(stats)} за {stats['elapsed']:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
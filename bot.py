@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
 import os
+import atexit
+import fcntl
+import hashlib
+import json
 import logging
+import tempfile
 import threading
-import uuid
-from flask import Flask, request
+import time
+from flask import Flask, Response, request, jsonify
 import telebot
-from openai import OpenAI
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Distance, VectorParams
+from qdrant_client.models import PointStruct, PointIdsList, SearchParams, QuantizationSearchParams
 import requests
+from requests.adapters import HTTPAdapter
+from embedding_cache import EmbeddingCache, normalize_text
+import ingest
+import dedup
+import backup
+from dispatcher import ChatDispatcher
+from answer_cache import SemanticAnswerCache, context_allows
+from context_store import ConversationStore, SQLiteBackend
+from vector_mirror import VectorMirror
+from lexical_index import LexicalIndex
+from retrieval_policy import get_policy
+from metrics import Metrics, SlowRequestProfiler, track
+from rate_limit import RateLimiter
+from coalescer import MessageCoalescer
+from prompt_builder import MESSAGE_OVERHEAD, count_tokens, message_tokens, select_snippets, select_turns, truncate
+from summarizer import ConversationSummarizer, turns_after
+from outbox import MESSAGE_LIMIT, TelegramOutbox
+from pager import CursorSessions
 
 # ----------------- Логи -----------------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,6 +45,91 @@ RENDER_URL = os.getenv("RENDER_URL", "https://asuna-3bfa.onrender.com")  # URL 
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))  # ID администратора
 PORT = int(os.getenv("PORT", 5000))
 
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS") or 1536)  # для новой коллекции; рабочий размер берётся из Qdrant
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")  # "" - только память
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 86400))  # секунды
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", 500000))  # записей в SQLite, 0 - без предела
+
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 8))  # потоки обработки обновлений
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 200))  # максимум ожидающих обновлений
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))  # косинусная близость вопросов
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 2000))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 6 * 3600))  # секунды
+ANSWER_CACHE_CONTEXT_TURNS = int(os.getenv("ANSWER_CACHE_CONTEXT_TURNS", 0))  # допустимо предыдущих реплик в диалоге
+ANSWER_CACHE_IDLE = int(os.getenv("ANSWER_CACHE_IDLE", 1800))  # секунды паузы, после которой старый диалог не в счёт
+ANSWER_CACHE_INVALIDATE_THRESHOLD = float(os.getenv("ANSWER_CACHE_INVALIDATE_THRESHOLD", 0.35))  # близость вопроса к новому знанию
+
+CONTEXT_STORE = os.getenv("CONTEXT_STORE", "sqlite")  # sqlite | memory
+CONTEXT_DB_PATH = os.getenv("CONTEXT_DB_PATH", "contexts.sqlite3")
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", 10))  # реплик на пользователя
+CONTEXT_MAX_USERS = int(os.getenv("CONTEXT_MAX_USERS", 10000))  # диалогов в памяти воркера
+CONTEXT_MEMORY_CHARS = int(os.getenv("CONTEXT_MEMORY_CHARS", 20_000_000))  # символов в памяти воркера
+CONTEXT_IDLE_TTL = int(os.getenv("CONTEXT_IDLE_TTL", 86400))  # секунды до вытеснения из памяти
+
+KNOWLEDGE_DUPLICATE_MODE = os.getenv("KNOWLEDGE_DUPLICATE_MODE", "replace")  # replace | merge | off - почти такая же запись уже есть
+KNOWLEDGE_DUPLICATE_THRESHOLD = float(os.getenv("KNOWLEDGE_DUPLICATE_THRESHOLD", 0.95))  # косинусная близость дубликата
+
+DATABASE_PAGE_SIZE = int(os.getenv("DATABASE_PAGE_SIZE", 10))  # записей на странице /database
+DATABASE_SESSION_TTL = int(os.getenv("DATABASE_SESSION_TTL", 3600))  # секунды жизни кнопок листания
+EXPORT_MAX_MB = int(os.getenv("EXPORT_MAX_MB", 50))  # больше Telegram не примет - только python backup.py
+INGEST_STATE_DIR = os.getenv("INGEST_STATE_DIR", "ingest_state")  # состояния незавершённых загрузок документов
+INGEST_STATE_TTL = int(os.getenv("INGEST_STATE_TTL", 7 * 86400))  # секунды, потом файл состояния удаляется
+
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 10))  # секунды
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")  # none | scalar | binary - для новой коллекции
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", 2.0))  # кандидатов на пересчёт по исходным векторам
+QDRANT_RESCORE = os.getenv("QDRANT_RESCORE", "1") == "1"
+LOCAL_INDEX = os.getenv("LOCAL_INDEX", "off")  # off | primary (поиск локально) | fallback (если Qdrant недоступен)
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "knowledge_mirror")  # префикс файлов снимка
+LOCAL_INDEX_SYNC_INTERVAL = int(os.getenv("LOCAL_INDEX_SYNC_INTERVAL", 60))  # секунды
+
+LEXICAL_INDEX = os.getenv("LEXICAL_INDEX", "1") == "1"  # BM25 по текстам базы знаний
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", 0.8))  # доля веса запроса в лучшем документе
+LEXICAL_MIN_GAP = float(os.getenv("LEXICAL_MIN_GAP", 1.5))  # во сколько раз лидер впереди второго
+
+RETRIEVAL_POLICY = os.getenv("RETRIEVAL_POLICY", "legacy")  # legacy | adaptive | adaptive-rerank | strict (см. retrieval_eval.py)
+
+PROFILE_SLOW_SECONDS = float(os.getenv("PROFILE_SLOW_SECONDS", 0))  # >0 - профилировать обновления дольше этого
+
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"  # потоковые ответы с правкой сообщения
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.2))  # секунды между правками
+
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 1.0))  # секунды тишины до ответа на пачку сообщений; 0 - без склейки
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 4.0))  # секунды с первого сообщения пачки
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", 5))
+
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE", 6))  # запросов к модели в минуту на пользователя; 0 - без лимита
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", 3))
+LLM_GLOBAL_RATE = float(os.getenv("LLM_GLOBAL_RATE", 20))  # запросов в минуту на весь деплой; 0 - без лимита
+LLM_GLOBAL_BURST = int(os.getenv("LLM_GLOBAL_BURST", 5))
+LLM_GLOBAL_MAX_WAIT = float(os.getenv("LLM_GLOBAL_MAX_WAIT", 5))  # секунды ожидания общего лимита
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1500))  # токенов на промпт (без ответа)
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"  # сворачивать старые реплики в резюме
+SUMMARY_KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", 4))  # последних реплик вне резюме
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", 4))  # новых старых реплик для обновления резюме
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 200))
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))  # сообщений в секунду на бота (лимит Telegram ~30)
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # сообщений в секунду в личный чат
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20))  # сообщений в минуту в группу
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv("TELEGRAM_SEND_ATTEMPTS", 5))  # попыток на 5xx и сетевые ошибки
+TELEGRAM_SEND_WAIT = float(os.getenv("TELEGRAM_SEND_WAIT", 30))  # секунды ожидания отправки, когда нужен её результат
+TELEGRAM_TIMEOUT = int(os.getenv("TELEGRAM_TIMEOUT", 10))  # секунды на запрос к Bot API
+TELEGRAM_UPLOAD_TIMEOUT = int(os.getenv("TELEGRAM_UPLOAD_TIMEOUT", 120))  # секунды на отправку файла (/export)
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", 4))  # потоков отправки в Telegram
+OUTBOX_MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", 5000))  # максимум ожидающих отправки запросов
+
+# Процессов-воркеров: общие лимиты делятся между ними, но порядок внутри чата, склейка
+# сообщений и лимиты на чат/пользователя держатся в памяти процесса - поэтому по умолчанию 1
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+
+DEPLOY_ID = os.getenv("DEPLOY_ID") or os.getenv("RENDER_GIT_COMMIT")  # разовая инициализация на деплой
+
 # Проверяем наличие всех токенов
 required_tokens = {
     "TELEGRAM_TOKEN": TELEGRAM_TOKEN,
@@ -33,188 +140,879 @@ required_tokens = {
     "ADMIN_USER_ID": ADMIN_USER_ID
 }
 
-for name, token in required_tokens.items():
-    if not token or (name == "ADMIN_USER_ID" and token == 0):
-        logging.error(f"Отсутствует переменная окружения: {name}")
-        if name == "ADMIN_USER_ID":
-            logging.error("ADMIN_USER_ID должен быть установлен в ID вашего Telegram аккаунта")
-        exit(1)
+def check_settings():
+    """Проверка переменных окружения (вызывается при создании приложения, а не при импорте)"""
+    missing = []
+    for name, token in required_tokens.items():
+        if not token or (name == "ADMIN_USER_ID" and token == 0):
+            logging.error(f"Отсутствует переменная окружения: {name}")
+            if name == "ADMIN_USER_ID":
+                logging.error("ADMIN_USER_ID должен быть установлен в ID вашего Telegram аккаунта")
+            missing.append(name)
+    if missing:
+        raise RuntimeError(f"Отсутствуют переменные окружения: {', '.join(missing)}")
 
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
-app = Flask(__name__)
+# Обработчики выполняются прямо в воркерах dispatcher (порядок внутри чата, замер времени).
+# Без токена бот создаётся с заглушкой: запуститься всё равно не даст check_settings()
+bot = telebot.TeleBot(TELEGRAM_TOKEN or "0:unset", threaded=False)
 
 # ----------------- Клиенты -----------------
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-qdrant = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+class LazyClient:
+    """Клиент, создаваемый при первом обращении.
+
+    Импорт модуля и старт воркера не ждут создания клиентов; после fork
+    клиент создаётся заново, чтобы процессы не делили пул соединений.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
 
-COLLECTION_NAME = "knowledge_base"
-CONTEXT_COLLECTION = "user_contexts"
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def make_openai_client():
+    from openai import OpenAI  # импорт openai заметно удлиняет старт
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+def make_qdrant_client():
+    if QDRANT_URL == ":memory:":
+        return QdrantClient(location=":memory:")  # локальный режим для нагрузочных тестов
+    return QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=QDRANT_TIMEOUT)
+
+def make_http_session():
+    """Сессия с пулом соединений для OpenRouter и Telegram"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(10, WORKER_THREADS + OUTBOX_SENDERS))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+openai_client = LazyClient(make_openai_client)
+qdrant = LazyClient(make_qdrant_client)
+http_session = LazyClient(make_http_session)
+
+def telebot_request(method, url, **kwargs):
+    """Запросы самого telebot (файлы, webhook) - через тот же пул соединений"""
+    return http_session.request(method, url, **kwargs)
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = telebot_request
+
+COLLECTION_NAME = "knowledge_base"  # коллекция или алиас (после migrate.py)
+retrieval_policy = get_policy(RETRIEVAL_POLICY)
+vector_size = EMBEDDING_DIMENSIONS  # размер векторов рабочей коллекции, уточняется в refresh_vector_size()
+
+# Параметры поиска для квантованной коллекции (без квантования Qdrant их игнорирует)
+SEARCH_PARAMS = SearchParams(quantization=QuantizationSearchParams(rescore=QDRANT_RESCORE, oversampling=QDRANT_OVERSAMPLING))
+
+# Метрики этапов и профайлер медленных обновлений
+metrics = Metrics()
+profiler = SlowRequestProfiler(PROFILE_SLOW_SECONDS) if PROFILE_SLOW_SECONDS > 0 else None
+
+# Курсоры листания /database (по сессии на каждый вызов команды)
+database_cursors = CursorSessions(ttl=DATABASE_SESSION_TTL)
+
+# Семантический кэш ответов
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_items=ANSWER_CACHE_SIZE,
+    ttl=ANSWER_CACHE_TTL
+)
+
+# Ресурсы процесса с потоками и файлами создаются в start_runtime() (после fork воркера)
+dispatcher = None        # пул обработки обновлений: по порядку внутри чата, параллельно между чатами
+context_store = None     # контексты пользователей (память + SQLite, общий для воркеров)
+embedding_cache = None   # кэш эмбеддингов (память + диск)
+coalescer = None         # склейка сообщений, отправленных подряд
+summarizer = None        # фоновое резюме старых реплик диалогов
+outbox = None            # очередь исходящих сообщений Telegram
+
+# Лимиты запросов к модели: на пользователя и общий (бесплатная модель OpenRouter)
+llm_limiter = RateLimiter(
+    user_rate=LLM_USER_RATE / 60,
+    user_burst=LLM_USER_BURST,
+    global_rate=LLM_GLOBAL_RATE / 60 / WEB_CONCURRENCY,
+    global_burst=max(1, LLM_GLOBAL_BURST // WEB_CONCURRENCY),
+    exempt=[ADMIN_USER_ID]
+)
+
+metrics.gauge("queue", lambda: {
+    key: value for key, value in dispatcher.stats().items()
+    if key in ("queued", "busy", "workers", "rejected")
+})
+metrics.gauge("outbox", lambda: outbox.stats())
+metrics.gauge("cache", lambda: {
+    "embedding_hit_memory": embedding_cache.hits_memory,
+    "embedding_hit_disk": embedding_cache.hits_disk,
+    "embedding_miss": embedding_cache.misses,
+    "answer_hit": answer_cache.hits,
+    "answer_miss": answer_cache.misses,
+})
+
+KNOWLEDGE_STATUS_TEXTS = {
+    "added": "✅ Запомнил: {text}",
+    "exists": "👌 Это я уже знаю: {text}",
+    "replaced": "✅ Запомнил и заменил похожую старую запись: {text}",
+    "merged": "✅ Дополнил похожую запись: {text}",
+}
+BUSY_TEXT = "Сейчас очень много сообщений, попробуй ещё раз через минуту 🙏"
+USER_LIMIT_TEXT = "Ты задаёшь вопросы слишком часто 🙏 Подожди {seconds} с и спроси ещё раз."
+GLOBAL_LIMIT_TEXT = "Сейчас много вопросов, я не успеваю ответить всем 🙏 Попробуй через {seconds} с."
 
 # ----------------- Проверка прав -----------------
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором"""
     return user_id == ADMIN_USER_ID
 
-# Хранилище контекстов пользователей в памяти
-user_contexts = {}
+def create_context_store():
+    backend = None
+    if CONTEXT_STORE == "sqlite":
+        try:
+            backend = SQLiteBackend(CONTEXT_DB_PATH, max_turns=CONTEXT_MAX_TURNS)
+        except Exception as e:
+            logging.error(f"Не удалось открыть хранилище контекстов {CONTEXT_DB_PATH}: {e}")
+    return ConversationStore(
+        backend=backend,
+        max_turns=CONTEXT_MAX_TURNS,
+        max_users=CONTEXT_MAX_USERS,
+        max_chars=CONTEXT_MEMORY_CHARS,
+        idle_ttl=CONTEXT_IDLE_TTL
+    )
+
 
 # ----------------- Функции для эмбеддингов -----------------
 def create_embedding(text: str):
-    """Создание эмбеддинга через OpenAI"""
+    """Создание эмбеддинга через OpenAI (с кэшем)"""
     try:
-        response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text.strip()
-        )
-        return response.data[0].embedding
+        cached = embedding_cache.get(text, embedding_cache_key())
+        if cached is not None:
+            return cached
+
+        with metrics.stage("embedding"):
+            response = openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text.strip(),
+                **embedding_params()
+            )
+        vector = response.data[0].embedding
+        embedding_cache.put(text, embedding_cache_key(), vector)
+        return vector
     except Exception as e:
         logging.error(f"Ошибка создания эмбеддинга: {e}")
         return None
 
+def embedding_params() -> dict:
+    """Размер эмбеддинга в запросе к OpenAI - под рабочую коллекцию"""
+    return ingest.embedding_params(EMBEDDING_MODEL, vector_size)
+
+def embedding_cache_key() -> str:
+    """Модель для ключа кэша эмбеддингов (с размером, если он задаётся явно)"""
+    return f"{EMBEDDING_MODEL}@{vector_size}" if embedding_params() else EMBEDDING_MODEL
+
+def embedding_cache_summary() -> str:
+    """Краткая статистика кэша эмбеддингов"""
+    stats = embedding_cache.stats()
+    return (
+        f"{stats['size']} в памяти, попаданий {stats['hits_memory']}+{stats['hits_disk']} (диск), "
+        f"промахов {stats['misses']}, hit rate {stats['hit_rate']:.0%}"
+    )
+
+def answer_cache_summary() -> str:
+    """Краткая статистика кэша ответов"""
+    stats = answer_cache.stats()
+    return (
+        f"{stats['size']} ответов, попаданий {stats['hits']}, промахов {stats['misses']}, "
+        f"hit rate {stats['hit_rate']:.0%}, сброшено {stats['invalidated']}"
+    )
+
+def local_index_summary() -> str:
+    """Состояние локального зеркала векторов"""
+    if vector_mirror is None:
+        return "выключен"
+    return f"{LOCAL_INDEX}, {vector_mirror.size} точек, поколение {vector_mirror.generation}"
+
+def limiter_summary() -> str:
+    """Состояние лимитов модели и склейки сообщений"""
+    stats = llm_limiter.stats()
+    text = (
+        f"пропущено {stats['allowed']}, отказов {stats['denied_user']} (личный лимит) / "
+        f"{stats['denied_global']} (общий), ожиданий {stats['waited']}"
+    )
+    if stats["global_tokens"] is not None:
+        text += f", общий запас {stats['global_tokens']:.1f}/{stats['global_burst']:g}"
+    if stats["top_denied"]:
+        text += ", чаще всех: " + ", ".join(f"{user_id} ({count})" for user_id, count in stats["top_denied"])
+    if summarizer is not None:
+        summaries = summarizer.stats()
+        text += (
+            f"\nРезюме диалогов: обновлено {summaries['updated']}, отложено {summaries['deferred']}, "
+            f"ошибок {summaries['failed']}"
+        )
+    if coalescer is not None:
+        merged = coalescer.stats()
+        text += f"\nСклейка: {merged['batches']} пачек, склеено {merged['merged']} сообщений, ждут {merged['pending']}"
+    return text
+
+def limit_text(decision) -> str:
+    """Ответ пользователю, когда сработал лимит"""
+    seconds = max(1, round(decision.retry_after))
+    template = USER_LIMIT_TEXT if decision.scope == "user" else GLOBAL_LIMIT_TEXT
+    return template.format(seconds=seconds)
+
+def outbox_summary() -> str:
+    """Краткая статистика очереди отправки в Telegram"""
+    stats = outbox.stats()
+    return (
+        f"{stats['queued']} в очереди, отправлено {stats['sent']}, 429 - {stats['throttled']}, "
+        f"повторов {stats['retried']}, склеено правок {stats['coalesced']}, ошибок {stats['failed']}, "
+        f"отброшено {stats['dropped']}"
+    )
+
+def dispatcher_summary() -> str:
+    """Краткая статистика пула обработки"""
+    stats = dispatcher.stats()
+    return (
+        f"{stats['queued']}/{stats['max_queue']} в очереди, "
+        f"занято {stats['busy']}/{stats['workers']} воркеров "
+        f"(загрузка {stats['utilization']:.0%}), отклонено {stats['rejected']}"
+    )
+
 # ----------------- Функции для работы с Qdrant -----------------
-def init_collections():
+def init_collections() -> bool:
     """Инициализация коллекций в Qdrant"""
     try:
-        collections = qdrant.get_collections()
-        existing_collections = [col.name for col in collections.collections]
-        
-        # Коллекция для базы знаний
-        if COLLECTION_NAME not in existing_collections:
-            qdrant.create_collection(
-                collection_name=COLLECTION_NAME,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
-            )
-            logging.info(f"Создана коллекция: {COLLECTION_NAME}")
-        else:
+        # Коллекция для базы знаний (имя может быть алиасом после миграции)
+        if not ingest.ensure_collection(qdrant, COLLECTION_NAME, EMBEDDING_DIMENSIONS, QDRANT_QUANTIZATION):
             logging.info(f"Коллекция {COLLECTION_NAME} уже существует")
+        return True
             
     except Exception as e:
         logging.error(f"Ошибка инициализации коллекций: {e}")
+        return False
 
-def add_to_knowledge_base(text: str, source: str = "user"):
-    """Добавление знания в базу"""
+def refresh_vector_size() -> bool:
+    """Размер векторов рабочей коллекции; True, если он изменился (алиас переключён миграцией)"""
+    global vector_size
     try:
+        size = qdrant.get_collection(COLLECTION_NAME).config.params.vectors.size
+    except Exception as e:
+        logging.warning(f"Не удалось получить параметры коллекции: {e}")
+        return False
+    if size == vector_size:
+        return False
+    logging.info(f"Размер векторов коллекции {COLLECTION_NAME}: {size} (был {vector_size})")
+    vector_size = size
+    # Векторы другого размера несравнимы: кэш ответов сбрасывается, зеркало пересобирается
+    answer_cache.clear()
+    if vector_mirror is not None and vector_mirror.dim not in (None, size):
+        threading.Thread(target=rebuild_local_index, name="local-index-rebuild", daemon=True).start()
+    return True
+
+def add_to_knowledge_base(text: str, source: str = "user", retry: bool = True):
+    """Добавление знания в базу.
+
+    id точки - хэш текста, так что повтор того же текста ничего не меняет.
+    Почти такая же запись, добавленная вручную, заменяется новой или
+    сливается с ней (KNOWLEDGE_DUPLICATE_MODE). Возвращает "added", "exists",
+    "replaced", "merged" или None при ошибке.
+    """
+    try:
+        point_id = ingest.content_point_id(text)
+        if qdrant.retrieve(collection_name=COLLECTION_NAME, ids=[point_id]):
+            logging.info(f"Знание уже есть: {text[:50]}...")
+            return "exists"
+
         vector = create_embedding(text)
         if not vector:
-            return False
-            
-        point_id = str(uuid.uuid4())
-        point = PointStruct(
-            id=point_id,
-            vector=vector,
-            payload={
-                "text": text,
-                "source": source,
-                "id": point_id
-            }
-        )
-        
+            return None
+
+        status = "added"
+        duplicate = None
+        if KNOWLEDGE_DUPLICATE_MODE in ("replace", "merge"):
+            duplicate = dedup.find_duplicate(qdrant, COLLECTION_NAME, vector, KNOWLEDGE_DUPLICATE_THRESHOLD,
+                                             search_params=SEARCH_PARAMS)
+        if duplicate is not None:
+            status = "replaced"
+            if KNOWLEDGE_DUPLICATE_MODE == "merge":
+                old_text = duplicate.payload.get("text", "")
+                merged = dedup.merge_texts(old_text, text)
+                if normalize_text(merged) == normalize_text(old_text):
+                    return "exists"  # новая формулировка ничего не добавляет
+                if merged != text:
+                    text = merged
+                    point_id = ingest.content_point_id(text)
+                    vector = create_embedding(text)
+                    if not vector:
+                        return None
+                    status = "merged"
+            logging.info(f"Похожая запись {duplicate.id} (близость {duplicate.score:.3f}): {status}")
+
+        payload = {
+            "text": text,
+            "source": source,
+            "id": point_id,
+            "created_at": time.time()
+        }
+        if duplicate is not None:
+            payload["replaces"] = [str(duplicate.id)]
+        point = PointStruct(id=point_id, vector=vector, payload=payload)
+
         qdrant.upsert(collection_name=COLLECTION_NAME, points=[point])
+        if duplicate is not None:
+            qdrant.delete(collection_name=COLLECTION_NAME, points_selector=PointIdsList(points=[duplicate.id]))
+            on_knowledge_removed([duplicate.id])
         logging.info(f"Добавлено знание: {text[:50]}...")
-        return True
+        on_knowledge_changed([point])
+        return status
     except Exception as e:
+        if retry and refresh_vector_size():
+            # Коллекцию перенесли на векторы другого размера - повтор с новым эмбеддингом
+            return add_to_knowledge_base(text, source, retry=False)
         logging.error(f"Ошибка добавления в базу знаний: {e}")
-        return False
+        return None
+
+def on_knowledge_changed(points: list):
+    """Реакция на изменение базы знаний: локальное зеркало и сброс устаревших ответов в кэше"""
+    if vector_mirror is not None and not vector_mirror.upsert(points):
+        refresh_vector_size()  # зеркало на старом размере векторов - пересборка
+    if lexical_index is not None:
+        lexical_index.add_points(points)
+    dropped = answer_cache.invalidate_points([point.id for point in points])
+    dropped += answer_cache.invalidate_similar([point.vector for point in points], ANSWER_CACHE_INVALIDATE_THRESHOLD)
+    if dropped:
+        logging.info(f"Сброшено ответов из кэша: {dropped}")
 
-def search_knowledge(query: str, threshold: float = 0.1, limit: int = 5):
+def on_knowledge_removed(point_ids: list):
+    """Удаление точек из локальных индексов и ответов, которые на них опирались"""
+    if vector_mirror is not None:
+        vector_mirror.remove(point_ids)
+    if lexical_index is not None:
+        lexical_index.remove(point_ids)
+    answer_cache.invalidate_points(point_ids)
+
+def search_knowledge(query: str):
     """Поиск релевантной информации в базе знаний"""
+    return [point.payload["text"] for point in search_knowledge_points(query)]
+
+def lexical_lookup(query: str, limit: int = 5):
+    """Лексический поиск: (результаты, уверенное ли совпадение)"""
+    if lexical_index is None:
+        return [], False
+    with metrics.stage("lexical"):
+        hits, coverage, code_match = lexical_index.search(query, limit)
+    return hits, LexicalIndex.confident(hits, coverage, code_match, LEXICAL_MIN_COVERAGE, LEXICAL_MIN_GAP)
+
+def search_knowledge_points(query: str, vector: list = None, lexical: tuple = None, policy=None):
+    """Поиск релевантных точек в базе знаний (с id и score) по политике RETRIEVAL_POLICY.
+
+    Уверенное лексическое совпадение (код брони, все слова запроса в одной
+    записи) возвращается сразу, без эмбеддинга; реплики без вопроса не ищутся.
+    Иначе из результатов плотного и лексического поиска политика отбирает
+    столько записей, сколько действительно близко к вопросу.
+    Готовые вектор и результат lexical_lookup можно передать, чтобы не считать их повторно.
+    """
+    policy = policy or retrieval_policy
+    if policy.skips(query):
+        metrics.inc("retrieval", "skip")
+        return []
     try:
-        vector = create_embedding(query)
-        if not vector:
-            return []
-            
-        results = qdrant.query_points(
-            collection_name=COLLECTION_NAME,
-            query=vector,
-            limit=limit,
-            score_threshold=threshold
-        ).points
-        
-        if results:
-            logging.info(f"Найдено {len(results)} релевантных записей для запроса: {query}")
-            return [point.payload["text"] for point in results]
+        def dense_search(vector, threshold, limit):
+            try:
+                return search_vector(vector, threshold, limit)
+            except Exception:
+                if not refresh_vector_size() and len(vector) == vector_size:
+                    raise
+                # Коллекцию перенесли на векторы другого размера - повтор с новым эмбеддингом
+                vector = create_embedding(query)
+                return search_vector(vector, threshold, limit) if vector else []
+
+        result = policy.retrieve(query, create_embedding, dense_search,
+                                 lexical=lexical or lexical_lookup(query, policy.candidates), vector=vector)
+        metrics.inc("retrieval", result.decision)
+        if result.hits:
+            logging.info(f"Найдено {len(result.hits)} релевантных записей ({result.decision}) для запроса: {query}")
         else:
             logging.info(f"Релевантной информации не найдено для: {query}")
-            return []
-            
+        return result.hits
     except Exception as e:
         logging.error(f"Ошибка поиска в базе знаний: {e}")
         return []
 
-# ----------------- Функции для OpenRouter (Nemotron Nano) -----------------
-def ask_nemotron(question: str, context: list = None, user_context: list = None):
-    """Запрос к Nemotron Nano через OpenRouter"""
+def search_vector(vector, threshold: float, limit: int):
+    """Поиск по вектору: локальное зеркало или Qdrant, зеркало - запасной вариант.
+
+    ValueError, если вектор не того размера, что рабочая коллекция
+    (вызывающий обновляет размер и повторяет поиск с новым эмбеддингом).
+    """
+    if vector_size and len(vector) != vector_size:
+        raise ValueError(f"Размер вектора {len(vector)} не совпадает с коллекцией ({vector_size})")
+    if LOCAL_INDEX == "primary" and local_index_ready() and vector_mirror.dim == len(vector):
+        with metrics.stage("search-local"):
+            return vector_mirror.search(vector, limit, threshold)
     try:
-        messages = []
-        
-        # Системное сообщение с логикой работы
-        if context:
-            system_prompt = f"""You Asuna - Booking Cat Assistant for Darkexpress. 
+        with metrics.stage("search"):
+            return qdrant.query_points(
+                collection_name=COLLECTION_NAME,
+                query=vector,
+                limit=limit,
+                score_threshold=threshold,
+                search_params=SEARCH_PARAMS
+            ).points
+    except Exception as e:
+        if not local_index_ready():
+            raise
+        logging.warning(f"Qdrant недоступен ({e}), поиск по локальному зеркалу")
+        with metrics.stage("search-local"):
+            return vector_mirror.search(vector, limit, threshold)
 
-YOU HAVE DATABASE:
-{chr(10).join(context)}
+# ----------------- Локальное зеркало векторов -----------------
+vector_mirror = VectorMirror(LOCAL_INDEX_PATH, COLLECTION_NAME) if LOCAL_INDEX != "off" else None
 
+def local_index_ready() -> bool:
+    return vector_mirror is not None and vector_mirror.size > 0
 
-        else:
-            system_prompt = """You Asuna - ai assistant with database."""
-        
-        messages.append({"role": "system", "content": system_prompt})
-        
-        # Добавляем контекст диалога (последние 6 сообщений)
-        if user_context:
-            for msg in user_context[-6:]:
-                messages.append(msg)
-        
-        # Текущий вопрос
-        messages.append({"role": "user", "content": question})
-        
-        # Запрос к OpenRouter с Nemotron Nano
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": RENDER_URL,  # Опционально для OpenRouter
-            },
-            json={
-                "model": "meta-llama/llama-3.3-70b-instruct:free",  # ✅ Новая бесплатная модель
-                "messages": messages,
-                "temperature": 0.3,  # Более стабильные ответы
-                "max_tokens": 300    # Максимальная длина ответа
-            },
-            timeout=30  # Таймаут 30 секунд
+def sync_local_index():
+    """Один цикл синхронизации зеркала с коллекцией"""
+    # Размер векторов сверяется явно: поиск по зеркалу сам не заметит переключения алиаса
+    refresh_vector_size()
+    if vector_mirror.dim not in (None, vector_size):
+        rebuild_local_index()
+        return 0
+    if vector_mirror.disk_generation() > vector_mirror.generation:
+        vector_mirror.load()  # снимок обновил другой воркер
+    pulled = vector_mirror.pull(qdrant)
+    if pulled or vector_mirror.dirty:
+        vector_mirror.save()
+    return pulled
+
+_rebuild_lock = threading.Lock()
+
+def rebuild_local_index():
+    """Полная пересборка зеркала (после смены размера векторов)"""
+    if not _rebuild_lock.acquire(blocking=False):
+        return  # пересборка уже идёт
+    try:
+        vector_mirror.pull(qdrant, full=True)
+        vector_mirror.save()
+    except Exception as e:
+        logging.error(f"Ошибка пересборки зеркала: {e}")
+    finally:
+        _rebuild_lock.release()
+
+def local_index_loop():
+    """Фоновое поддержание зеркала: снимок с диска или полная загрузка, затем инкрементальные обновления"""
+    try:
+        if not vector_mirror.load() or vector_mirror.dim not in (None, vector_size):
+            logging.info("Снимка зеркала нет, загружаю коллекцию целиком")
+            vector_mirror.pull(qdrant, full=True)
+            vector_mirror.save()
+    except Exception as e:
+        logging.error(f"Ошибка начальной загрузки зеркала: {e}")
+    while True:
+        time.sleep(LOCAL_INDEX_SYNC_INTERVAL)
+        try:
+            pulled = sync_local_index()
+            if pulled:
+                logging.info(f"Зеркало обновлено: {pulled} точек, всего {vector_mirror.size}")
+        except Exception as e:
+            logging.error(f"Ошибка синхронизации зеркала: {e}")
+
+def start_local_index():
+    if vector_mirror is not None:
+        threading.Thread(target=local_index_loop, name="local-index", daemon=True).start()
+
+
+# ----------------- Лексический индекс -----------------
+lexical_index = LexicalIndex() if LEXICAL_INDEX else None
+
+def lexical_index_loop():
+    """Фоновое построение BM25-индекса и подтягивание новых записей из коллекции"""
+    while True:
+        try:
+            pulled = lexical_index.pull(qdrant, COLLECTION_NAME)
+            if pulled:
+                logging.info(f"Лексический индекс: +{pulled} записей, всего {lexical_index.size}")
+        except Exception as e:
+            logging.error(f"Ошибка синхронизации лексического индекса: {e}")
+        time.sleep(LOCAL_INDEX_SYNC_INTERVAL)
+
+def start_lexical_index():
+    if lexical_index is not None:
+        threading.Thread(target=lexical_index_loop, name="lexical-index", daemon=True).start()
+
+# ----------------- Запуск процесса -----------------
+_runtime_pid = None
+_runtime_lock = threading.Lock()
+
+def start_runtime():
+    """Запуск ресурсов процесса: пул обработки, хранилища, фоновые индексы и прогрев.
+
+    Вызывается в каждом воркере после fork (хук post_fork или первый запрос);
+    повторный вызов в том же процессе ничего не делает.
+    """
+    global dispatcher, context_store, embedding_cache, coalescer, summarizer, outbox, _runtime_pid
+    if _runtime_pid == os.getpid():
+        return
+    with _runtime_lock:
+        if _runtime_pid == os.getpid():
+            return
+        started = time.perf_counter()
+        embedding_cache = EmbeddingCache(
+            path=EMBEDDING_CACHE_PATH or None,
+            max_items=EMBEDDING_CACHE_SIZE,
+            ttl=EMBEDDING_CACHE_TTL,
+            disk_max_items=EMBEDDING_CACHE_DISK_SIZE
+        )
+        context_store = create_context_store()
+        atexit.register(context_store.close)
+        outbox = TelegramOutbox(
+            telegram_api,
+            senders=OUTBOX_SENDERS,
+            # Лимит Telegram - на бота целиком, он делится между процессами
+            global_rate=TELEGRAM_GLOBAL_RATE / WEB_CONCURRENCY,
+            chat_rate=TELEGRAM_CHAT_RATE,
+            chat_burst=TELEGRAM_CHAT_BURST,
+            group_rate=TELEGRAM_GROUP_RATE / 60,
+            max_attempts=TELEGRAM_SEND_ATTEMPTS,
+            max_queue=OUTBOX_MAX_QUEUE
         )
+        atexit.register(outbox.drain)
+        dispatcher = ChatDispatcher(workers=WORKER_THREADS, max_queue=UPDATE_QUEUE_SIZE)
+        if COALESCE_WINDOW > 0:
+            coalescer = MessageCoalescer(
+                submit_messages,
+                window=COALESCE_WINDOW,
+                max_wait=COALESCE_MAX_WAIT,
+                max_items=COALESCE_MAX_MESSAGES
+            )
+        if SUMMARY_ENABLED:
+            summarizer = ConversationSummarizer(
+                context_store, summarize_dialogue,
+                keep_turns=SUMMARY_KEEP_TURNS,
+                batch=SUMMARY_BATCH,
+                # Резюме не важнее ответов: только при свободном общем лимите
+                allow=lambda: llm_limiter.try_acquire(None).allowed
+            )
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+        _runtime_pid = os.getpid()
+        if WEB_CONCURRENCY > 1:
+            logging.warning(f"WEB_CONCURRENCY={WEB_CONCURRENCY}: порядок сообщений в чате, склейка и лимиты "
+                            f"на чат и пользователя действуют только внутри одного воркера")
+        logging.info(f"Воркер {_runtime_pid} готов за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+def warmup():
+    """Фоновый прогрев после старта: разовая инициализация деплоя, индексы и соединения с сервисами"""
+    started = time.perf_counter()
+    run_startup_once()
+    refresh_vector_size()
+    start_local_index()
+    start_lexical_index()
+    try:
+        qdrant.get_collection(COLLECTION_NAME)  # клиент и первое соединение
+        openai_client.get()
+        http_session.get()
+    except Exception as e:
+        logging.warning(f"Прогрев не завершён: {e}")
+        return
+    logging.info(f"Прогрев завершён за {time.perf_counter() - started:.1f} с")
+
+# ----------------- Функции для OpenRouter (Nemotron Nano) -----------------
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+LLM_MODEL = "meta-llama/llama-3.3-70b-instruct:free"  # ✅ Новая бесплатная модель
+LLM_TIMEOUT = 30  # Таймаут 30 секунд
+
+LLM_ERROR_TEXT = "Извини, у меня проблемы с получением ответа. Попробуй позже."
+LLM_TIMEOUT_TEXT = "Извини, запрос занял слишком много времени. Попробуй позже."
+LLM_FAILURE_TEXT = "Извини, произошла ошибка. Попробуй позже."
+LLM_FALLBACK_TEXTS = (LLM_ERROR_TEXT, LLM_TIMEOUT_TEXT, LLM_FAILURE_TEXT)
+STREAM_CUT_TEXT = "\n\n⚠️ Ответ оборвался, задайте вопрос ещё раз."
+
+def build_messages(question: str, context: list = None, user_context: list = None, summary: tuple = None):
+    """Сборка сообщений для модели в пределах PROMPT_TOKEN_BUDGET.
+
+    Бюджет заполняется по приоритету: системный промпт, текущий вопрос,
+    самые релевантные записи базы (без повторов), резюме старой части
+    диалога, последние реплики. summary - (текст, сколько первых реплик
+    user_context уже в нём) из get_user_summary.
+    """
+    turns = list(user_context or [])
+    # Последняя запись контекста - сам текущий вопрос
+    if turns and turns[-1]["role"] == "user" and turns[-1]["content"] == question:
+        turns.pop()
+
+    header = "You Asuna - Booking Cat Assistant for Darkexpress. \n\nYOU HAVE DATABASE:\n"
+    question_message = {"role": "user", "content": question}
+    budget = PROMPT_TOKEN_BUDGET - count_tokens(header) - 2 * MESSAGE_OVERHEAD - message_tokens(question_message)
+    snippets, used = select_snippets(context or [], budget)
+    budget -= used
+
+    # Системное сообщение с логикой работы
+    if snippets:
+        system_prompt = header + "\n".join(snippets) + "\n"
+    else:
+        system_prompt = """You Asuna - ai assistant with database."""
+
+    if summary:
+        # Первые реплики уже пересказаны в резюме
+        turns = turns[summary[1]:]
+        summary_text = truncate(summary[0], min(SUMMARY_MAX_TOKENS, budget - 10))
+        if summary_text:
+            system_prompt += f"\nEARLIER IN THIS CONVERSATION:\n{summary_text}\n"
+            budget -= count_tokens(summary_text) + 10
+
+    messages = [{"role": "system", "content": system_prompt}]
+    # Контекст диалога: последние реплики, которые влезают в бюджет
+    messages.extend(select_turns(turns, budget))
+    # Текущий вопрос
+    messages.append(question_message)
+    metrics.inc("prompt_tokens", value=sum(message_tokens(message) for message in messages))
+    return messages
+
+def summarize_dialogue(previous: str, turns: list) -> str:
+    """Обновление резюме диалога: прежнее резюме + новые старые реплики (вызывается в фоне)"""
+    lines = "\n".join(
+        f"{'Asuna' if turn['role'] == 'assistant' else 'User'}: {turn['content']}" for turn in turns
+    )
+    messages = [
+        {"role": "system", "content": (
+            "You keep a short running summary of a conversation between a user and Asuna, "
+            "a booking assistant. Merge the new lines into the summary. Keep names, dates, "
+            "booking details, user preferences and open questions; drop greetings and small talk. "
+            "Reply with the updated summary only, in the language of the conversation, "
+            "no longer than 80 words."
+        )},
+        {"role": "user", "content": f"Summary so far:\n{previous or '(empty)'}\n\nNew lines:\n{lines}"},
+    ]
+    payload = openrouter_payload(messages)
+    payload["temperature"] = 0.1
+    payload["max_tokens"] = SUMMARY_MAX_TOKENS
+    with metrics.stage("summary"):
+        response = http_session.post(OPENROUTER_URL, headers=openrouter_headers(), json=payload, timeout=LLM_TIMEOUT)
+    if response.status_code != 200:
+        logging.error(f"Ошибка OpenRouter при обновлении резюме: {response.status_code} - {response.text}")
+        metrics.inc("errors", "summary")
+        return None
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+def openrouter_headers():
+    """Заголовки запроса к OpenRouter"""
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": RENDER_URL,  # Опционально для OpenRouter
+    }
+
+def openrouter_payload(messages: list):
+    """Тело запроса к OpenRouter"""
+    return {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "temperature": 0.3,  # Более стабильные ответы
+        "max_tokens": 300    # Максимальная длина ответа
+    }
+
+def ask_nemotron(question: str, context: list = None, user_context: list = None, summary: tuple = None):
+    """Запрос к Nemotron Nano через OpenRouter"""
+    try:
+        messages = build_messages(question, context, user_context, summary)
+
+        # Запрос к OpenRouter с Nemotron Nano
+        with metrics.stage("llm"):
+            response = http_session.post(
+                OPENROUTER_URL,
+                headers=openrouter_headers(),
+                json=openrouter_payload(messages),
+                timeout=LLM_TIMEOUT
+            )
         
         if response.status_code == 200:
             result = response.json()
             return result["choices"][0]["message"]["content"]
         else:
             logging.error(f"Ошибка OpenRouter: {response.status_code} - {response.text}")
-            return "Извини, у меня проблемы с получением ответа. Попробуй позже."
+            metrics.inc("errors", "llm")
+            return LLM_ERROR_TEXT
             
     except requests.exceptions.Timeout:
         logging.error("Таймаут запроса к Nemotron")
-        return "Извини, запрос занял слишком много времени. Попробуй позже."
+        metrics.inc("timeouts", "llm")
+        return LLM_TIMEOUT_TEXT
     except Exception as e:
         logging.error(f"Ошибка запроса к Nemotron: {e}")
-        return "Извини, произошла ошибка. Попробуй позже."
+        return LLM_FAILURE_TEXT
+
+# ----------------- Отправка в Telegram -----------------
+TELEGRAM_API_URL = "https://api.telegram.org/bot{0}/{1}"
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+def telegram_api(method: str, payload: dict) -> dict:
+    """Вызов метода Bot API через общий пул соединений; возвращает ответ Telegram целиком.
+
+    Файлы передаются в payload["files"] ({поле: (имя, байты)}) - тогда запрос
+    уходит как multipart/form-data.
+    """
+    url = (telebot.apihelper.API_URL or TELEGRAM_API_URL).format(TELEGRAM_TOKEN, method)
+    files = payload.get("files")
+    with metrics.stage("telegram"):
+        if files:
+            data = {key: value for key, value in payload.items() if key != "files"}
+            response = http_session.post(url, data=data, files=files, timeout=TELEGRAM_UPLOAD_TIMEOUT)
+        else:
+            response = http_session.post(url, json=payload, timeout=TELEGRAM_TIMEOUT)
+    return response.json()
+
+def telegram_download(file_path: str, path: str):
+    """Скачивание файла (file_path из getFile) с файлового сервера Telegram в path через общий пул соединений"""
+    url = (telebot.apihelper.FILE_URL or TELEGRAM_FILE_URL).format(TELEGRAM_TOKEN, file_path)
+    # http_session.get - метод LazyClient, поэтому request("GET", ...)
+    try:
+        with metrics.stage("telegram"), http_session.request("GET", url, stream=True, timeout=TELEGRAM_UPLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)  # недокачанный файл
+        raise
+
+def reply(message, text: str, wait: bool = False, **params):
+    """Ответ на сообщение через очередь отправки (длинный текст - несколькими сообщениями).
+
+    Возвращает Future сразу; wait=True - дождаться отправки и вернуть
+    отправленное сообщение (dict из ответа Telegram) или бросить ошибку.
+    """
+    future = outbox.send(message.chat.id, text, reply_to=message.message_id, **params)
+    return future.result(TELEGRAM_SEND_WAIT) if wait else future
+
+def edit_text(sent: dict, text: str, **params):
+    """Правка отправленного сообщения через очередь; ожидающая правка того же сообщения заменяется"""
+    return outbox.edit(sent["chat"]["id"], sent["message_id"], text, **params)
+
+def answer_callback(call, text: str = None):
+    """Ответ на нажатие кнопки через очередь чата, где нажата кнопка"""
+    payload = {"callback_query_id": call.id}
+    if text:
+        payload["text"] = text[:200]
+    return outbox.call("answerCallbackQuery", payload, chat_id=call.message.chat.id)
+
+# ----------------- Потоковые ответы -----------------
+STREAM_PLACEHOLDER = "✍️ ..."
+STREAM_CURSOR = " ▌"
+
+def parse_sse_line(line: str):
+    """Текстовый фрагмент из строки SSE-потока OpenRouter (None - не данные или конец)"""
+    if not line or not line.startswith("data:"):
+        return None  # пустые строки и комментарии вроде ": OPENROUTER PROCESSING"
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    chunk = json.loads(data)
+    if "error" in chunk:
+        raise RuntimeError(chunk["error"])
+    choices = chunk.get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or None
+
+def ask_nemotron_stream(question: str, context: list = None, user_context: list = None, summary: tuple = None):
+    """Потоковый запрос к модели: генератор фрагментов ответа"""
+    payload = openrouter_payload(build_messages(question, context, user_context, summary))
+    payload["stream"] = True
+    with http_session.post(
+        OPENROUTER_URL,
+        headers=openrouter_headers(),
+        json=payload,
+        stream=True,
+        timeout=LLM_TIMEOUT
+    ) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"OpenRouter {response.status_code}: {response.text}")
+        for line in response.iter_lines(decode_unicode=True):
+            delta = parse_sse_line(line)
+            if delta:
+                yield delta
+
+def stream_reply(message, question: str, context: list = None, user_context: list = None,
+                 summary: tuple = None) -> tuple:
+    """Ответ с заглушкой, которая по мере генерации дополняется правками; (текст, получен ли целиком).
+
+    Правки не чаще STREAM_EDIT_INTERVAL; если чат упёрся в лимит Telegram,
+    очередь отправки сама ждёт retry_after и отправляет только последнюю правку.
+    Если поток не удался до первых токенов, ответ запрашивается целиком;
+    если после - пользователь видит начало ответа с пометкой STREAM_CUT_TEXT.
+    """
+    try:
+        placeholder = reply(message, STREAM_PLACEHOLDER, wait=True)
+    except Exception as e:
+        logging.error(f"Не удалось отправить заглушку: {e}")
+        response = ask_nemotron(question, context, user_context, summary)
+        reply(message, response)
+        return response, True
+
+    text = ""
+    shown = ""
+    complete = True
+    started = time.perf_counter()
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    try:
+        for delta in ask_nemotron_stream(question, context, user_context, summary):
+            if not text:
+                metrics.observe("llm-first-token", time.perf_counter() - started)
+            text += delta
+            if time.monotonic() >= next_edit and text.strip() != shown:
+                shown = text.strip()
+                next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                edit_text(placeholder, shown[:MESSAGE_LIMIT - len(STREAM_CURSOR)] + STREAM_CURSOR)
+    except Exception as e:
+        logging.error(f"Ошибка потокового ответа: {e}")
+        metrics.inc("errors", "llm-stream")
+        if not text.strip():
+            text = ask_nemotron(question, context, user_context, summary)
+        else:
+            complete = False
+            text = text.strip() + STREAM_CUT_TEXT
+    else:
+        metrics.observe("llm", time.perf_counter() - started)
+
+    text = text.strip() or LLM_ERROR_TEXT
+    edit_text(placeholder, text)  # не поместившееся в заглушку уходит следующими сообщениями
+    return text, complete
 
 # ----------------- Управление контекстом пользователей -----------------
 def add_to_user_context(user_id: int, message: str, is_bot: bool = False):
     """Добавление сообщения в контекст пользователя"""
-    if user_id not in user_contexts:
-        user_contexts[user_id] = []
-    
     role = "assistant" if is_bot else "user"
-    user_contexts[user_id].append({"role": role, "content": message})
-    
-    # Ограничиваем контекст последними 10 сообщениями
-    if len(user_contexts[user_id]) > 10:
-        user_contexts[user_id] = user_contexts[user_id][-10:]
+    # Хранилище держит последние CONTEXT_MAX_TURNS сообщений, запись на диск - в фоне
+    context_store.append(user_id, role, message)
+    if is_bot and summarizer is not None:
+        summarizer.schedule(user_id)  # старые реплики сворачиваются в резюме в фоне
 
 def get_user_context(user_id: int):
     """Получение контекста пользователя"""
-    return user_contexts.get(user_id, [])
+    return context_store.get(user_id)
+
+def get_user_idle(user_id: int):
+    """Секунды между последней репликой пользователя и предыдущей (None, если диалога не было)"""
+    return context_store.idle_before_last(user_id)
+
+def get_user_summary(user_id: int):
+    """Резюме старой части диалога: (текст, сколько первых реплик контекста в него вошло) или None"""
+    if summarizer is None:
+        return None
+    record = context_store.get_summary(user_id)
+    if not record:
+        return None
+    first, turns = context_store.get_window(user_id)
+    return record[0], len(turns) - len(turns_after(turns, first, record[1]))
 
 # ----------------- Обработчики команд -----------------
 @bot.message_handler(commands=['start'])
@@ -245,7 +1043,7 @@ def handle_start(message):
 
 Примечание: Общую базу знаний может пополнять только администратор."""
     
-    bot.reply_to(message, welcome_text)
+    reply(message, welcome_text)
     add_to_user_context(message.from_user.id, message.text)
     add_to_user_context(message.from_user.id, welcome_text, is_bot=True)
 
@@ -258,21 +1056,30 @@ def handle_help(message):
 1. **Добавить в базу знаний:**
    `запомни Python - это язык программирования`
 
-2. **Задать вопрос:**
+2. **Загрузить документ:**
+   отправьте файл .jsonl или .txt (.jsonl.gz из `/export` - восстановление)
+
+3. **Задать вопрос:**
    `что такое Python?`
 
-3. **Очистить контекст:**
+4. **Очистить контекст:**
    `/clear`
 
-4. **Проверить статус:**
+5. **Проверить статус:**
    `/admin`
 
-5. **Просмотр базы:**
+6. **Просмотр базы:**
    `/database` или `/db`
 
-6. **Статистика:**
+7. **Статистика:**
    `/count`
 
+8. **Убрать дубликаты в базе:**
+   `/compact check` - показать, `/compact` - удалить, `/compact merge` - слить
+
+9. **Резервная копия базы:**
+   `/export` - файл .jsonl.gz, `/export vectors` - вместе с векторами
+
 **Модель:** Nemotron Nano 9B (бесплатная)"""
     else:
         help_text = """**Как пользоваться ботом:**
@@ -288,14 +1095,13 @@ def handle_help(message):
 - Запоминаю наш диалог для контекста
 - База знаний пополняется администратором"""
     
-    bot.reply_to(message, help_text)
+    reply(message, help_text)
 
 @bot.message_handler(commands=['clear'])
 def handle_clear(message):
     user_id = message.from_user.id
-    if user_id in user_contexts:
-        del user_contexts[user_id]
-    bot.reply_to(message, "Контекст диалога очищен")
+    context_store.clear(user_id)
+    reply(message, "Контекст диалога очищен")
 
 @bot.message_handler(commands=['admin'])
 def handle_admin(message):
@@ -304,63 +1110,109 @@ def handle_admin(message):
         admin_info = (
             "**Админ панель**\n\n"
             f"Ваш ID: `{user_id}`\n"
-            f"Активных пользователей: {len(user_contexts)}\n"
+            f"Активных пользователей: {len(context_store)} (всего диалогов: {context_store.total_users()})\n"
             "Статус базы знаний: Активна\n"
-            "Модель: Nemotron Nano 9B\n\n"
+            "Модель: Nemotron Nano 9B\n"
+            f"Кэш эмбеддингов: {embedding_cache_summary()}\n"
+            f"Кэш ответов: {answer_cache_summary()}\n"
+            f"Очередь: {dispatcher_summary()}\n"
+            f"Отправка: {outbox_summary()}\n"
+            f"Лимиты LLM: {limiter_summary()}\n\n"
+            f"**Задержки:**\n{metrics.summary()}\n\n"
             "**Доступные команды:**\n"
             "• `запомни [текст]` - добавить в базу\n"
+            "• отправьте файл .jsonl/.txt - массовая загрузка\n"
             "• `/clear` - очистить свой контекст\n"
             "• `/database` - просмотр базы\n"
             "• `/count` - статистика\n"
+            "• `/compact` - убрать дубликаты в базе\n"
+            "• `/export` - резервная копия базы\n"
             "• `/admin` - эта панель"
         )
-        bot.reply_to(message, admin_info, parse_mode='Markdown')
+        reply(message, admin_info, parse_mode='Markdown')
     else:
-        bot.reply_to(message, "У вас нет прав администратора")
+        reply(message, "У вас нет прав администратора")
+
+def database_page(session: str, page: int, user_id: int):
+    """Текст и кнопки страницы /database; None, если сессия просмотра устарела"""
+    found, offset = database_cursors.offset(session, user_id, page)
+    if not found:
+        return None
+    points, next_offset = qdrant.scroll(
+        collection_name=COLLECTION_NAME,
+        limit=DATABASE_PAGE_SIZE,
+        offset=offset,
+        with_payload=True
+    )
+    database_cursors.remember(session, page, next_offset)
+    if not points:
+        return "База данных пуста", None
+
+    first = page * DATABASE_PAGE_SIZE + 1
+    total = qdrant.count(collection_name=COLLECTION_NAME, exact=False).count
+    database_text = f"**База знаний** (записи {first}-{first + len(points) - 1} из ~{total}):\n\n"
+
+    for i, point in enumerate(points, first):
+        text = point.payload.get("text", "Нет текста")
+        source = point.payload.get("source", "unknown")
+        if len(text) > 100:
+            text = text[:100] + "..."
+        database_text += f"{i}. `{text}`\n   *Источник: {source}*\n\n"
+
+    # Курсоры страниц хранятся в сессии, в кнопке - только её токен и номер страницы
+    buttons = []
+    if page > 0:
+        buttons.append({"text": "◀️ Назад", "callback_data": f"db:{session}:{page - 1}"})
+    if next_offset is not None:
+        buttons.append({"text": "Вперёд ▶️", "callback_data": f"db:{session}:{page + 1}"})
+    return database_text, {"inline_keyboard": [buttons]} if buttons else None
 
 @bot.message_handler(commands=['database', 'db'])
 def handle_database(message):
     user_id = message.from_user.id
     if not is_admin(user_id):
-        bot.reply_to(message, "У вас нет прав администратора")
+        reply(message, "У вас нет прав администратора")
         return
     
     try:
-        result = qdrant.scroll(
-            collection_name=COLLECTION_NAME,
-            limit=20,
-            with_payload=True
-        )
-        
-        points = result[0]
-        
-        if not points:
-            bot.reply_to(message, "База данных пуста")
-            return
-        
-        database_text = f"**База знаний** (показано {len(points)} записей):\n\n"
-        
-        for i, point in enumerate(points, 1):
-            text = point.payload.get("text", "Нет текста")
-            source = point.payload.get("source", "unknown")
-            if len(text) > 100:
-                text = text[:100] + "..."
-            database_text += f"{i}. `{text}`\n   *Источник: {source}*\n\n"
-        
-        if len(database_text) > 4000:
-            database_text = database_text[:4000] + "\n...\n_Список обрезан_"
-        
-        bot.reply_to(message, database_text, parse_mode='Markdown')
+        database_text, markup = database_page(database_cursors.open(user_id), 0, user_id)
+        params = {"reply_markup": markup} if markup else {}
+        reply(message, database_text, parse_mode='Markdown', **params)
         
     except Exception as e:
         logging.error(f"Ошибка получения базы данных: {e}")
-        bot.reply_to(message, f"Ошибка получения данных: {e}")
+        reply(message, f"Ошибка получения данных: {e}")
+
+@bot.callback_query_handler(func=lambda call: (call.data or "").startswith("db:"))
+def handle_database_page(call):
+    """Кнопки листания /database"""
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        answer_callback(call, "У вас нет прав администратора")
+        return
+
+    try:
+        _, session, page = call.data.split(":")
+        result = database_page(session, int(page), user_id)
+    except Exception as e:
+        logging.error(f"Ошибка получения базы данных: {e}")
+        answer_callback(call, f"Ошибка получения данных: {e}")
+        return
+    if result is None:
+        answer_callback(call, "Список устарел, отправьте /database ещё раз")
+        return
+
+    database_text, markup = result
+    params = {"reply_markup": markup} if markup else {}
+    # Ответ на нажатие - раньше правки: Telegram ждёт его, пока крутится индикатор на кнопке
+    answer_callback(call)
+    outbox.edit(call.message.chat.id, call.message.message_id, database_text, parse_mode='Markdown', **params)
 
 @bot.message_handler(commands=['count'])
 def handle_count(message):
     user_id = message.from_user.id
     if not is_admin(user_id):
-        bot.reply_to(message, "У вас нет прав администратора")
+        reply(message, "У вас нет прав администратора")
         return
     
     try:
@@ -371,18 +1223,271 @@ def handle_count(message):
             "📊 **Статистика базы данных:**\n\n"
             f"Коллекция: `{COLLECTION_NAME}`\n"
             f"Записей: **{points_count}**\n"
-            "Размер вектора: 1536\n"
+            f"Размер вектора: {collection_info.config.params.vectors.size}\n"
             "Метрика: Cosine\n"
+            f"Квантование: {quantization_name(collection_info.config.quantization_config)}\n"
+            f"Локальный индекс: {local_index_summary()}\n"
+            f"Лексический индекс: {lexical_index.size if lexical_index is not None else 'выключен'}\n\n"
+            f"**Поиск:**\n{metrics.summary(['embedding', 'lexical', 'search', 'search-local'])}\n"
             "Модель: Nemotron Nano 9B"
         )
         
-        bot.reply_to(message, count_text, parse_mode='Markdown')
+        reply(message, count_text, parse_mode='Markdown')
         
     except Exception as e:
         logging.error(f"Ошибка получения статистики: {e}")
-        bot.reply_to(message, f"Ошибка получения статистики: {e}")
+        reply(message, f"Ошибка получения статистики: {e}")
+
+_compact_lock = threading.Lock()
+
+def run_compaction(message, mode: str, dry_run: bool, status_message):
+    """Фоновое сжатие дубликатов базы знаний с отчётом"""
+    try:
+        stats = dedup.compact(
+            qdrant, COLLECTION_NAME,
+            threshold=KNOWLEDGE_DUPLICATE_THRESHOLD,
+            mode=mode,
+            embed=create_embedding,
+            dry_run=dry_run,
+            on_points=on_knowledge_changed,
+            on_removed=on_knowledge_removed
+        )
+        text = f"{'🔎 Найдено' if dry_run else '✅ Готово'}: {dedup.format_stats(stats)} за {stats['elapsed']:.0f} с"
+        for example in stats["examples"]:
+            text += "\n• " + " | ".join(example)
+    except Exception as e:
+        logging.error(f"Ошибка сжатия базы знаний: {e}")
+        text = f"❌ Ошибка сжатия базы знаний: {e}"
+    finally:
+        _compact_lock.release()
+    try:
+        edit_text(status_message, text).result(TELEGRAM_SEND_WAIT)
+    except Exception:
+        reply(message, text)
+
+@bot.message_handler(commands=['compact'])
+def handle_compact(message):
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        reply(message, "У вас нет прав администратора")
+        return
+
+    argument = message.text.split(maxsplit=1)[1].strip() if " " in message.text else ""
+    if argument not in ("", "check", "merge"):
+        reply(message, "Использование: /compact [check | merge]")
+        return
+    if not _compact_lock.acquire(blocking=False):
+        reply(message, "Сжатие базы уже идёт")
+        return
+    try:
+        status_message = reply(message, "⏳ Ищу дубликаты в базе знаний...", wait=True)
+        mode = "merge" if argument == "merge" else "replace"
+        threading.Thread(target=run_compaction, args=(message, mode, argument == "check", status_message),
+                         daemon=True).start()
+    except Exception:
+        _compact_lock.release()
+        raise
+
+def quantization_name(config) -> str:
+    """Тип квантования коллекции для статистики"""
+    if config is None:
+        return "нет"
+    return type(config).__name__.replace("Quantization", "").lower() or "да"
+
+def ingest_state_path(fingerprint: str) -> str:
+    """Файл состояния загрузки по отпечатку содержимого; заодно удаляются состояния старше INGEST_STATE_TTL"""
+    os.makedirs(INGEST_STATE_DIR, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(INGEST_STATE_DIR):
+        stale = os.path.join(INGEST_STATE_DIR, name)
+        try:
+            if now - os.path.getmtime(stale) > INGEST_STATE_TTL:
+                os.remove(stale)
+        except OSError:
+            pass  # файл уже удалил другой воркер
+    digest = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(INGEST_STATE_DIR, f"{digest}.json")
+
+def run_document_ingest(message, path: str, status_message):
+    """Фоновая загрузка документа в базу знаний с отчётом о прогрессе"""
+    last_edit = [0.0]
+
+    def progress(stats):
+        # Не чаще раза в 3 секунды, чтобы не упереться в лимиты Telegram
+        if time.time() - last_edit[0] < 3:
+            return
+        last_edit[0] = time.time()
+        edit_text(status_message, f"⏳ {ingest.format_progress(stats)}")
+
+    try:
+        fingerprint = ingest.file_fingerprint(path)
+        stats = ingest.ingest(
+            ingest.read_records(path, source=f"admin_{message.from_user.id}"),
+            openai_client, qdrant,
+            collection=COLLECTION_NAME,
+            model=EMBEDDING_MODEL,
+            dimensions=vector_size,
+            state_path=ingest_state_path(fingerprint),
+            progress=progress,
+            on_points=on_knowledge_changed,
+            input_id=fingerprint
+        )
+        text = f"✅ Документ загружен: {ingest.format_progress(stats)} за {stats['elapsed']:.0f} с"
+        if stats["failed"]:
+            text += "\nПришлите файл ещё раз, чтобы догрузить пропущенные пакеты."
+    except Exception as e:
+        logging.error(f"Ошибка загрузки документа: {e}")
+        text = f"❌ Ошибка загрузки документа: {e}"
+    finally:
+        # Состояние лежит в INGEST_STATE_DIR под отпечатком файла: повторная отправка того же
+        # файла продолжит загрузку, а брошенное состояние удалится через INGEST_STATE_TTL
+        os.remove(path)
+    try:
+        edit_text(status_message, text).result(TELEGRAM_SEND_WAIT)
+    except Exception:
+        reply(message, text)
+
+def run_restore(message, path: str, status_message):
+    """Фоновое восстановление базы знаний из выгрузки /export с отчётом о прогрессе"""
+    last_edit = [0.0]
+
+    def progress(stats):
+        # Не чаще раза в 3 секунды, чтобы не упереться в лимиты Telegram
+        if time.time() - last_edit[0] < 3:
+            return
+        last_edit[0] = time.time()
+        edit_text(status_message, f"⏳ Восстановлено {stats['points']} записей")
+
+    try:
+        stats = backup.restore_collection(
+            qdrant, COLLECTION_NAME, path,
+            embed=lambda texts: ingest.embed_texts(openai_client, texts, EMBEDDING_MODEL, dimensions=vector_size),
+            quantization=QDRANT_QUANTIZATION,
+            progress=progress,
+            on_points=on_knowledge_changed
+        )
+        text = f"✅ База восстановлена из выгрузки {stats['source']}: {backup.format_stats(stats)} за {stats['elapsed']:.0f} с"
+    except Exception as e:
+        logging.error(f"Ошибка восстановления базы знаний: {e}")
+        text = f"❌ Ошибка восстановления базы знаний: {e}"
+    finally:
+        os.remove(path)
+    try:
+        edit_text(status_message, text).result(TELEGRAM_SEND_WAIT)
+    except Exception:
+        reply(message, text)
+
+_export_lock = threading.Lock()
+
+def run_export(message, with_vectors: bool, status_message):
+    """Фоновая выгрузка базы знаний в .jsonl.gz и отправка файла"""
+    name = f"{COLLECTION_NAME}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+    path = os.path.join(tempfile.gettempdir(), f"asuna-export-{os.getpid()}-{name}")
+    last_edit = [0.0]
+
+    def progress(stats):
+        if time.time() - last_edit[0] < 3:
+            return
+        last_edit[0] = time.time()
+        edit_text(status_message, f"⏳ Выгружено {stats['points']} записей")
+
+    try:
+        stats = backup.export_collection(qdrant, COLLECTION_NAME, path, with_vectors=with_vectors, progress=progress)
+        text = f"✅ Выгрузка готова: {backup.format_stats(stats)} за {stats['elapsed']:.0f} с"
+        if stats["bytes"] > EXPORT_MAX_MB * 1024 * 1024:
+            text += f"\nФайл больше {EXPORT_MAX_MB} МБ и не пройдёт через Telegram: выгрузите базу командой python backup.py export"
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+            outbox.call("sendDocument", {
+                "chat_id": message.chat.id,
+                "reply_to_message_id": message.message_id,
+                "caption": "Восстановление: отправьте этот файл боту",
+                "files": {"document": (name, data)},
+            }).result(TELEGRAM_UPLOAD_TIMEOUT * outbox.max_attempts)
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки базы знаний: {e}")
+        text = f"❌ Ошибка выгрузки базы знаний: {e}"
+    finally:
+        _export_lock.release()
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        edit_text(status_message, text).result(TELEGRAM_SEND_WAIT)
+    except Exception:
+        reply(message, text)
+
+@bot.message_handler(commands=['export'])
+def handle_export(message):
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        reply(message, "У вас нет прав администратора")
+        return
+
+    argument = message.text.split(maxsplit=1)[1].strip() if " " in message.text else ""
+    if argument not in ("", "vectors"):
+        reply(message, "Использование: /export [vectors]")
+        return
+    if not _export_lock.acquire(blocking=False):
+        reply(message, "Выгрузка базы уже идёт")
+        return
+    try:
+        status_message = reply(message, "⏳ Выгружаю базу знаний...", wait=True)
+        threading.Thread(target=run_export, args=(message, argument == "vectors", status_message),
+                         daemon=True).start()
+    except Exception:
+        _export_lock.release()
+        raise
+
+@bot.message_handler(content_types=['document'])
+def handle_document(message):
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        reply(message, "Только администратор может загружать документы в базу знаний")
+        return
+
+    document = message.document
+    name = document.file_name or "document.txt"
+    restore = name.endswith(".jsonl.gz")  # выгрузка из /export
+    if not restore and not name.endswith((".jsonl", ".txt", ".md")):
+        reply(message, "Поддерживаются файлы .jsonl, .txt и .md, а также выгрузки .jsonl.gz")
+        return
+
+    try:
+        # getFile - метод Bot API, он идёт через очередь чата; само скачивание - с файлового
+        # сервера Telegram (не Bot API, без лимитов на отправку), через общий пул с таймаутом
+        file_info = outbox.call("getFile", {"file_id": document.file_id},
+                                chat_id=message.chat.id).result(TELEGRAM_SEND_WAIT)
+        # Имя зависит от file_unique_id: повторная отправка того же файла продолжает загрузку
+        path = os.path.join(tempfile.gettempdir(), f"asuna-{document.file_unique_id}-{os.path.basename(name)}")
+        telegram_download(file_info["file_path"], path)
+    except Exception as e:
+        logging.error(f"Ошибка скачивания документа: {e}")
+        reply(message, f"Не удалось скачать файл: {e}")
+        return
+
+    try:
+        status = f"⏳ Восстанавливаю базу из {name}..." if restore else f"⏳ Загружаю {name} в базу знаний..."
+        status_message = reply(message, status, wait=True)
+    except Exception as e:
+        logging.error(f"Не удалось отправить статус загрузки: {e}")
+        return
+    target = run_restore if restore else run_document_ingest
+    threading.Thread(target=target, args=(message, path, status_message), daemon=True).start()
 
 # ----------------- Обработчик сообщений -----------------
+def answer_cacheable(user_context: list, question: str, idle=None) -> bool:
+    """Можно ли использовать кэш ответов: предыдущие реплики не меняют смысл вопроса"""
+    # Последняя запись контекста - сам текущий вопрос
+    return ANSWER_CACHE_ENABLED and context_allows(
+        len(user_context) - 1, idle, question,
+        max_turns=ANSWER_CACHE_CONTEXT_TURNS, idle_after=ANSWER_CACHE_IDLE
+    )
+
+def is_remember_command(text: str) -> bool:
+    """Сообщение - команда «запомни ...»"""
+    return text.lower().startswith("запомни ")
+
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
     try:
@@ -393,15 +1498,17 @@ def handle_message(message):
         
         # Добавляем сообщение в контекст
         add_to_user_context(user_id, user_text)
+        replied = False
+        limited = False
         
         # Команда для запоминания - только для админа
-        if user_text.lower().startswith("запомни "):
+        if is_remember_command(user_text):
             if is_admin(user_id):
                 knowledge = user_text[8:].strip()
                 if knowledge:
-                    success = add_to_knowledge_base(knowledge, source=f"admin_{user_id}")
-                    if success:
-                        response = f"✅ Запомнил: {knowledge}"
+                    status = add_to_knowledge_base(knowledge, source=f"admin_{user_id}")
+                    if status:
+                        response = KNOWLEDGE_STATUS_TEXTS[status].format(text=knowledge)
                     else:
                         response = "❌ Не удалось сохранить информацию"
                 else:
@@ -411,54 +1518,203 @@ def handle_message(message):
                 response = f"{username}, только администратор может добавлять информацию в общую базу знаний.\n\nНо я запомню наш диалог для контекста!"
         else:
             # Обычный вопрос - ищем в базе и отвечаем через Nemotron
-            knowledge_results = search_knowledge(user_text)
             user_context_data = get_user_context(user_id)
-            
-            # Отвечаем через Nemotron Nano
-            response = ask_nemotron(user_text, knowledge_results, user_context_data)
-            
-            if knowledge_results:
-                logging.info(f"Ответ дан с использованием {len(knowledge_results)} записей из базы знаний")
+
+            # Уверенное лексическое совпадение (например, код брони) - без эмбеддинга и кэша ответов
+            lexical = lexical_lookup(user_text, retrieval_policy.candidates)
+
+            # Похожий вопрос уже задавали - отвечаем из кэша без LLM
+            question_vector = None
+            if not lexical[1] and answer_cacheable(user_context_data, user_text, get_user_idle(user_id)):
+                question_vector = create_embedding(user_text)
+                response = answer_cache.lookup(question_vector) if question_vector else None
+            else:
+                response = None
+
+            if response:
+                logging.info(f"Ответ из семантического кэша для: {user_text}")
+            else:
+                # Лимиты модели: личный - отказ сразу, общий - короткое ожидание
+                decision = llm_limiter.acquire(user_id, max_wait=LLM_GLOBAL_MAX_WAIT)
+                if not decision.allowed:
+                    logging.warning(f"Лимит запросов ({decision.scope}) для {user_id}, повтор через {decision.retry_after:.0f} с")
+                    metrics.inc("limited", decision.scope)
+                    response = limit_text(decision)
+                    limited = True
+                else:
+                    knowledge_points = search_knowledge_points(user_text, vector=question_vector, lexical=lexical)
+                    knowledge_results = [point.payload["text"] for point in knowledge_points]
+
+                    # Отвечаем через Nemotron Nano
+                    summary = get_user_summary(user_id)
+                    complete = True
+                    if STREAM_RESPONSES:
+                        response, complete = stream_reply(message, user_text, knowledge_results,
+                                                          user_context_data, summary)
+                        replied = True
+                    else:
+                        response = ask_nemotron(user_text, knowledge_results, user_context_data, summary)
+
+                    # Оборванный или аварийный ответ в кэш не попадает
+                    if question_vector and complete and response not in LLM_FALLBACK_TEXTS:
+                        answer_cache.store(user_text, question_vector, [point.id for point in knowledge_points], response)
+
+                    if knowledge_results:
+                        logging.info(f"Ответ дан с использованием {len(knowledge_results)} записей из базы знаний")
         
         # Отправляем ответ
-        bot.reply_to(message, response)
+        if not replied:
+            reply(message, response)
         
-        # Добавляем ответ в контекст
-        add_to_user_context(user_id, response, is_bot=True)
+        # Добавляем ответ в контекст (сообщение о лимите модели не нужно)
+        if not limited:
+            add_to_user_context(user_id, response, is_bot=True)
         
     except Exception as e:
         logging.error(f"Ошибка обработки сообщения: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуй еще раз.")
+        reply(message, "Произошла ошибка. Попробуй еще раз.")
 
 # ----------------- Flask маршруты -----------------
-@app.route("/", methods=["GET"])
 def home():
     return "Asuna Knowledge Bot is running! Model: Nemotron Nano 9B", 200
 
-@app.route(f"/{TELEGRAM_TOKEN}", methods=["POST"])
+def process_update(update):
+    """Обработка одного обновления в воркере (с замером полного времени)"""
+    with track(profiler, f"update {update.update_id}"), metrics.stage("update"):
+        bot.process_new_updates([update])
+
+def update_chat_id(update):
+    """chat_id обновления (ключ для последовательной обработки)"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
+
+def is_coalescable(update) -> bool:
+    """Обычный текстовый вопрос, который можно склеить с соседними сообщениями"""
+    message = update.message
+    return (
+        message is not None and message.content_type == "text" and bool(message.text)
+        and not message.text.startswith("/") and not is_remember_command(message.text.strip())
+    )
+
+def coalesce_key(update):
+    """Ключ склейки: чат и автор (в группе сообщения разных людей не склеиваются)"""
+    chat_id = update_chat_id(update)
+    source = update.message or update.edited_message or update.callback_query
+    user = getattr(source, "from_user", None)
+    if chat_id is None or user is None:
+        return None
+    return chat_id, user.id
+
+def merge_updates(updates: list):
+    """Одно обновление из нескольких сообщений чата: тексты через перевод строки, ответ - на последнее"""
+    update = updates[-1]
+    if len(updates) > 1:
+        update.message.text = "\n".join(item.message.text.strip() for item in updates)
+        logging.info(f"Склеено {len(updates)} сообщений чата {update.message.chat.id}")
+        metrics.inc("coalesced", value=len(updates) - 1)
+    return update
+
+def submit_messages(key: tuple, updates: list):
+    """Передача пачки сообщений автора в пул обработки (вызывается из потока склейки)"""
+    chat_id = key[0]
+    update = merge_updates(updates)
+    if not dispatcher.submit(chat_id, process_update, update):
+        logging.warning(f"Очередь переполнена, сообщения чата {chat_id} отклонены")
+        outbox.send(chat_id, BUSY_TEXT)
+
 def webhook():
     try:
         json_data = request.get_json()
         if json_data:
             logging.info("Получен webhook от Telegram")
             update = telebot.types.Update.de_json(json_data)
-            threading.Thread(target=bot.process_new_updates, args=([update],)).start()
+            chat_id = update_chat_id(update)
+            key = chat_id if chat_id is not None else update.update_id
+            coalesce = coalesce_key(update) if coalescer is not None else None
+            if coalesce is not None:
+                if is_coalescable(update):
+                    coalescer.add(coalesce, update)
+                    return "", 200
+                # Накопленные вопросы автора обрабатываются раньше его команды
+                pending = coalescer.take(coalesce)
+                if pending:
+                    submit_messages(coalesce, pending)
+            if not dispatcher.submit(key, process_update, update):
+                logging.warning(f"Очередь переполнена, обновление {update.update_id} отклонено")
+                if chat_id is not None and update.message:
+                    # Ответ прямо в теле webhook - без лишнего запроса к Telegram
+                    return jsonify({"method": "sendMessage", "chat_id": chat_id, "text": BUSY_TEXT}), 200
         return "", 200
     except Exception as e:
         logging.error(f"Ошибка webhook: {e}")
         return "", 500
 
-def set_webhook():
-    """Установка webhook"""
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+def create_app() -> Flask:
+    """Фабрика Flask-приложения.
+
+    Не создаёт клиентов и потоков: это делает start_runtime() в каждом
+    воркере, поэтому приложение можно загрузить в мастере gunicorn
+    (preload_app) и быстро форкать воркеры.
+    """
+    check_settings()
+    app = Flask(__name__)
+    app.add_url_rule("/", "home", home, methods=["GET"])
+    app.add_url_rule(f"/{TELEGRAM_TOKEN}", "webhook", webhook, methods=["POST"])
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint, methods=["GET"])
+    app.before_request(start_runtime)  # если воркер запущен не через gunicorn.conf.py
+    return app
+
+def set_webhook() -> bool:
+    """Установка webhook (без запроса, если он уже указывает на нужный адрес)"""
     try:
         webhook_url = f"{RENDER_URL}/{TELEGRAM_TOKEN}"
+        if bot.get_webhook_info().url == webhook_url:
+            logging.info(f"Webhook уже установлен: {webhook_url}")
+            return True
         result = bot.set_webhook(url=webhook_url)
         if result:
             logging.info(f"✅ Webhook установлен: {webhook_url}")
         else:
             logging.error("❌ Ошибка установки webhook")
+        return bool(result)
     except Exception as e:
         logging.error(f"Ошибка при установке webhook: {e}")
+        return False
+
+def startup_marker() -> str:
+    """Файл-отметка разовой инициализации для текущего деплоя"""
+    deploy = DEPLOY_ID or str(os.path.getmtime(__file__))
+    key = hashlib.sha1(f"{deploy}|{TELEGRAM_TOKEN}|{QDRANT_URL}|{RENDER_URL}".encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"asuna-startup-{key}")
+
+def run_startup_once() -> bool:
+    """Проверка коллекции и установка webhook один раз на деплой, а не в каждом воркере.
+
+    Воркеры на одной машине договариваются через файловую блокировку;
+    отметка пишется только после успеха, иначе попытку повторит следующий воркер.
+    """
+    marker = startup_marker()
+    try:
+        with open(f"{marker}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(marker):
+                return False
+            if init_collections() and set_webhook():
+                with open(marker, "w") as f:
+                    f.write(str(time.time()))
+                logging.info("Разовая инициализация деплоя выполнена")
+            return True
+    except OSError as e:
+        logging.error(f"Ошибка разовой инициализации: {e}")
+        return False
 
 # ----------------- Запуск -----------------
 if __name__ == "__main__":
@@ -466,9 +1722,14 @@ if __name__ == "__main__":
     logging.info(f"👤 Admin User ID: {ADMIN_USER_ID}")
     logging.info(f"🤖 Model: Nemotron Nano 9B (Free)")
     
-    # Инициализация
-    init_collections()
-    set_webhook()
+    try:
+        app = create_app()
+    except RuntimeError as e:
+        logging.error(e)
+        exit(1)
+
+    # Коллекция и webhook проверяются в фоне, после открытия порта
+    start_runtime()
     
     logging.info(f"✅ Бот запущен на порту {PORT}")
     logging.info(f"🌐 Webhook: {RENDER_URL}/{TELEGRAM_TOKEN}")
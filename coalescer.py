@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Склейка подряд идущих сообщений одного автора в чате (debounce перед обработкой)"""
+import logging
+import threading
+import time
+
+
+class MessageCoalescer:
+    """Копит сообщения по ключу (чат, автор), пока пользователь продолжает писать.
+
+    Пачка отдаётся в flush(key, items), когда после последнего сообщения
+    прошло window секунд, с первого - max_wait секунд или набралось
+    max_items сообщений. flush вызывается из фонового потока под блокировкой:
+    take() той же пачки ждёт, пока она не будет передана дальше, поэтому
+    flush должен только ставить пачку в очередь обработки.
+    """
+
+    def __init__(self, flush, window: float = 1.0, max_wait: float = 4.0, max_items: int = 5,
+                 name: str = "coalescer"):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._pending = {}  # key -> [items, время первого, время последнего]
+        self._cond = threading.Condition()
+        self.batches = 0
+        self.merged = 0     # сообщений, склеенных с предыдущими
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, key, item):
+        """Добавить сообщение в пачку чата"""
+        now = time.monotonic()
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [[item], now, now]
+            else:
+                entry[0].append(item)
+                entry[2] = now
+            self._cond.notify()
+
+    def take(self, key) -> list:
+        """Забрать накопленное по ключу сразу (например, перед командой)"""
+        with self._cond:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return []
+            self.batches += 1
+            self.merged += len(entry[0]) - 1
+        return entry[0]
+
+    def _deadline(self, entry) -> float:
+        if len(entry[0]) >= self.max_items:
+            return 0.0
+        return min(entry[2] + self.window, entry[1] + self.max_wait)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [key for key, entry in self._pending.items() if self._deadline(entry) <= now]
+                if not due:
+                    deadlines = [self._deadline(entry) for entry in self._pending.values()]
+                    self._cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+                # Передача под блокировкой: команда, пришедшая в этот момент, встанет в очередь после пачки
+                for key in due:
+                    items = self._pending.pop(key)[0]
+                    self.batches += 1
+                    self.merged += len(items) - 1
+                    try:
+                        self.flush(key, items)
+                    except Exception as e:
+                        logging.error(f"Ошибка передачи сообщений {key}: {e}")
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = sum(len(entry[0]) for entry in self._pending.values())
+            chats = len(self._pending)
+        return {"pending": pending, "chats": chats, "batches": self.batches, "merged": self.merged}
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""Хранилище контекстов диалогов: кольцевые буферы в памяти + SQLite"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+
+class SQLiteBackend:
+    """Долговременное хранение реплик в SQLite (WAL), общее для всех воркеров"""
+
+    def __init__(self, path: str, max_turns: int = 10, retention: float = 30 * 86400):
+        self.path = path
+        self.max_turns = max_turns
+        self.retention = retention
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL, turn INTEGER)"
+        )
+        if "turn" not in [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]:
+            # База от прежней версии: номера реплик появятся у новых записей
+            self._db.execute("ALTER TABLE messages ADD COLUMN turn INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "user_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, marker TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def load(self, user_id: int):
+        """Последние реплики пользователя: [(role, content, номер реплики или None, created_at), ...]"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, content, turn, created_at FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, self.max_turns)
+            ).fetchall()
+        return rows[::-1]
+
+    def load_summary(self, user_id: int):
+        """Резюме старой части диалога: (summary, marker) или None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary, marker FROM summaries WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def write_batch(self, ops: list):
+        """Запись пакета операций одной транзакцией"""
+        touched = set()
+        with self._lock:
+            with self._db:
+                for op in ops:
+                    if op[0] == "append":
+                        _, user_id, role, content, created_at, turn = op
+                        self._db.execute(
+                            "INSERT INTO messages (user_id, role, content, created_at, turn) VALUES (?, ?, ?, ?, ?)",
+                            (user_id, role, content, created_at, turn)
+                        )
+                        touched.add(user_id)
+                    elif op[0] == "summary":
+                        _, user_id, summary, marker, updated_at = op
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO summaries (user_id, summary, marker, updated_at) VALUES (?, ?, ?, ?)",
+                            (user_id, summary, marker, updated_at)
+                        )
+                    elif op[0] == "clear":
+                        self._db.execute("DELETE FROM messages WHERE user_id = ?", (op[1],))
+                        self._db.execute("DELETE FROM summaries WHERE user_id = ?", (op[1],))
+                        touched.discard(op[1])
+                # Храним не больше max_turns реплик на пользователя
+                for user_id in touched:
+                    self._db.execute(
+                        "DELETE FROM messages WHERE user_id = ? AND id NOT IN "
+                        "(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                        (user_id, user_id, self.max_turns)
+                    )
+
+    def cleanup(self):
+        """Удаление давно неактивных диалогов"""
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - self.retention,))
+                self._db.execute("DELETE FROM summaries WHERE updated_at < ?", (time.time() - self.retention,))
+
+    def count_users(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(DISTINCT user_id) FROM messages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def parse_marker(marker):
+    """Номер последней свёрнутой реплики из поля marker (-1 - метка прежнего формата или её нет)"""
+    try:
+        return int(marker)
+    except (TypeError, ValueError):
+        return -1
+
+
+class _Conversation:
+    """Кольцевой буфер реплик одного пользователя.
+
+    Реплики нумеруются по порядку с нуля (last - номер последней), номер
+    не сдвигается при вытеснении старых реплик из буфера.
+    """
+    __slots__ = ("turns", "size", "last", "summary", "synced_at", "used_at")
+
+    def __init__(self, max_turns: int, turns=(), summary=None):
+        self.turns = deque(maxlen=max_turns)  # (is_bot, content, time.time() реплики)
+        self.size = 0
+        self.last = -1
+        # (текст резюме, номер последней свёрнутой реплики)
+        self.summary = (summary[0], parse_marker(summary[1])) if summary else None
+        self.synced_at = self.used_at = time.monotonic()
+        for role, content, _, created_at in turns:
+            self.push(role == "assistant", content, created_at)
+        if turns and turns[-1][2] is not None:
+            self.last = turns[-1][2]
+
+    @property
+    def first(self) -> int:
+        """Номер самой старой реплики в буфере"""
+        return self.last - len(self.turns) + 1
+
+    def push(self, is_bot: bool, content: str, created_at: float = None):
+        if len(self.turns) == self.turns.maxlen:
+            self.size -= len(self.turns[0][1])
+        self.turns.append((is_bot, content, created_at or time.time()))
+        self.size += len(content)
+        self.last += 1
+
+
+class ConversationStore:
+    """Контексты диалогов с вытеснением и асинхронной записью.
+
+    В памяти - не больше max_users диалогов и max_chars символов суммарно
+    (вытесняются давно не использованные), а также диалоги, неактивные
+    дольше idle_ttl. Запись в backend идёт пакетами из фонового потока,
+    так что append() не ждёт диска. Диалог, не обновлявшийся локально
+    дольше refresh_after секунд, перечитывается из backend: так видны
+    реплики, записанные другими воркерами.
+    """
+
+    def __init__(self, backend=None, max_turns: int = 10, max_users: int = 10000,
+                 max_chars: int = 20_000_000, idle_ttl: float = 86400,
+                 flush_interval: float = 0.5, refresh_after: float = 2.0):
+        self.backend = backend
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_chars = max_chars
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.refresh_after = refresh_after
+        self._conversations = OrderedDict()  # user_id -> _Conversation
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._writes = queue.Queue(maxsize=100000)
+        self._pending = Counter()  # user_id -> операций, ещё не записанных в backend
+        self._last_sweep = time.monotonic()
+        self.evicted = 0
+        self.dropped_writes = 0
+        self._writer = None
+        if backend is not None:
+            self._writer = threading.Thread(target=self._write_loop, name="context-writer", daemon=True)
+            self._writer.start()
+
+    # ----------------- Память -----------------
+    def _evict(self):
+        """Вытеснение по idle_ttl и по глобальным лимитам (вызывается под блокировкой)"""
+        now = time.monotonic()
+        if now - self._last_sweep > 60:
+            self._last_sweep = now
+            for user_id in [uid for uid, conv in self._conversations.items() if now - conv.used_at > self.idle_ttl]:
+                self._chars -= self._conversations.pop(user_id).size
+                self.evicted += 1
+        while self._conversations and (len(self._conversations) > self.max_users or self._chars > self.max_chars):
+            _, conv = self._conversations.popitem(last=False)
+            self._chars -= conv.size
+            self.evicted += 1
+
+    def _load(self, user_id: int):
+        """Диалог из памяти или из backend (под блокировкой)"""
+        conv = self._conversations.get(user_id)
+        now = time.monotonic()
+        stale = conv is None or now - conv.synced_at > self.refresh_after
+        # Пока есть незаписанные операции, данные в памяти новее, чем в backend
+        if self.backend is not None and stale and not self._pending[user_id]:
+            try:
+                turns = self.backend.load(user_id)
+                summary = self.backend.load_summary(user_id)
+            except Exception as e:
+                logging.error(f"Ошибка чтения контекста {user_id}: {e}")
+                turns = None
+            if turns is not None:
+                if conv is not None:
+                    self._chars -= conv.size
+                conv = _Conversation(self.max_turns, turns, summary)
+                self._conversations[user_id] = conv
+                self._chars += conv.size
+        if conv is None:
+            conv = _Conversation(self.max_turns)
+            self._conversations[user_id] = conv
+        conv.used_at = now
+        self._conversations.move_to_end(user_id)
+        return conv
+
+    # ----------------- Публичный интерфейс -----------------
+    def append(self, user_id: int, role: str, content: str):
+        """Добавление реплики (запись на диск - в фоне)"""
+        with self._lock:
+            conv = self._load(user_id)
+            self._chars -= conv.size
+            conv.push(role == "assistant", content)
+            self._chars += conv.size
+            conv.synced_at = time.monotonic()
+            self._evict()
+            self._enqueue(("append", user_id, role, content, time.time(), conv.last))
+
+    def get(self, user_id: int) -> list:
+        """Реплики пользователя в формате сообщений для модели"""
+        with self._lock:
+            if self.backend is None and user_id not in self._conversations:
+                return []
+            conv = self._load(user_id)
+            self._evict()
+            return [{"role": "assistant" if is_bot else "user", "content": content}
+                    for is_bot, content, _ in conv.turns]
+
+    def idle_before_last(self, user_id: int):
+        """Секунды между последней репликой и предыдущей (None, если предыдущей нет)"""
+        with self._lock:
+            if self.backend is None and user_id not in self._conversations:
+                return None
+            turns = self._load(user_id).turns
+            if len(turns) < 2:
+                return None
+            return turns[-1][2] - turns[-2][2]
+
+    def get_window(self, user_id: int) -> tuple:
+        """(номер первой реплики, реплики) - как get(), но с нумерацией"""
+        with self._lock:
+            if self.backend is None and user_id not in self._conversations:
+                return 0, []
+            conv = self._load(user_id)
+            self._evict()
+            return conv.first, [{"role": "assistant" if is_bot else "user", "content": content}
+                                for is_bot, content, _ in conv.turns]
+
+    def get_summary(self, user_id: int):
+        """Резюме старой части диалога: (summary, номер последней свёрнутой реплики) или None"""
+        with self._lock:
+            if self.backend is None and user_id not in self._conversations:
+                return None
+            return self._load(user_id).summary
+
+    def set_summary(self, user_id: int, summary: str, marker: int):
+        """Сохранение резюме; marker - номер последней реплики, вошедшей в него"""
+        with self._lock:
+            conv = self._load(user_id)
+            conv.summary = (summary, marker)
+            conv.synced_at = time.monotonic()
+            self._enqueue(("summary", user_id, summary, str(marker), time.time()))
+
+    def clear(self, user_id: int):
+        """Очистка контекста пользователя"""
+        with self._lock:
+            conv = self._conversations.pop(user_id, None)
+            if conv is not None:
+                self._chars -= conv.size
+            self._enqueue(("clear", user_id))
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def total_users(self) -> int:
+        """Число пользователей с сохранённым контекстом (по всем воркерам)"""
+        if self.backend is None:
+            return len(self._conversations)
+        try:
+            return self.backend.count_users()
+        except Exception as e:
+            logging.error(f"Ошибка подсчёта пользователей: {e}")
+            return len(self._conversations)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._conversations),
+            "chars": self._chars,
+            "evicted": self.evicted,
+            "pending_writes": self._writes.qsize(),
+            "dropped_writes": self.dropped_writes,
+        }
+
+    # ----------------- Фоновая запись -----------------
+    def _enqueue(self, op):
+        """Постановка операции в очередь записи (вызывается под блокировкой)"""
+        if self.backend is None:
+            return
+        try:
+            self._writes.put_nowait(op)
+            self._pending[op[1]] += 1
+        except queue.Full:
+            self.dropped_writes += 1
+            logging.error("Очередь записи контекстов переполнена, реплика не сохранена на диск")
+
+    def _write_loop(self):
+        last_cleanup = time.monotonic()
+        while True:
+            op = self._writes.get()
+            if op is None:
+                return
+            time.sleep(self.flush_interval)  # копим пакет
+            ops = [op]
+            stop = False
+            while True:
+                try:
+                    op = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    stop = True
+                    break
+                ops.append(op)
+            try:
+                self.backend.write_batch(ops)
+            except Exception as e:
+                logging.error(f"Ошибка записи контекстов ({len(ops)} операций): {e}")
+            with self._lock:
+                for op in ops:
+                    self._pending[op[1]] -= 1
+                    if self._pending[op[1]] <= 0:
+                        del self._pending[op[1]]
+            if time.monotonic() - last_cleanup > 3600:
+                last_cleanup = time.monotonic()
+                try:
+                    self.backend.cleanup()
+                except Exception as e:
+                    logging.error(f"Ошибка очистки старых контекстов: {e}")
+            if stop:
+                return
+
+    def close(self):
+        """Запись оставшихся операций и остановка фонового потока"""
+        if self._writer is None:
+            return
+        self._writes.put(None)
+        self._writer.join(timeout=10)
+        self._writer = None
+        self.backend.close()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Дедупликация базы знаний: проверка перед записью и сжатие всей коллекции.
+
+Запуск из консоли:
+    python dedup.py --threshold 0.95 --dry-run
+    python dedup.py --mode merge
+
+Удалённые id записываются в payload "replaces" оставшейся записи с новым
+created_at: при инкрементальной синхронизации их убирают из локальных
+индексов все воркеры.
+"""
+import argparse
+import logging
+import os
+import re
+import time
+
+import numpy as np
+from qdrant_client.models import Filter, IsEmptyCondition, PayloadField, PointIdsList, PointStruct
+
+import ingest
+from embedding_cache import normalize_text
+
+SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def merge_texts(old: str, new: str) -> str:
+    """Слияние двух формулировок: к новой добавляются предложения старой, которых в ней нет"""
+    sentences = [s for s in SENTENCE_RE.split(new.strip()) if s]
+    seen = {normalize_text(s) for s in sentences}
+    for sentence in SENTENCE_RE.split(old.strip()):
+        if sentence and normalize_text(sentence) not in seen:
+            sentences.append(sentence)
+            seen.add(normalize_text(sentence))
+    return " ".join(sentences)
+
+
+def find_duplicate(qdrant, collection: str, vector, threshold: float, search_params=None):
+    """Самая близкая запись, добавленная вручную (не чанк документа), или None"""
+    points = qdrant.query_points(
+        collection_name=collection,
+        query=vector,
+        limit=1,
+        score_threshold=threshold,
+        query_filter=Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="doc"))]),
+        with_payload=True,
+        search_params=search_params
+    ).points
+    return points[0] if points else None
+
+
+def doc_key(payload) -> int:
+    """Хэш поля doc (0 - запись добавлена вручную, не чанк документа)"""
+    doc = (payload or {}).get("doc")
+    return 0 if doc is None else (hash(doc) or 1)
+
+
+def load_points(qdrant, collection: str, page_size: int = 1000) -> tuple:
+    """Векторы всей коллекции: (ids, матрица float32 с нормированными строками, created_at, doc_key).
+
+    Матрица выделяется заранее по числу точек и заполняется постранично;
+    payload целиком не хранится - только created_at и хэш doc.
+    """
+    capacity = qdrant.count(collection_name=collection, exact=True).count
+    ids = []
+    matrix = None
+    created = np.zeros(capacity)
+    docs = np.zeros(capacity, dtype=np.int64)
+    offset = None
+    while True:
+        page, offset = qdrant.scroll(
+            collection_name=collection,
+            limit=page_size,
+            offset=offset,
+            with_payload=["created_at", "doc"],
+            with_vectors=True
+        )
+        for point in page:
+            n = len(ids)
+            if n == len(created):
+                # Точки добавили во время чтения - массивы растут
+                extra = max(n, page_size)
+                created = np.concatenate([created, np.zeros(extra)])
+                docs = np.concatenate([docs, np.zeros(extra, dtype=np.int64)])
+                if matrix is not None:
+                    matrix = np.concatenate([matrix, np.empty((extra, matrix.shape[1]), dtype=np.float32)])
+            if matrix is None:
+                matrix = np.empty((len(created), len(point.vector)), dtype=np.float32)
+            matrix[n] = point.vector
+            created[n] = (point.payload or {}).get("created_at", 0.0)
+            docs[n] = doc_key(point.payload)
+            ids.append(point.id)
+        if offset is None:
+            break
+    n = len(ids)
+    if matrix is None:
+        return ids, np.zeros((0, 0), dtype=np.float32), created[:0], docs[:0]
+    matrix = matrix[:n]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return ids, matrix, created[:n], docs[:n]
+
+
+def find_clusters(matrix, created, docs, threshold: float, block: int = 512) -> list:
+    """Группы почти одинаковых точек (списки индексов, первой идёт самая новая).
+
+    Жадная кластеризация: самая новая необработанная точка забирает все
+    необработанные с косинусной близостью не ниже threshold. Чанки одного
+    документа (одинаковый doc_key) не считаются дубликатами друг друга.
+    Строки matrix должны быть нормированы (см. load_points).
+    """
+    if not len(matrix):
+        return []
+    order = np.argsort(-np.asarray(created), kind="stable")
+    assigned = np.zeros(len(matrix), dtype=bool)
+    clusters = []
+    for start in range(0, len(order), block):
+        rows = order[start:start + block]
+        scores = matrix[rows] @ matrix.T
+        for row, i in enumerate(rows):
+            if assigned[i]:
+                continue
+            mask = (scores[row] >= threshold) & ~assigned
+            if docs[i]:
+                mask &= docs != docs[i]
+            mask[i] = True
+            members = [int(j) for j in np.flatnonzero(mask)]
+            assigned[members] = True
+            if len(members) > 1:
+                members.sort(key=lambda j: j != i)
+                clusters.append(members)
+    return clusters
+
+
+def fetch_points(qdrant, collection: str, point_ids: list, with_vectors: bool = True) -> list:
+    """Точки по id в том же порядке (удалённые за это время пропускаются)"""
+    found = {point.id: point for point in qdrant.retrieve(
+        collection_name=collection, ids=point_ids, with_payload=True, with_vectors=with_vectors
+    )}
+    return [found[point_id] for point_id in point_ids if point_id in found]
+
+
+def compact(qdrant, collection: str, threshold: float = 0.95, mode: str = "replace", embed=None,
+            dry_run: bool = False, on_points=None, on_removed=None) -> dict:
+    """Схлопывание групп почти одинаковых записей всей коллекции.
+
+    replace - остаётся самая новая запись группы; merge - записи сливаются
+    в одну (нужен embed(text) -> вектор). Группа, для которой эмбеддинг
+    получить не удалось, пропускается целиком. on_points(points) и
+    on_removed(ids) вызываются после изменений в Qdrant.
+    """
+    started = time.time()
+    ids, matrix, created, docs = load_points(qdrant, collection)
+    clusters = find_clusters(matrix, created, docs, threshold)
+    del matrix  # дальше нужны только id групп; payload и векторы дочитываются по группам
+    stats = {"points": len(ids), "clusters": len(clusters), "removed": 0, "merged": 0, "skipped": 0,
+             "examples": [[(point.payload or {}).get("text", "")[:80]
+                           for point in fetch_points(qdrant, collection, [ids[j] for j in cluster[:3]], False)]
+                          for cluster in clusters[:5]]}
+    if dry_run:
+        stats["removed"] = sum(len(cluster) - 1 for cluster in clusters)
+        stats["elapsed"] = time.time() - started
+        return stats
+
+    for cluster in clusters:
+        cluster_ids = [ids[j] for j in cluster]
+        points = fetch_points(qdrant, collection, cluster_ids)
+        if len(points) < 2 or points[0].id != cluster_ids[0]:
+            continue  # группу изменили, пока шло сравнение
+        survivor = points[0]
+        payload = dict(survivor.payload or {})
+        vector = survivor.vector
+        point_id = survivor.id
+        if mode == "merge":
+            text = payload.get("text", "")
+            for other in points[1:]:
+                text = merge_texts((other.payload or {}).get("text", ""), text)
+            if text != payload.get("text"):
+                try:
+                    vector = embed(text)
+                except Exception as e:
+                    logging.error(f"Ошибка эмбеддинга слитой записи: {e}")
+                    vector = None
+                if vector is None:
+                    # Без вектора запись не сохранить - группа остаётся как есть до следующего запуска
+                    stats["skipped"] += 1
+                    continue
+                point_id = ingest.content_point_id(text)
+                payload.update(text=text, id=point_id)
+                payload.pop("doc", None)
+                payload.pop("chunk", None)
+                stats["merged"] += 1
+        removed = [point.id for point in points if point.id != point_id]
+        payload["replaces"] = [str(old_id) for old_id in removed]
+        payload["created_at"] = time.time()
+        point = PointStruct(id=point_id, vector=vector, payload=payload)
+        ingest.upsert_points(qdrant, collection, [point])
+        qdrant.delete(collection_name=collection, points_selector=PointIdsList(points=removed), wait=True)
+        stats["removed"] += len(removed)
+        if on_removed:
+            on_removed(removed)
+        if on_points:
+            on_points([point])
+
+    stats["elapsed"] = time.time() - started
+    return stats
+
+
+def format_stats(stats: dict) -> str:
+    """Строка итога для логов и сообщений"""
+    text = (
+        f"точек {stats['points']}, групп дубликатов {stats['clusters']}, "
+        f"удалено {stats['removed']}"
+    )
+    if stats["merged"]:
+        text += f", слито {stats['merged']}"
+    if stats.get("skipped"):
+        text += f", пропущено групп {stats['skipped']}"
+    return text
+
+
+# ----------------- Запуск из консоли -----------------
+def main():
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Сжатие почти одинаковых записей базы знаний")
+    parser.add_argument("--collection", default=ingest.DEFAULT_COLLECTION)
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("KNOWLEDGE_DUPLICATE_THRESHOLD", 0.95)))
+    parser.add_argument("--mode", default="replace", choices=["replace", "merge"])
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", ingest.DEFAULT_MODEL))
+    parser.add_argument("--dry-run", action="store_true", help="только показать найденные группы")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qdrant = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=60)
+    embed = None
+    if args.mode == "merge":
+        from openai import OpenAI
+        openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        size = qdrant.get_collection(args.collection).config.params.vectors.size
+        embed = lambda text: ingest.embed_texts(openai_client, [text], args.model, dimensions=size)[0]
+
+    stats = compact(qdrant, args.collection, args.threshold, args.mode, embed, dry_run=args.dry_run)
+    for example in stats["examples"]:
+        logging.info("Группа: " + " | ".join(example))
+    logging.info(f"{'Найдено' if args.dry_run else '✅ Готово'}: {format_stats(stats)} за {stats['elapsed']:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
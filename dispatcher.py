@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Пул воркеров с ограниченной очередью и последовательной обработкой внутри чата"""
+import logging
+import threading
+import time
+from collections import deque
+
+
+class ChatDispatcher:
+    """Фиксированный пул потоков для обработки обновлений.
+
+    Задачи с одинаковым ключом (chat_id) выполняются строго по очереди,
+    задачи разных чатов - параллельно. Общее число ожидающих задач
+    ограничено max_queue: при переполнении submit() возвращает False.
+    """
+
+    def __init__(self, workers: int = 8, max_queue: int = 200, name: str = "dispatcher"):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pending = {}      # key -> deque задач
+        self._ready = deque()   # ключи, готовые к обработке (не выполняются сейчас)
+        self._cond = threading.Condition()
+        self._queued = 0
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started = time.monotonic()
+        self._running = True
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, *args) -> bool:
+        """Поставить задачу в очередь; False, если очередь заполнена"""
+        with self._cond:
+            if not self._running or self._queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            jobs = self._pending.get(key)
+            if jobs is None:
+                # Чат ещё не в работе - он сразу готов к обработке
+                jobs = self._pending[key] = deque()
+                self._ready.append(key)
+            jobs.append((fn, args))
+            self._queued += 1
+            self._cond.notify()
+            return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running and not self._ready:
+                    return
+                key = self._ready.popleft()
+                fn, args = self._pending[key].popleft()
+                self._queued -= 1
+                self._busy += 1
+
+            started = time.monotonic()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка в задаче диспетчера: {e}")
+            finally:
+                elapsed = time.monotonic() - started
+                with self._cond:
+                    self._busy -= 1
+                    self._busy_time += elapsed
+                    self.processed += 1
+                    if self._pending[key]:
+                        # Следующее сообщение этого чата - в конец очереди готовых
+                        self._ready.append(key)
+                        self._cond.notify()
+                    else:
+                        del self._pending[key]
+
+    def stop(self, timeout: float = 10):
+        """Остановка после обработки уже принятых задач"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        """Глубина очереди и загрузка воркеров"""
+        with self._cond:
+            uptime = max(time.monotonic() - self._started, 1e-6)
+            return {
+                "workers": self.workers,
+                "busy": self._busy,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "chats": len(self._pending),
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "utilization": self._busy_time / (uptime * self.workers),
+            }
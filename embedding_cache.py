@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Двухуровневый кэш эмбеддингов: LRU в памяти + SQLite на диске"""
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста для ключа кэша"""
+    return " ".join(text.split()).lower()
+
+
+def make_key(text: str, model: str) -> str:
+    """Ключ кэша по нормализованному тексту и имени модели"""
+    raw = f"{model}\x00{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+class EmbeddingCache:
+    """LRU-кэш эмбеддингов с TTL и постоянным хранилищем в SQLite.
+
+    Векторы на диске хранятся как float32, поэтому кэш переживает
+    перезапуски и общий для всех воркеров на одной машине. Устаревшие
+    записи удаляются с диска при открытии и каждые prune_every записей,
+    там же база урезается до disk_max_items самых новых.
+    """
+
+    def __init__(self, path: str = None, max_items: int = 10000, ttl: float = 86400,
+                 disk_ttl: float = 30 * 86400, disk_max_items: int = 500000, prune_every: int = 1000):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.disk_ttl = disk_ttl
+        self.disk_max_items = disk_max_items
+        self.prune_every = prune_every
+        self._puts = 0
+        self._memory = OrderedDict()  # key -> (created_at, vector)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT, vector BLOB, created_at REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created_at)")
+                self._db.commit()
+            except Exception as e:
+                logging.error(f"Не удалось открыть кэш эмбеддингов {path}: {e}")
+                self._db = None
+            self.prune()
+
+    # ----------------- Память -----------------
+    def _memory_get(self, key: str):
+        with self._lock:
+            item = self._memory.get(key)
+            if item is None:
+                return None
+            created_at, vector = item
+            if time.time() - created_at > self.ttl:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return vector
+
+    def _memory_put(self, key: str, vector: list, created_at: float = None):
+        with self._lock:
+            self._memory[key] = (created_at or time.time(), vector)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    # ----------------- Диск -----------------
+    def _disk_get(self, key: str):
+        if self._db is None:
+            return None
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+        except Exception as e:
+            logging.error(f"Ошибка чтения кэша эмбеддингов: {e}")
+            return None
+        if row is None:
+            return None
+        blob, created_at = row
+        if time.time() - created_at > self.disk_ttl:
+            return None
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def _disk_put(self, key: str, model: str, vector: list):
+        if self._db is None:
+            return
+        try:
+            blob = array("f", vector).tobytes()
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, model, blob, time.time())
+                )
+                self._db.commit()
+                self._puts += 1
+                due = self._puts % self.prune_every == 0
+        except Exception as e:
+            logging.error(f"Ошибка записи в кэш эмбеддингов: {e}")
+            return
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """Удаление с диска записей старше disk_ttl и самых старых сверх disk_max_items"""
+        if self._db is None:
+            return 0
+        try:
+            with self._db_lock:
+                removed = self._db.execute(
+                    "DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.disk_ttl,)
+                ).rowcount
+                if self.disk_max_items:
+                    removed += self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                        "ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.disk_max_items,)
+                    ).rowcount
+                self._db.commit()
+        except Exception as e:
+            logging.error(f"Ошибка очистки кэша эмбеддингов: {e}")
+            return 0
+        if removed:
+            logging.info(f"Из кэша эмбеддингов удалено {removed} устаревших записей")
+        return removed
+
+    # ----------------- Публичный интерфейс -----------------
+    def get(self, text: str, model: str):
+        """Вектор из кэша или None"""
+        key = make_key(text, model)
+        vector = self._memory_get(key)
+        if vector is not None:
+            with self._lock:
+                self.hits_memory += 1
+            return vector
+
+        vector = self._disk_get(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.hits_disk += 1
+        self._memory_put(key, vector)
+        return vector
+
+    def put(self, text: str, model: str, vector: list):
+        """Сохранение вектора в оба уровня кэша"""
+        key = make_key(text, model)
+        self._memory_put(key, vector)
+        self._disk_put(key, model, vector)
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            size, hits_memory, hits_disk, misses = len(self._memory), self.hits_memory, self.hits_disk, self.misses
+        total = hits_memory + hits_disk + misses
+        return {
+            "size": size,
+            "hits_memory": hits_memory,
+            "hits_disk": hits_disk,
+            "misses": misses,
+            "hit_rate": (hits_memory + hits_disk) / total if total else 0.0,
+        }
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Настройки gunicorn: приложение загружается один раз в мастере, воркеры стартуют форком.
+
+Запуск:
+    gunicorn wsgi:app
+
+Воркер по умолчанию один. Порядок обработки внутри чата (ChatDispatcher),
+склейка сообщений (MessageCoalescer), лимиты на пользователя и темп
+отправки в чат (TelegramOutbox), кэш ответов живут в памяти процесса:
+с несколькими воркерами обновления одного чата попадают в разные процессы,
+порядок и склейка ломаются, а лимиты на чат и пользователя умножаются
+(делятся на WEB_CONCURRENCY только общие лимиты). Нагрузку наращивают
+потоками (WORKER_THREADS в bot.py, GUNICORN_THREADS здесь).
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "1"))  # больше одного - см. выше
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+preload_app = True  # импорт bot.py (numpy, qdrant_client, openai) - один раз на деплой
+
+
+def post_fork(server, worker):
+    """Потоки, SQLite и клиенты создаются только в воркере, после fork"""
+    import bot
+    bot.start_runtime()
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""Массовая загрузка знаний в Qdrant: нарезка на чанки, пакетные эмбеддинги и upsert.
+
+Запуск из консоли:
+    python ingest.py faq.jsonl docs.txt --source faq
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from qdrant_client.models import (
+    PointStruct, Distance, VectorParams, ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    BinaryQuantization, BinaryQuantizationConfig
+)
+
+from embedding_cache import normalize_text
+
+DEFAULT_COLLECTION = "knowledge_base"
+DEFAULT_MODEL = "text-embedding-3-small"
+POINT_NAMESPACE = uuid.UUID("6f1c6a52-3f4e-4b7a-9a51-2f3d0c6b8e11")
+
+
+# ----------------- Чтение и нарезка -----------------
+def chunk_text(text: str, size: int = 1000, overlap: int = 200):
+    """Нарезка текста на перекрывающиеся чанки по границам слов"""
+    text = " ".join(text.split())
+    if len(text) <= size:
+        return [text] if text else []
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Стараемся резать по концу предложения, иначе по пробелу
+            cut = max(text.rfind(". ", start, end), text.rfind("! ", start, end), text.rfind("? ", start, end))
+            if cut <= start + size // 2:
+                cut = text.rfind(" ", start, end)
+            if cut > start + size // 2:
+                end = cut + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Не начинаем чанк с середины слова
+        space = text.find(" ", start, end)
+        if 0 <= space < end - 1:
+            start = space + 1
+    return [c for c in chunks if c]
+
+
+def read_records(path: str, source: str = None):
+    """Чтение записей из JSONL ({"text": ..., "source": ...}) или текстового файла"""
+    name = os.path.basename(path)
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logging.error(f"{name}:{line_no}: некорректный JSON, строка пропущена")
+                    continue
+                text = item.get("text") if isinstance(item, dict) else None
+                if text:
+                    yield {"text": text, "source": item.get("source") or source or name, "doc": f"{name}:{line_no}"}
+    else:
+        # Абзацы, разделённые пустыми строками, считаем отдельными записями;
+        # файл читается блоками, в памяти - только незаконченный абзац
+        i = 0
+        tail = ""
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                paragraphs = (tail + block).split("\n\n")
+                tail = paragraphs.pop()
+                for paragraph in paragraphs:
+                    i += 1
+                    if paragraph.strip():
+                        yield {"text": paragraph, "source": source or name, "doc": f"{name}#{i}"}
+        if tail.strip():
+            yield {"text": tail, "source": source or name, "doc": f"{name}#{i + 1}"}
+
+
+def iter_chunks(records, size: int = 1000, overlap: int = 200):
+    """Поток чанков с метаданными"""
+    for record in records:
+        for i, chunk in enumerate(chunk_text(record["text"], size, overlap)):
+            yield {"text": chunk, "source": record["source"], "doc": record["doc"], "chunk": i}
+
+
+def chunk_point_id(chunk: dict) -> str:
+    """Детерминированный id точки: повторная загрузка перезаписывает те же точки"""
+    digest = hashlib.sha1(f"{chunk['doc']}\x00{chunk['chunk']}\x00{chunk['text']}".encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(POINT_NAMESPACE, digest))
+
+
+def content_point_id(text: str) -> str:
+    """id точки по содержимому: повторное «запомни» того же текста - та же точка"""
+    digest = hashlib.sha1(f"text\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(POINT_NAMESPACE, digest))
+
+
+def batched(items, size: int):
+    """Группировка потока в пакеты"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ----------------- Эмбеддинги и upsert -----------------
+def embedding_params(model: str, dimensions: int = None) -> dict:
+    """Дополнительные параметры запроса эмбеддингов: размер задаётся только моделям text-embedding-3"""
+    if dimensions and model.startswith("text-embedding-3"):
+        return {"dimensions": dimensions}
+    return {}
+
+
+def embed_texts(openai_client, texts: list, model: str = DEFAULT_MODEL, retries: int = 5,
+                dimensions: int = None):
+    """Эмбеддинги для пакета текстов одним запросом"""
+    delay = 1.0
+    for attempt in range(retries):
+        try:
+            response = openai_client.embeddings.create(model=model, input=texts, **embedding_params(model, dimensions))
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            logging.warning(f"Ошибка пакетного эмбеддинга ({e}), повтор через {delay:.0f} с")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def upsert_points(qdrant, collection: str, points: list, retries: int = 5):
+    """Upsert пакета точек с повторами"""
+    delay = 1.0
+    for attempt in range(retries):
+        try:
+            qdrant.upsert(collection_name=collection, points=points, wait=True)
+            return
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            logging.warning(f"Ошибка upsert ({e}), повтор через {delay:.0f} с")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def quantization_config(kind: str = None):
+    """Квантование векторов в Qdrant: none | scalar (int8, в 4 раза меньше) | binary (в 32 раза меньше).
+
+    Квантованные векторы держатся в памяти, исходные - на диске
+    и используются только для пересчёта лучших кандидатов (rescore).
+    """
+    if kind == "scalar":
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+    if kind == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    if kind not in (None, "", "none"):
+        raise ValueError(f"Неизвестный тип квантования: {kind}")
+    return None
+
+
+def collection_exists(qdrant, collection: str) -> bool:
+    """Есть ли коллекция или алиас с таким именем"""
+    if collection in [col.name for col in qdrant.get_collections().collections]:
+        return True
+    return collection in [alias.alias_name for alias in qdrant.get_aliases().aliases]
+
+
+def create_collection(qdrant, collection: str, size: int, quantization: str = None):
+    """Создание коллекции с косинусной метрикой и, при необходимости, квантованием"""
+    quantization = quantization_config(quantization)
+    qdrant.create_collection(
+        collection_name=collection,
+        vectors_config=VectorParams(size=size, distance=Distance.COSINE, on_disk=quantization is not None),
+        quantization_config=quantization
+    )
+    logging.info(f"Создана коллекция: {collection} (размер вектора {size})")
+
+
+def migration_marker(collection: str) -> str:
+    """Алиас-метка: пока он есть, migrate.py переключает имя collection с коллекции на алиас"""
+    return f"{collection}__migrating"
+
+
+def ensure_collection(qdrant, collection: str, size: int, quantization: str = None) -> bool:
+    """Создание коллекции, если её нет; True, если коллекция создана.
+
+    Во время первой миграции имя на миг свободно (коллекция удалена, алиас
+    ещё не создан) - по метке migration_marker коллекция не пересоздаётся.
+    """
+    if collection_exists(qdrant, collection):
+        return False
+    if migration_marker(collection) in [alias.alias_name for alias in qdrant.get_aliases().aliases]:
+        logging.info(f"{collection} переключается на алиас, коллекция не создаётся")
+        return False
+    create_collection(qdrant, collection, size, quantization)
+    return True
+
+
+# ----------------- Состояние для возобновления -----------------
+def file_fingerprint(path: str) -> str:
+    """Путь и хэш содержимого файла: состояние загрузки относится только к нему"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return f"{os.path.abspath(path)}:{digest.hexdigest()[:16]}"
+
+
+class IngestState:
+    """Номера завершённых пакетов; позволяет продолжить прерванную загрузку"""
+
+    def __init__(self, path: str = None, fingerprint: str = ""):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.done = set()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("fingerprint") == fingerprint:
+                    self.done = set(data.get("done", []))
+                else:
+                    logging.info("Параметры загрузки изменились, начинаем заново")
+            except Exception as e:
+                logging.error(f"Не удалось прочитать состояние загрузки {path}: {e}")
+
+    def mark(self, batch_no: int):
+        self.done.add(batch_no)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.fingerprint, "done": sorted(self.done)}, f)
+        os.replace(tmp, self.path)
+
+
+def ingest(records, openai_client, qdrant, collection: str = DEFAULT_COLLECTION,
+           model: str = DEFAULT_MODEL, chunk_size: int = 1000, overlap: int = 200,
+           batch_size: int = 128, concurrency: int = 4, state_path: str = None,
+           progress=None, on_points=None, dimensions: int = None, quantization: str = None,
+           input_id: str = ""):
+    """Загрузка записей в коллекцию.
+
+    Каждый пакет из batch_size чанков - один запрос эмбеддингов и один upsert.
+    Одновременно выполняется не больше concurrency пакетов. progress(stats)
+    вызывается после каждого пакета, on_points(points) - после успешного upsert.
+    dimensions - размер эмбеддингов (text-embedding-3), quantization - для новой коллекции.
+    input_id - что загружается (file_fingerprint): состояние другого входа не подхватывается.
+    """
+    fingerprint = f"{input_id}:{collection}:{model}:{dimensions or ''}:{chunk_size}:{overlap}:{batch_size}"
+    state = IngestState(state_path, fingerprint)
+    stats = {"chunks": 0, "skipped": 0, "batches": 0, "failed": 0, "started": time.time()}
+    collection_ready = [False]
+    collection_lock = threading.Lock()
+
+    def process(batch_no: int, batch: list):
+        vectors = embed_texts(openai_client, [c["text"] for c in batch], model, dimensions=dimensions)
+        with collection_lock:
+            if not collection_ready[0]:
+                ensure_collection(qdrant, collection, len(vectors[0]), quantization)
+                collection_ready[0] = True
+        points = []
+        for chunk, vector in zip(batch, vectors):
+            point_id = chunk_point_id(chunk)
+            points.append(PointStruct(
+                id=point_id,
+                vector=vector,
+                payload={
+                    "text": chunk["text"],
+                    "source": chunk["source"],
+                    "doc": chunk["doc"],
+                    "chunk": chunk["chunk"],
+                    "id": point_id,
+                    "created_at": time.time()
+                }
+            ))
+        upsert_points(qdrant, collection, points)
+        if on_points:
+            on_points(points)
+        return batch_no, len(batch)
+
+    in_flight = set()
+    last_save = time.time()
+
+    def collect(done_futures):
+        nonlocal last_save
+        for future in done_futures:
+            in_flight.discard(future)
+            try:
+                batch_no, count = future.result()
+                state.mark(batch_no)
+                stats["chunks"] += count
+                stats["batches"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"Пакет не загружен: {e}")
+        if time.time() - last_save > 5:
+            state.save()
+            last_save = time.time()
+        if progress:
+            progress(dict(stats))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch_no, batch in enumerate(batched(iter_chunks(records, chunk_size, overlap), batch_size)):
+            if batch_no in state.done:
+                stats["skipped"] += len(batch)
+                continue
+            # Ограничиваем число пакетов в полёте, чтобы не держать весь файл в памяти
+            while len(in_flight) >= concurrency * 2:
+                done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done_futures)
+            in_flight.add(pool.submit(process, batch_no, batch))
+        while in_flight:
+            done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done_futures)
+
+    state.save()
+    if state_path and not stats["failed"] and os.path.exists(state_path):
+        os.remove(state_path)
+    stats["elapsed"] = time.time() - stats["started"]
+    return stats
+
+
+def format_progress(stats: dict) -> str:
+    """Строка прогресса для логов и сообщений"""
+    elapsed = max(time.time() - stats["started"], 1e-6)
+    rate = stats["chunks"] / elapsed
+    text = f"загружено {stats['chunks']} чанков ({rate:.0f}/с)"
+    if stats["skipped"]:
+        text += f", пропущено как уже загруженные: {stats['skipped']}"
+    if stats["failed"]:
+        text += f", ошибок пакетов: {stats['failed']}"
+    return text
+
+
+# ----------------- Запуск из консоли -----------------
+def main():
+    from openai import OpenAI
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Массовая загрузка знаний в Qdrant")
+    parser.add_argument("files", nargs="+", help="JSONL или текстовые файлы")
+    parser.add_argument("--source", help="значение поля source (по умолчанию имя файла)")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL))
+    parser.add_argument("--dimensions", type=int, default=int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None,
+                        help="размер эмбеддингов (для text-embedding-3; по умолчанию EMBEDDING_DIMENSIONS)")
+    parser.add_argument("--quantization", default=os.getenv("QDRANT_QUANTIZATION", "none"),
+                        choices=["none", "scalar", "binary"], help="квантование, если коллекция создаётся")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--overlap", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--state", help="файл состояния для возобновления (по умолчанию <файл>.ingest.json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    qdrant = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+
+    last_report = [0.0]
+
+    def progress(stats):
+        if time.time() - last_report[0] > 2:
+            last_report[0] = time.time()
+            logging.info(format_progress(stats))
+
+    for path in args.files:
+        logging.info(f"Загрузка {path}")
+        stats = ingest(
+            read_records(path, args.source), openai_client, qdrant,
+            collection=args.collection, model=args.model,
+            chunk_size=args.chunk_size, overlap=args.overlap,
+            batch_size=args.batch_size, concurrency=args.concurrency,
+            state_path=args.state or f"{path}.ingest.json",
+            progress=progress,
+            dimensions=args.dimensions,
+            quantization=args.quantization,
+            input_id=file_fingerprint(path)
+        )
+        logging.info(f"✅ {path}: {format_progress(stats)} за {stats['elapsed']:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
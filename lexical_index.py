@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Инвертированный индекс BM25 по текстам базы знаний (русский и английский)"""
+import math
+import re
+import threading
+import time
+from collections import Counter
+
+from qdrant_client.models import FieldCondition, Filter, Range
+
+from vector_mirror import Hit
+
+TOKEN_RE = re.compile(r"[0-9a-zа-я]+(?:[-_/][0-9a-zа-я]+)*")
+
+STOPWORDS = {
+    # русские
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она", "так",
+    "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее", "мне", "было",
+    "вот", "от", "меня", "еще", "нет", "о", "из", "ему", "теперь", "когда", "даже", "ну", "ли",
+    "если", "уже", "или", "ни", "быть", "был", "него", "до", "вас", "нибудь", "уж", "вам", "там",
+    "потом", "себя", "ей", "может", "они", "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя",
+    "их", "чем", "была", "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе", "под", "будет",
+    "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой", "ним", "здесь", "этом", "один",
+    "мой", "тем", "чтобы", "нее", "были", "куда", "зачем", "всех", "можно", "при", "об", "это", "эта",
+    # английские
+    "a", "an", "the", "and", "or", "but", "if", "of", "at", "by", "for", "with", "about", "to", "from",
+    "in", "on", "is", "are", "was", "were", "be", "been", "it", "its", "this", "that", "these", "those",
+    "i", "you", "he", "she", "we", "they", "me", "my", "your", "do", "does", "did", "what", "how",
+    "can", "will", "would", "should", "there", "here", "as", "so", "not", "no",
+}
+
+RU_ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ией", "иях", "ах", "ях",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ам", "ям",
+    "ов", "ев", "ью", "ия", "ие", "ии", "ть", "ти", "ет", "ут", "ют", "ит", "ат", "ят", "ешь", "ишь",
+    "ем", "им", "ете", "ите", "ла", "ло", "ли", "ал", "ил", "ся", "сь",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+EN_ENDINGS = ["ing", "ies", "ied", "ed", "es", "ly", "s"]
+
+
+def stem(token: str) -> str:
+    """Лёгкий стемминг: отрезание типичных окончаний"""
+    if any(ch.isdigit() for ch in token):
+        return token  # коды бронирований и номера - как есть
+    if "а" <= token[0] <= "я":
+        for _ in range(3):  # например «-ет» и «-ся» в «отменяется»
+            for ending in RU_ENDINGS:
+                if token.endswith(ending) and len(token) - len(ending) >= 3:
+                    token = token[:-len(ending)]
+                    break
+            else:
+                break
+        return token
+    for ending in EN_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= 3:
+            return token[:-len(ending)]
+    return token
+
+
+def tokenize(text: str) -> list:
+    """Токены для индекса: нижний регистр, ё -> е, без стоп-слов, со стеммингом"""
+    text = text.lower().replace("ё", "е")
+    return [stem(token) for token in TOKEN_RE.findall(text) if token not in STOPWORDS]
+
+
+def is_code(token: str) -> bool:
+    """Похоже на код или номер (буквы с цифрами, длина от 4)"""
+    return len(token) >= 4 and any(ch.isdigit() for ch in token)
+
+
+class LexicalIndex:
+    """BM25 с инкрементальным добавлением и удалением документов"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._postings = {}      # термин -> {номер документа: tf}
+        self._docs = {}          # номер документа -> (id точки, payload, длина)
+        self._by_id = {}         # id точки -> номер документа
+        self._next_doc = 0
+        self._total_len = 0
+        self.synced_at = 0.0
+
+    @property
+    def size(self) -> int:
+        return len(self._docs)
+
+    def add(self, point_id, payload: dict):
+        """Добавление или замена документа"""
+        terms = Counter(tokenize(payload.get("text", "")))
+        with self._lock:
+            # Записи, которые эта заменила (дедупликация), удаляются и в других воркерах
+            for old_id in payload.get("replaces", ()):
+                if old_id != point_id:
+                    self._remove(old_id)
+            self._remove(point_id)
+            doc = self._next_doc
+            self._next_doc += 1
+            length = sum(terms.values())
+            self._docs[doc] = (point_id, payload, length)
+            self._by_id[point_id] = doc
+            self._total_len += length
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[doc] = tf
+            self.synced_at = max(self.synced_at, payload.get("created_at", 0.0))
+
+    def add_points(self, points):
+        """Добавление точек Qdrant (PointStruct/Record)"""
+        for point in points:
+            if point.payload:
+                self.add(point.id, dict(point.payload))
+
+    def remove(self, point_ids):
+        """Удаление документов по id точек"""
+        with self._lock:
+            for point_id in point_ids:
+                self._remove(point_id)
+
+    def _remove(self, point_id):
+        doc = self._by_id.pop(point_id, None)
+        if doc is None:
+            return
+        _, payload, length = self._docs.pop(doc)
+        self._total_len -= length
+        for term in set(tokenize(payload.get("text", ""))):
+            postings = self._postings.get(term)
+            if postings:
+                postings.pop(doc, None)
+                if not postings:
+                    del self._postings[term]
+
+    def pull(self, qdrant, collection: str, page_size: int = 1000) -> int:
+        """Загрузка текстов из коллекции (инкрементально по created_at)"""
+        started = time.time()
+        scroll_filter = None
+        if self.synced_at:
+            scroll_filter = Filter(must=[FieldCondition(key="created_at", range=Range(gte=self.synced_at))])
+        pulled = 0
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
+                collection_name=collection,
+                scroll_filter=scroll_filter,
+                limit=page_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False
+            )
+            self.add_points(points)
+            pulled += len(points)
+            if offset is None:
+                break
+        self.synced_at = max(self.synced_at, started - 60)
+        return pulled
+
+    def search(self, query: str, limit: int = 5):
+        """Лучшие документы по BM25: (hits, доля веса запроса, покрытая первым документом, совпал ли код)"""
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._docs)
+            if not n or not terms:
+                return [], 0.0, False
+            avgdl = self._total_len / n
+            scores = Counter()
+            matched = {}
+            idf_total = 0.0
+            for term in terms:
+                postings = self._postings.get(term)
+                df = len(postings) if postings else 0
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                idf_total += idf
+                if not postings:
+                    continue
+                for doc, tf in postings.items():
+                    length = self._docs[doc][2]
+                    scores[doc] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avgdl))
+                    matched.setdefault(doc, []).append((term, idf))
+            top = scores.most_common(limit)
+            hits = [Hit(self._docs[doc][0], score, self._docs[doc][1]) for doc, score in top]
+            if not top:
+                return hits, 0.0, False
+            best = matched[top[0][0]]
+            coverage = sum(idf for _, idf in best) / idf_total if idf_total else 0.0
+            code_match = any(is_code(term) for term, _ in best)
+        return hits, coverage, code_match
+
+    @staticmethod
+    def confident(hits, coverage: float, code_match: bool, min_coverage: float = 0.8,
+                  min_gap: float = 1.5) -> bool:
+        """Уверенное лексическое совпадение: найден код или запрос покрыт и лидер заметно впереди"""
+        if not hits:
+            return False
+        if code_match:
+            return True
+        second = hits[1].score if len(hits) > 1 else 0.0
+        return coverage >= min_coverage and hits[0].score >= min_gap * second
+
+
+def rrf_fuse(result_lists, limit: int = 5, k: int = 60):
+    """Reciprocal rank fusion нескольких ранжированных списков"""
+    scores = Counter()
+    payloads = {}
+    for results in result_lists:
+        for rank, point in enumerate(results):
+            scores[point.id] += 1.0 / (k + rank + 1)
+            payloads.setdefault(point.id, point.payload)
+    return [Hit(point_id, score, payloads[point_id]) for point_id, score in scores.most_common(limit)]
@@ -0,0 +1,670 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест бота без внешних сервисов.
+
+Поднимает локальные заглушки Telegram Bot API, OpenAI (эмбеддинги) и
+OpenRouter (ответы модели) с настраиваемыми задержками и ошибками,
+Qdrant работает в режиме :memory:. Flask-приложение из bot.py
+запускается в этом же процессе, на его webhook с заданной частотой
+отправляются синтетические или записанные обновления.
+
+Пример:
+    python loadtest.py --rate 20 --duration 30 --chats 200
+    python loadtest.py --updates recorded.jsonl --rate 50 --compare loadtest_results/old.json
+
+Результат (пропускная способность, задержки, пики потоков и памяти,
+разбивка по этапам) сохраняется в JSON для сравнения между коммитами.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+
+EMBEDDING_DIM = 1536
+FAKE_TOKEN = "123456:loadtest"
+
+VOCABULARY = [
+    "бронирование", "оплата", "доставка", "возврат", "подписка", "аккаунт", "пароль", "тариф",
+    "скидка", "заказ", "курьер", "склад", "карта", "счёт", "договор", "поддержка", "менеджер",
+    "отмена", "перенос", "номер", "гостиница", "трансфер", "багаж", "билет", "рейс", "виза",
+    "страховка", "депозит", "комиссия", "лимит", "кэшбэк", "бонусы", "уведомление", "приложение",
+    "сайт", "офис", "график", "выходные", "праздники", "сотрудник", "документы", "паспорт",
+    "подтверждение", "квитанция", "чек", "налог", "адрес", "телефон", "почта", "срок", "часы",
+    "завтрак", "парковка", "животные", "дети", "питание", "экскурсия", "гид", "маршрут", "погода",
+]
+QUESTION_PREFIXES = ["Как", "Подскажи", "Что с", "Расскажи про", "Где", "Когда"]
+
+
+def percentiles(values) -> dict:
+    """p50/p95/p99/max/mean по сырым значениям (в миллисекундах)"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50": round(at(0.5), 1),
+        "p95": round(at(0.95), 1),
+        "p99": round(at(0.99), 1),
+        "max": round(ordered[-1] * 1000, 1),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 1),
+    }
+
+
+# ----------------- Заглушки внешних сервисов -----------------
+class FakeServices:
+    """Общее состояние заглушек: задержки, ошибки и журнал вызовов Telegram"""
+
+    def __init__(self, embed_latency: float, llm_latency: float, llm_first_token: float,
+                 telegram_latency: float, latency_sigma: float, embed_errors: float,
+                 llm_errors: float, telegram_errors: float, answer_tokens: int, seed: int):
+        self.embed_latency = embed_latency
+        self.llm_latency = llm_latency
+        self.llm_first_token = llm_first_token
+        self.telegram_latency = telegram_latency
+        self.latency_sigma = latency_sigma
+        self.embed_errors = embed_errors
+        self.llm_errors = llm_errors
+        self.telegram_errors = telegram_errors
+        self.answer_tokens = answer_tokens
+        self.errors_enabled = False  # включаются после наполнения базы
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._token_vectors = {}
+        self._next_message_id = 10_000_000
+        self.origin = {}    # message_id бота -> message_id вопроса
+        self.calls = []     # (время, метод, message_id вопроса или None)
+        self.counts = {"embeddings": 0, "embedding_inputs": 0, "llm": 0, "llm_stream": 0,
+                       "telegram": {}, "injected_errors": 0}
+
+    def delay(self, median: float) -> float:
+        """Задержка из логнормального распределения с заданной медианой"""
+        if median <= 0:
+            return 0.0
+        with self._lock:
+            return median * self._random.lognormvariate(0, self.latency_sigma)
+
+    def fail(self, rate: float) -> bool:
+        if not self.errors_enabled or rate <= 0:
+            return False
+        with self._lock:
+            failed = self._random.random() < rate
+            if failed:
+                self.counts["injected_errors"] += 1
+        return failed
+
+    def embedding(self, text: str) -> np.ndarray:
+        """Детерминированный эмбеддинг: сумма случайных векторов токенов (похожие тексты близки)"""
+        from lexical_index import tokenize
+
+        vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+        for token in tokenize(text) or [text]:
+            token_vector = self._token_vectors.get(token)
+            if token_vector is None:
+                seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:4], "little")
+                token_vector = np.random.RandomState(seed).standard_normal(EMBEDDING_DIM).astype(np.float32)
+                self._token_vectors[token] = token_vector
+            vector += token_vector
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def answer(self) -> list:
+        return [f"ответ{i} " for i in range(self.answer_tokens)]
+
+    def record_telegram(self, method: str, params: dict) -> int:
+        """Учёт вызова Telegram; возвращает message_id для ответа"""
+        origin = None
+        reply = params.get("reply_parameters")
+        if reply:
+            origin = json.loads(reply).get("message_id")
+        elif params.get("reply_to_message_id"):
+            origin = int(params["reply_to_message_id"])
+        now = time.perf_counter()
+        with self._lock:
+            self.counts["telegram"][method] = self.counts["telegram"].get(method, 0) + 1
+            if method == "sendMessage":
+                self._next_message_id += 1
+                message_id = self._next_message_id
+                if origin is not None:
+                    self.origin[message_id] = origin
+            else:
+                message_id = int(params.get("message_id", 0) or 0)
+                origin = self.origin.get(message_id)
+            self.calls.append((now, method, origin))
+        return message_id
+
+
+def make_handler(services: FakeServices):
+    """Один обработчик для всех заглушек: маршрутизация по пути запроса"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _json(self, status: int, data: dict):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path.endswith("/embeddings"):
+                self._embeddings(json.loads(body))
+            elif url.path.endswith("/chat/completions"):
+                self._completions(json.loads(body))
+            elif url.path.startswith("/bot"):
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if body and "json" in (self.headers.get("Content-Type") or ""):
+                    params.update(json.loads(body))
+                elif body and "form" in (self.headers.get("Content-Type") or ""):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                self._telegram(url.path.rsplit("/", 1)[-1], params)
+            else:
+                self._json(404, {"error": "not found"})
+
+        # OpenAI
+        def _embeddings(self, payload: dict):
+            inputs = payload["input"]
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            time.sleep(services.delay(services.embed_latency))
+            if services.fail(services.embed_errors):
+                self._json(500, {"error": {"message": "injected error", "type": "server_error"}})
+                return
+            data = []
+            for i, text in enumerate(inputs):
+                vector = services.embedding(text)
+                if payload.get("dimensions"):
+                    # Как у text-embedding-3: первые компоненты, заново нормированные
+                    vector = vector[:payload["dimensions"]]
+                    vector = vector / (np.linalg.norm(vector) or 1.0)
+                if payload.get("encoding_format") == "base64":
+                    embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode()
+                else:
+                    embedding = vector.tolist()
+                data.append({"object": "embedding", "index": i, "embedding": embedding})
+            with services._lock:
+                services.counts["embeddings"] += 1
+                services.counts["embedding_inputs"] += len(inputs)
+            self._json(200, {"object": "list", "data": data, "model": payload.get("model"),
+                             "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+        # OpenRouter
+        def _completions(self, payload: dict):
+            stream = payload.get("stream")
+            with services._lock:
+                services.counts["llm_stream" if stream else "llm"] += 1
+            total = services.delay(services.llm_latency)
+            if services.fail(services.llm_errors):
+                time.sleep(total / 2)
+                self._json(502, {"error": {"message": "injected error", "code": 502}})
+                return
+            tokens = services.answer()
+            if not stream:
+                time.sleep(total)
+                self._json(200, {"choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}]})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            first = min(total, services.delay(services.llm_first_token))
+            time.sleep(first)
+            step = (total - first) / max(1, len(tokens))
+            for token in tokens:
+                chunk = {"choices": [{"delta": {"content": token}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(step)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        # Telegram
+        def _telegram(self, method: str, params: dict):
+            time.sleep(services.delay(services.telegram_latency))
+            if method in ("sendMessage", "editMessageText") and services.fail(services.telegram_errors):
+                self._json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                 "parameters": {"retry_after": 1}})
+                return
+            if method == "getWebhookInfo":
+                self._json(200, {"ok": True, "result": {"url": "", "has_custom_certificate": False,
+                                                        "pending_update_count": 0}})
+                return
+            if method == "getMe":
+                self._json(200, {"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "Asuna",
+                                                        "username": "asuna_loadtest_bot"}})
+                return
+            message_id = services.record_telegram(method, params)
+            if method in ("sendMessage", "editMessageText"):
+                chat_id = int(params.get("chat_id", 0) or 0)
+                self._json(200, {"ok": True, "result": {
+                    "message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", "")}})
+            else:
+                self._json(200, {"ok": True, "result": True})
+
+    return Handler
+
+
+def start_server(server) -> threading.Thread:
+    thread = threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True)
+    thread.start()
+    return thread
+
+
+# ----------------- Нагрузка -----------------
+def synthetic_knowledge(count: int, rng: random.Random) -> list:
+    """Синтетические записи базы знаний с кодами вида AS00042"""
+    records = []
+    for i in range(count):
+        words = rng.sample(VOCABULARY, 12)
+        text = f"{' '.join(words).capitalize()}. Код {f'AS{i:05d}'}."
+        records.append({"text": text, "source": "loadtest", "doc": f"loadtest-{i}"})
+    return records
+
+
+def synthetic_questions(records: list, count: int, repeat_ratio: float, code_ratio: float,
+                        rng: random.Random) -> list:
+    """Вопросы к базе: по коду (лексический путь), пересказом и точные повторы (кэши)"""
+    questions = []
+    for _ in range(count):
+        if questions and rng.random() < repeat_ratio:
+            questions.append(rng.choice(questions))
+            continue
+        index = rng.randrange(len(records)) if records else 0
+        if records and rng.random() < code_ratio:
+            questions.append(f"Что известно про AS{index:05d}?")
+        elif records:
+            words = rng.sample(records[index]["text"].rstrip(".").split(". ")[0].lower().split(), 4)
+            questions.append(f"{rng.choice(QUESTION_PREFIXES)} {' '.join(words)} {rng.choice(VOCABULARY)}?")
+        else:
+            questions.append(f"{rng.choice(QUESTION_PREFIXES)} {' '.join(rng.sample(VOCABULARY, 4))}?")
+    return questions
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": user,
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            "date": int(time.time()),
+            "text": text,
+        },
+    }
+
+
+def recorded_updates(path: str, count: int, first_id: int) -> list:
+    """Записанные обновления (JSONL) с новыми update_id/message_id для сопоставления ответов"""
+    with open(path, encoding="utf-8") as f:
+        source = [json.loads(line) for line in f if line.strip()]
+    if not source:
+        raise ValueError(f"{path}: нет обновлений")
+    updates = []
+    for i in range(count):
+        update = json.loads(json.dumps(source[i % len(source)]))
+        update["update_id"] = first_id + i
+        message = update.get("message") or update.get("edited_message")
+        if message:
+            message["message_id"] = first_id + i
+            message["date"] = int(time.time())
+        updates.append(update)
+    return updates
+
+
+class ResourceSampler:
+    """Пики числа потоков и RSS процесса во время теста"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.threads_max = threading.active_count()
+        self.rss_max = self._rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="loadtest-sampler", daemon=True)
+
+    @staticmethod
+    def _rss() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.threads_max = max(self.threads_max, threading.active_count())
+            self.rss_max = max(self.rss_max, self._rss())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_load(webhook_url: str, updates: list, rate: float, clients: int, timeout: float):
+    """Отправка обновлений на webhook с постоянной частотой (открытая модель нагрузки)"""
+    sessions = threading.local()
+    sent = {}       # message_id -> время отправки
+    results = {"accepted": 0, "rejected": 0, "http_errors": 0, "webhook": [], "lag": 0.0}
+    lock = threading.Lock()
+
+    def post(update):
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        started = time.perf_counter()
+        message = update.get("message") or update.get("edited_message") or {}
+        with lock:
+            sent[message.get("message_id", update["update_id"])] = started
+        try:
+            response = session.post(webhook_url, json=update, timeout=timeout)
+        except requests.RequestException:
+            with lock:
+                results["http_errors"] += 1
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            results["webhook"].append(elapsed)
+            if response.status_code != 200:
+                results["http_errors"] += 1
+            elif response.content and response.json().get("method") == "sendMessage":
+                results["rejected"] += 1  # ответ «занято» прямо в теле webhook
+            else:
+                results["accepted"] += 1
+
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix="loadtest-client") as pool:
+        started = time.perf_counter()
+        for i, update in enumerate(updates):
+            due = started + i / rate
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                results["lag"] = max(results["lag"], -wait)
+            pool.submit(post, update)
+    return sent, results
+
+
+def wait_for_drain(dispatcher, timeout: float, coalescer=None) -> bool:
+    """Ожидание, пока воркеры обработают все принятые обновления"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = dispatcher.stats()
+        waiting = coalescer.stats()["pending"] if coalescer is not None else 0
+        if not stats["queued"] and not stats["busy"] and not waiting:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def stage_breakdown(metrics) -> dict:
+    """p50/p95/p99 по этапам из гистограмм бота (оценка по корзинам)"""
+    stages = {}
+    for name, histogram in sorted(metrics.stages.items()):
+        if histogram.count:
+            stages[name] = {
+                "count": histogram.count,
+                "p50": round(histogram.quantile(0.5) * 1000, 1),
+                "p95": round(histogram.quantile(0.95) * 1000, 1),
+                "p99": round(histogram.quantile(0.99) * 1000, 1),
+                "mean": round(histogram.sum / histogram.count * 1000, 1),
+                "errors": metrics.counters.get(("errors", name), 0),
+            }
+    return stages
+
+
+def compare(result: dict, baseline_path: str):
+    """Сравнение с предыдущим результатом: основные показатели и изменение в процентах"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = [
+        ("throughput", lambda r: r["throughput"]),
+        ("e2e p50, мс", lambda r: r["latency"]["end_to_end"].get("p50")),
+        ("e2e p99, мс", lambda r: r["latency"]["end_to_end"].get("p99")),
+        ("first p50, мс", lambda r: r["latency"]["first_response"].get("p50")),
+        ("threads max", lambda r: r["resources"]["threads_max"]),
+        ("rss max, МБ", lambda r: r["resources"]["rss_max_mb"]),
+    ]
+    print(f"Сравнение с {baseline_path} ({baseline.get('commit')} -> {result['commit']}):")
+    for name, get in rows:
+        try:
+            old, new = get(baseline), get(result)
+        except (KeyError, TypeError):
+            continue
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {name:<16} {old:>10} -> {new:<10} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--rate", type=float, default=10.0, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=20.0, help="секунд нагрузки")
+    parser.add_argument("--count", type=int, help="число обновлений (вместо rate * duration)")
+    parser.add_argument("--chats", type=int, default=100, help="разных пользователей")
+    parser.add_argument("--clients", type=int, default=32, help="параллельных HTTP-клиентов")
+    parser.add_argument("--updates", help="JSONL с записанными Update (по умолчанию - синтетические)")
+    parser.add_argument("--knowledge", type=int, default=500, help="синтетических записей в базе")
+    parser.add_argument("--knowledge-file", help="JSONL или текст для наполнения базы вместо синтетики")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="доля точных повторов вопросов")
+    parser.add_argument("--code-ratio", type=float, default=0.2, help="доля вопросов по коду записи")
+    parser.add_argument("--embed-latency", type=float, default=0.08, help="медиана, секунды")
+    parser.add_argument("--llm-latency", type=float, default=1.5, help="медиана полного ответа, секунды")
+    parser.add_argument("--llm-first-token", type=float, default=0.4, help="медиана первого токена, секунды")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="медиана, секунды")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="разброс логнормальных задержек")
+    parser.add_argument("--embed-errors", type=float, default=0.0, help="доля ошибок эмбеддингов")
+    parser.add_argument("--llm-errors", type=float, default=0.0, help="доля ошибок модели")
+    parser.add_argument("--telegram-errors", type=float, default=0.0, help="доля ответов 429 от Telegram")
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--qdrant", default=":memory:", help="QDRANT_URL (по умолчанию локальный режим)")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл результата (по умолчанию loadtest_results/<время>-<коммит>.json)")
+    parser.add_argument("--compare", help="предыдущий результат для сравнения")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    services = FakeServices(
+        embed_latency=args.embed_latency, llm_latency=args.llm_latency,
+        llm_first_token=args.llm_first_token, telegram_latency=args.telegram_latency,
+        latency_sigma=args.latency_sigma, embed_errors=args.embed_errors,
+        llm_errors=args.llm_errors, telegram_errors=args.telegram_errors,
+        answer_tokens=args.answer_tokens, seed=args.seed
+    )
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(services))
+    stub.daemon_threads = True
+    start_server(stub)
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+
+    # Окружение бота задаётся до импорта: все внешние вызовы идут в заглушки
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": FAKE_TOKEN,
+        "OPENAI_API_KEY": "loadtest",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "OPENROUTER_API_KEY": "loadtest",
+        "OPENROUTER_URL": f"{stub_url}/api/v1/chat/completions",
+        "QDRANT_URL": args.qdrant,
+        "ADMIN_USER_ID": os.getenv("ADMIN_USER_ID", "1"),
+    })
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(workdir, "embedding_cache.sqlite3"))
+    os.environ.setdefault("CONTEXT_DB_PATH", os.path.join(workdir, "contexts.sqlite3"))
+    os.environ.setdefault("LOCAL_INDEX_PATH", os.path.join(workdir, "knowledge_mirror"))
+    # Лимиты модели по умолчанию выключены: меряем конвейер, а не token bucket
+    os.environ.setdefault("LLM_USER_RATE", "0")
+    os.environ.setdefault("LLM_GLOBAL_RATE", "0")
+
+    import telebot
+    telebot.apihelper.API_URL = f"{stub_url}/bot{{0}}/{{1}}"
+
+    import bot
+    import ingest
+    from werkzeug.serving import make_server
+
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    app = bot.create_app()
+    bot.init_collections()
+    bot.start_runtime()
+
+    # Наполнение базы
+    if args.knowledge_file:
+        records = list(ingest.read_records(args.knowledge_file))
+    else:
+        records = synthetic_knowledge(args.knowledge, rng)
+    if records:
+        stats = ingest.ingest(
+            records, bot.openai_client, bot.qdrant, collection=bot.COLLECTION_NAME,
+            model=bot.EMBEDDING_MODEL, concurrency=1 if args.qdrant == ":memory:" else 4,
+            on_points=bot.on_knowledge_changed
+        )
+        print(f"База знаний: {stats['chunks']} точек за {stats['elapsed']:.1f} с")
+
+    count = args.count or max(1, int(args.rate * args.duration))
+    if args.updates:
+        updates = recorded_updates(args.updates, count, first_id=1)
+    else:
+        questions = synthetic_questions(records, count, args.repeat_ratio, args.code_ratio, rng)
+        updates = [make_update(i + 1, 100_000 + rng.randrange(args.chats), text)
+                   for i, text in enumerate(questions)]
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    start_server(server)
+    webhook_url = f"http://127.0.0.1:{server.server_port}/{FAKE_TOKEN}"
+
+    bot.metrics.reset()
+    services.errors_enabled = True
+    sampler = ResourceSampler()
+    sampler.start()
+    print(f"Нагрузка: {count} обновлений, {args.rate:g}/с, {args.chats} чатов")
+    started = time.perf_counter()
+    sent, load = run_load(webhook_url, updates, args.rate, args.clients, timeout=30)
+    drained = wait_for_drain(bot.dispatcher, args.drain_timeout, bot.coalescer)
+    finished = time.perf_counter()
+    sampler.stop()
+    server.shutdown()
+
+    # Сопоставление ответов бота с вопросами
+    first, last = {}, {}
+    for moment, method, origin in services.calls:
+        if origin in sent:
+            first.setdefault(origin, moment)
+            last[origin] = moment
+    end_to_end = [last[origin] - sent[origin] for origin in last]
+    first_response = [first[origin] - sent[origin] for origin in first]
+    answered_until = max(last.values(), default=finished)
+    elapsed = max(1e-9, answered_until - started)
+
+    result = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "bot": {
+            "worker_threads": bot.WORKER_THREADS,
+            "update_queue_size": bot.UPDATE_QUEUE_SIZE,
+            "stream_responses": bot.STREAM_RESPONSES,
+            "answer_cache": bot.ANSWER_CACHE_ENABLED,
+            "lexical_index": bot.LEXICAL_INDEX,
+            "local_index": bot.LOCAL_INDEX,
+            "context_store": bot.CONTEXT_STORE,
+            "coalesce_window": bot.COALESCE_WINDOW,
+        },
+        "updates": {
+            "sent": len(updates),
+            "accepted": load["accepted"],
+            "rejected": load["rejected"],
+            "http_errors": load["http_errors"],
+            "answered": len(last),
+            "coalesced": bot.metrics.counters.get(("coalesced", ""), 0),
+            "limited": sum(value for (name, _), value in bot.metrics.counters.items() if name == "limited"),
+            "unanswered": load["accepted"] - len(last) - bot.metrics.counters.get(("coalesced", ""), 0),
+            "drained": drained,
+        },
+        "elapsed": round(elapsed, 2),
+        "throughput": round(len(last) / elapsed, 2),
+        "max_send_lag": round(load["lag"], 3),
+        "latency": {
+            "end_to_end": percentiles(end_to_end),
+            "first_response": percentiles(first_response),
+            "webhook": percentiles(load["webhook"]),
+        },
+        "resources": {
+            "threads_max": sampler.threads_max,
+            "rss_max_mb": round(sampler.rss_max / 2 ** 20, 1),
+        },
+        "stages": stage_breakdown(bot.metrics),
+        "counters": {f"{name}:{label}" if label else name: value
+                     for (name, label), value in sorted(bot.metrics.counters.items())},
+        "fakes": services.counts,
+    }
+
+    output = args.output or os.path.join(
+        "loadtest_results", f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    e2e = result["latency"]["end_to_end"]
+    print(f"Ответов: {len(last)}/{len(updates)} (склеено {result['updates']['coalesced']}, "
+          f"отклонено {load['rejected']}, ошибок HTTP {load['http_errors']})")
+    print(f"Пропускная способность: {result['throughput']} ответов/с")
+    print(f"Задержка: p50 {e2e.get('p50')} мс, p99 {e2e.get('p99')} мс; "
+          f"потоков до {sampler.threads_max}, RSS до {result['resources']['rss_max_mb']} МБ")
+    for name, stage in result["stages"].items():
+        print(f"  {name}: p50 {stage['p50']} мс, p99 {stage['p99']} мс, n={stage['count']}")
+    print(f"Результат: {output}")
+    if args.compare:
+        compare(result, args.compare)
+
+    bot.dispatcher.stop()
+    bot.context_store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Лёгкие метрики: гистограммы времени этапов, счётчики и экспорт для Prometheus"""
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Границы корзин в секундах: от 1 мс до минуты
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; квантили оцениваются интерполяцией"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля (линейная интерполяция внутри корзины)"""
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Реестр метрик процесса"""
+
+    # Имя метки Prometheus для счётчиков и показателей (по умолчанию "label")
+    LABEL_NAMES = {"errors": "stage", "timeouts": "stage", "cache": "event", "queue": "state", "limited": "scope",
+                   "retrieval": "decision", "outbox": "state"}
+
+    def __init__(self, prefix: str = "asuna"):
+        self.prefix = prefix
+        self.stages = {}          # этап -> Histogram
+        self.counters = Counter()  # (имя, этап/метка) -> значение
+        self.gauges = {}          # имя -> функция, возвращающая {метка: значение}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def inc(self, name: str, label: str = "", value: int = 1):
+        with self._lock:
+            self.counters[(name, label)] += value
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замер времени этапа; исключение учитывается как ошибка этапа"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("errors", name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def reset(self):
+        """Сброс гистограмм и счётчиков (показатели остаются)"""
+        with self._lock:
+            self.stages = {}
+            self.counters = Counter()
+
+    def gauge(self, name: str, collect):
+        """Регистрация показателя, который считывается при экспорте"""
+        self.gauges[name] = collect
+
+    # ----------------- Экспорт -----------------
+    def render_prometheus(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        p = self.prefix
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            with histogram._lock:
+                counts, total, total_sum = list(histogram.counts), histogram.count, histogram.sum
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {total_sum:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {total}')
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            for (counter_name, label), value in counters:
+                if counter_name == name:
+                    labels = f'{{{self.LABEL_NAMES.get(name, "label")}="{label}"}}' if label else ""
+                    lines.append(f"{p}_{name}_total{labels} {value}")
+
+        for name, collect in sorted(self.gauges.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                logging.error(f"Ошибка сбора метрики {name}: {e}")
+                continue
+            lines.append(f"# TYPE {p}_{name} gauge")
+            for label, value in sorted(values.items()):
+                labels = f'{{{self.LABEL_NAMES.get(name, "label")}="{label}"}}' if label else ""
+                lines.append(f"{p}_{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, stages=None) -> str:
+        """Краткая сводка p50/p95/p99 по этапам для админ-команд"""
+        rows = []
+        for stage in stages or sorted(self.stages):
+            histogram = self.stages.get(stage)
+            if histogram is None or not histogram.count:
+                continue
+            errors = self.counters.get(("errors", stage), 0)
+            rows.append(
+                f"{stage}: p50 {histogram.quantile(0.5) * 1000:.0f} мс, "
+                f"p95 {histogram.quantile(0.95) * 1000:.0f} мс, "
+                f"p99 {histogram.quantile(0.99) * 1000:.0f} мс, "
+                f"n={histogram.count}" + (f", ошибок {errors}" if errors else "")
+            )
+        return "\n".join(rows) or "данных пока нет"
+
+
+class SlowRequestProfiler:
+    """Сэмплирующий профайлер для медленных запросов.
+
+    Пока запрос идёт дольше threshold секунд, фоновый поток раз в interval
+    снимает стек его потока. Если запрос оказался медленным, в лог пишутся
+    самые частые стеки. Быстрые запросы стоят только вставки в словарь.
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.01, top: int = 5):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._active = {}  # id потока -> [название, начало, Counter стеков]
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _ensure_sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="slow-profiler", daemon=True)
+                self._sampler.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                slow = {tid: entry for tid, entry in self._active.items() if now - entry[1] > self.threshold}
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for tid, entry in slow.items():
+                frame = frames.get(tid)
+                if frame is not None:
+                    stack = traceback.extract_stack(frame, limit=12)
+                    entry[2][" <- ".join(f"{f.name}:{f.lineno}" for f in reversed(stack))] += 1
+
+    @contextmanager
+    def track(self, name: str):
+        """Отслеживание запроса в текущем потоке"""
+        tid = threading.get_ident()
+        entry = [name, time.perf_counter(), Counter()]
+        with self._lock:
+            self._active[tid] = entry
+        self._ensure_sampler()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.pop(tid, None)
+            elapsed = time.perf_counter() - entry[1]
+            if elapsed > self.threshold and entry[2]:
+                total = sum(entry[2].values())
+                report = "\n".join(f"  {count * 100 // total}% {stack}" for stack, count in entry[2].most_common(self.top))
+                logging.warning(f"Медленный запрос {name}: {elapsed:.2f} с, стеки ({total} сэмплов):\n{report}")
+
+
+def track(profiler, name: str):
+    """profiler.track(name) или пустой контекст, если профайлер выключен"""
+    return profiler.track(name) if profiler is not None else nullcontext()
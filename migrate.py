@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Перенос базы знаний в новую коллекцию (другой размер эмбеддингов, квантование) без остановки бота.
+
+Запуск из консоли:
+    python migrate.py --dimensions 512 --quantization scalar --drop-old
+    python migrate.py --dimensions 256 --mode reembed
+
+Пока knowledge_base - обычная коллекция (первый перенос), она удаляется
+при переключении, поэтому нужен --drop-old; на это время ставится алиас
+knowledge_base__migrating, чтобы бот не создал коллекцию заново.
+
+Точки копируются пакетами в новую коллекцию, пока бот работает со старой;
+записи, добавленные за время копирования, догружаются по created_at,
+а удалённые в старой коллекции удаляются и из новой (сравнение id).
+Затем алиас knowledge_base атомарно переключается на новую коллекцию,
+и воркеры бота сами переходят на новый размер векторов.
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from qdrant_client.models import (
+    PointStruct, PointIdsList, Filter, FieldCondition, Range,
+    CreateAlias, CreateAliasOperation, DeleteAlias, DeleteAliasOperation
+)
+
+import ingest
+
+# Запас на расхождение часов между воркерами бота и машиной миграции
+CLOCK_SKEW = 60
+# Попыток создать алиас, если имя снова заняла коллекция
+SWAP_ATTEMPTS = 3
+
+
+def resolve_collection(qdrant, name: str) -> tuple:
+    """Коллекция, на которую указывает имя: (коллекция, является ли имя алиасом)"""
+    for alias in qdrant.get_aliases().aliases:
+        if alias.alias_name == name:
+            return alias.collection_name, True
+    return name, False
+
+
+def truncate_vector(vector, dimensions: int) -> list:
+    """Первые dimensions компонент с повторной нормировкой.
+
+    Для text-embedding-3 это равносильно запросу с параметром dimensions,
+    поэтому переиндексация обходится без обращений к OpenAI.
+    """
+    vector = np.asarray(vector[:dimensions], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def copy_points(qdrant, source: str, target: str, transform, batch_size: int = 256,
+                since: float = None, progress=None, copied_ids: set = None) -> int:
+    """Копирование точек source -> target пакетами; transform(points) -> векторы.
+
+    В copied_ids (если передан) собираются id скопированных точек.
+    """
+    scroll_filter = None
+    if since is not None:
+        scroll_filter = Filter(must=[FieldCondition(key="created_at", range=Range(gte=since))])
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant.scroll(
+            collection_name=source,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=transform.needs_vectors
+        )
+        if points:
+            vectors = transform(points)
+            ingest.upsert_points(qdrant, target, [
+                PointStruct(id=point.id, vector=vector, payload=point.payload)
+                for point, vector in zip(points, vectors)
+            ])
+            copied += len(points)
+            if copied_ids is not None:
+                copied_ids.update(point.id for point in points)
+            if progress:
+                progress(copied)
+        if offset is None:
+            return copied
+
+
+def point_ids(qdrant, collection: str, batch_size: int = 1000) -> set:
+    """id всех точек коллекции (без payload и векторов)"""
+    ids = set()
+    offset = None
+    while True:
+        points, offset = qdrant.scroll(
+            collection_name=collection,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False
+        )
+        ids.update(point.id for point in points)
+        if offset is None:
+            return ids
+
+
+def propagate_deletions(qdrant, source: str, target: str, copied_ids: set, before: float = None) -> int:
+    """Удаление из target скопированных точек, которых больше нет в source.
+
+    За время копирования бот удаляет записи в старой коллекции (замены
+    при дедупликации, compact), а догрузка по created_at их не видит.
+    С before не трогаются точки, записанные в target после этого времени
+    (после переключения бот пишет уже в новую коллекцию).
+    """
+    gone = list(copied_ids - point_ids(qdrant, source))
+    if gone and before is not None:
+        records = qdrant.retrieve(collection_name=target, ids=gone, with_payload=["created_at"])
+        gone = [record.id for record in records if (record.payload or {}).get("created_at", 0) < before]
+    if gone:
+        qdrant.delete(collection_name=target, points_selector=PointIdsList(points=gone))
+        logging.info(f"Из {target} удалено {len(gone)} точек, удалённых в {source} за время переноса")
+    return len(gone)
+
+
+class Truncate:
+    """Новые векторы - укороченные старые"""
+    needs_vectors = True
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def __call__(self, points):
+        return [truncate_vector(point.vector, self.dimensions) for point in points]
+
+
+class Reembed:
+    """Новые векторы - заново посчитанные эмбеддинги текстов"""
+    needs_vectors = False
+
+    def __init__(self, openai_client, model: str, dimensions: int):
+        self.openai_client = openai_client
+        self.model = model
+        self.dimensions = dimensions
+
+    def __call__(self, points):
+        texts = [point.payload.get("text") or "" for point in points]
+        return ingest.embed_texts(self.openai_client, texts, self.model, dimensions=self.dimensions)
+
+
+def swap_alias(qdrant, alias: str, target: str, source: str, is_alias: bool, transform=None, batch_size: int = 256):
+    """Переключение имени на новую коллекцию.
+
+    Если имя уже алиас, удаление и создание идут одной атомарной операцией.
+    При первой миграции имя занято самой коллекцией: её приходится удалить
+    перед созданием алиаса (удалить коллекцию операцией алиасов нельзя).
+    На это время ставится алиас-метка, по которой ingest.ensure_collection
+    не пересоздаёт коллекцию; снятие метки и создание алиаса - одна операция.
+    Если коллекция всё же появилась снова (её создали до метки), её точки
+    переносятся в target, а она удаляется повторно.
+    """
+    create = CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=alias))
+    if is_alias:
+        qdrant.update_collection_aliases(change_aliases_operations=[
+            DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)), create
+        ])
+        return
+
+    marker = ingest.migration_marker(alias)
+    qdrant.update_collection_aliases(change_aliases_operations=[
+        CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=marker))
+    ])
+    qdrant.delete_collection(source)
+    for attempt in range(SWAP_ATTEMPTS):
+        try:
+            qdrant.update_collection_aliases(change_aliases_operations=[
+                DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=marker)), create
+            ])
+            return
+        except Exception as e:
+            if attempt + 1 == SWAP_ATTEMPTS or alias not in [c.name for c in qdrant.get_collections().collections]:
+                raise
+            logging.warning(f"Коллекция {alias} создана заново во время переключения ({e}), переношу её точки")
+            if transform is not None:
+                copy_points(qdrant, alias, target, transform, batch_size)
+            qdrant.delete_collection(alias)
+
+
+def migrate(qdrant, transform, alias: str, target: str, dimensions: int, quantization: str = None,
+            batch_size: int = 256, drop_old: bool = False, progress=None) -> dict:
+    """Перенос коллекции alias в target с переключением алиаса"""
+    source, is_alias = resolve_collection(qdrant, alias)
+    if source == target:
+        raise ValueError(f"Имя {alias} уже указывает на {target}")
+    if not is_alias and not drop_old:
+        raise ValueError(f"{alias} - коллекция, а не алиас: для переключения её нужно удалить (--drop-old)")
+
+    stats = {"source": source, "target": target, "copied": 0, "caught_up": 0, "deleted": 0, "started": time.time()}
+    ingest.create_collection(qdrant, target, dimensions, quantization)
+    copied_ids = set()
+
+    # 1. Основная копия; бот тем временем пишет в старую коллекцию
+    since = stats["started"] - CLOCK_SKEW
+    stats["copied"] = copy_points(qdrant, source, target, transform, batch_size, progress=progress,
+                                  copied_ids=copied_ids)
+
+    # 2. Догрузка записей, появившихся за время копирования (повторный upsert тех же id безопасен),
+    # и удаление тех, что за это время удалены в старой коллекции
+    caught_up_at = time.time() - CLOCK_SKEW
+    stats["caught_up"] = copy_points(qdrant, source, target, transform, batch_size, since=since,
+                                     copied_ids=copied_ids)
+    stats["deleted"] = propagate_deletions(qdrant, source, target, copied_ids)
+
+    # 3. Переключение и последняя догрузка того, что успели записать и удалить перед ним
+    if is_alias:
+        swapped_at = time.time()
+        swap_alias(qdrant, alias, target, source, is_alias, transform, batch_size)
+        stats["caught_up"] += copy_points(qdrant, source, target, transform, batch_size, since=caught_up_at,
+                                          copied_ids=copied_ids)
+        stats["deleted"] += propagate_deletions(qdrant, source, target, copied_ids, before=swapped_at - CLOCK_SKEW)
+        if drop_old:
+            qdrant.delete_collection(source)
+    else:
+        stats["caught_up"] += copy_points(qdrant, source, target, transform, batch_size, since=caught_up_at,
+                                          copied_ids=copied_ids)
+        stats["deleted"] += propagate_deletions(qdrant, source, target, copied_ids)
+        swap_alias(qdrant, alias, target, source, is_alias, transform, batch_size)
+
+    stats["elapsed"] = time.time() - stats["started"]
+    return stats
+
+
+# ----------------- Запуск из консоли -----------------
+def main():
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Перенос базы знаний в новую коллекцию с переключением алиаса")
+    parser.add_argument("--alias", default=ingest.DEFAULT_COLLECTION, help="имя, с которым работает бот")
+    parser.add_argument("--target", help="новая коллекция (по умолчанию <alias>_<размер>_<квантование>_<время>)")
+    parser.add_argument("--dimensions", type=int, default=int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None)
+    parser.add_argument("--quantization", default=os.getenv("QDRANT_QUANTIZATION", "none"),
+                        choices=["none", "scalar", "binary"])
+    parser.add_argument("--mode", default="truncate", choices=["truncate", "reembed"],
+                        help="truncate - укоротить старые векторы, reembed - посчитать эмбеддинги заново")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", ingest.DEFAULT_MODEL))
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--drop-old", action="store_true", help="удалить старую коллекцию после переключения")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qdrant = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=60)
+    source, _ = resolve_collection(qdrant, args.alias)
+    current = qdrant.get_collection(source).config.params.vectors.size
+    dimensions = args.dimensions or current
+
+    if args.mode == "truncate":
+        if dimensions > current:
+            parser.error(f"укоротить векторы размера {current} до {dimensions} нельзя, нужен --mode reembed")
+        if not args.model.startswith("text-embedding-3"):
+            logging.warning(f"{args.model} не обучена на укороченных векторах, качество поиска может упасть")
+        transform = Truncate(dimensions)
+    else:
+        from openai import OpenAI
+        transform = Reembed(OpenAI(api_key=os.getenv("OPENAI_API_KEY")), args.model, dimensions)
+
+    target = args.target or f"{args.alias}_{dimensions}_{args.quantization}_{time.strftime('%Y%m%d%H%M%S')}"
+    logging.info(f"Перенос {source} ({current}) -> {target} ({dimensions}, квантование {args.quantization})")
+
+    last_report = [0.0]
+
+    def progress(copied):
+        if time.time() - last_report[0] > 2:
+            last_report[0] = time.time()
+            logging.info(f"скопировано {copied} точек")
+
+    stats = migrate(
+        qdrant, transform, args.alias, target, dimensions,
+        quantization=args.quantization,
+        batch_size=args.batch_size,
+        drop_old=args.drop_old,
+        progress=progress
+    )
+    logging.info(
+        f"✅ {args.alias} -> {target}: скопировано {stats['copied']}, догружено {stats['caught_up']}, "
+        f"удалено {stats['deleted']} "
+        f"за {stats['elapsed']:.1f} с"
+    )
+    if not args.drop_old:
+        logging.info(f"Старая коллекция {source} оставлена, удалите её после проверки")
+
+
+if __name__ == "__main__":
+    main()
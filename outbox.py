@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Исходящие запросы к Telegram: общая очередь с темпом отправки, retry_after и повторами"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from rate_limit import TokenBucket
+
+MESSAGE_LIMIT = 4096  # символов в одном сообщении Telegram
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    """Части не длиннее limit: разрыв по абзацу, строке или пробелу (слово режется, только если иначе нельзя)"""
+    parts = []
+    while len(text) > limit:
+        cut = -1
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, limit // 2, limit + len(separator))
+            if cut > 0:
+                break
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return [part for part in parts if part.strip()] or [text]
+
+
+class SendError(Exception):
+    """Telegram отказал в запросе (error_code и description из ответа Bot API)"""
+
+    def __init__(self, error_code, description: str):
+        super().__init__(f"{error_code}: {description}")
+        self.error_code = error_code
+        self.description = description
+
+
+class _Job:
+    __slots__ = ("chat_id", "method", "payload", "key", "future", "attempts")
+
+    def __init__(self, chat_id: int, method: str, payload: dict, key, future: Future):
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.key = key
+        self.future = future
+        self.attempts = 0
+
+
+class TelegramOutbox:
+    """Единая очередь исходящих запросов к Bot API.
+
+    request(method, payload) -> dict выполняет запрос и возвращает ответ
+    Telegram целиком. Запросы одного чата уходят строго по очереди и не чаще
+    chat_rate в секунду (group_rate для групп), все вместе - не чаще
+    global_rate. На 429 чат ставится на паузу retry_after, на 5xx и сетевые
+    ошибки - повтор с растущей паузой, всего до max_attempts попыток.
+    Ожидающая правка сообщения заменяется новой: при потоковом ответе
+    уходит только последний текст. Результат - Future с объектом Message
+    из ответа (dict).
+    """
+
+    def __init__(self, request, senders: int = 4, global_rate: float = 25.0, chat_rate: float = 1.0,
+                 chat_burst: float = 3, group_rate: float = 20 / 60, group_burst: float = 3,
+                 max_attempts: int = 5, max_queue: int = 5000, max_chats: int = 10000, name: str = "outbox"):
+        self.request = request
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_attempts = max_attempts
+        self.max_queue = max_queue
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._buckets = OrderedDict()  # chat_id -> TokenBucket
+        self._pending = {}             # chat_id -> deque запросов (пока в чате есть очередь или запрос в полёте)
+        self._ready = OrderedDict()    # чаты с очередью и без запроса в полёте, по кругу
+        self._paused = {}              # chat_id -> time.monotonic(), раньше которого чату слать нельзя
+        self._cond = threading.Condition()
+        self._queued = 0
+        self._busy = 0
+        self.sent = 0
+        self.retried = 0
+        self.throttled = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.dropped = 0
+        for i in range(senders):
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True).start()
+
+    def send(self, chat_id: int, text: str, reply_to: int = None, **params) -> Future:
+        """Сообщение (длинное - несколькими частями по порядку); Future первой части"""
+        futures = []
+        for i, part in enumerate(split_text(text)):
+            payload = dict(params, chat_id=chat_id, text=part)
+            if reply_to and i == 0:
+                payload["reply_to_message_id"] = reply_to
+                payload["allow_sending_without_reply"] = True
+            futures.append(self.call("sendMessage", payload))
+        return futures[0]
+
+    def edit(self, chat_id: int, message_id: int, text: str, **params) -> Future:
+        """Правка сообщения; не поместившийся в него текст уходит следующими сообщениями"""
+        parts = split_text(text)
+        future = self.call("editMessageText", dict(params, chat_id=chat_id, message_id=message_id, text=parts[0]),
+                           key=("edit", message_id))
+        for part in parts[1:]:
+            self.call("sendMessage", dict(params, chat_id=chat_id, text=part))
+        return future
+
+    def call(self, method: str, payload: dict, key=None, chat_id: int = None) -> Future:
+        """Произвольный метод Bot API в очереди чата payload["chat_id"].
+
+        Запрос с тем же key, ещё ждущий отправки, заменяется новым. Для методов
+        без chat_id (answerCallbackQuery, getFile) чат очереди передаётся отдельно.
+        """
+        if chat_id is None:
+            chat_id = payload["chat_id"]
+        with self._cond:
+            jobs = self._pending.get(chat_id)
+            if key is not None and jobs:
+                for job in jobs:
+                    if job.key == key:
+                        job.payload = payload
+                        self.coalesced += 1
+                        return job.future
+            future = Future()
+            if self._queued >= self.max_queue:
+                self.dropped += 1
+                future.set_exception(SendError(None, "очередь отправки переполнена"))
+                return future
+            if jobs is None:
+                # Запросов чата нет ни в очереди, ни в полёте - он сразу готов
+                jobs = self._pending[chat_id] = deque()
+                self._ready[chat_id] = None
+            jobs.append(_Job(chat_id, method, payload, key, future))
+            self._queued += 1
+            self._cond.notify()
+            return future
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+            while len(self._buckets) > self.max_chats:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _next_job(self):
+        """Запрос, который можно отправить сейчас, иначе (None, пауза до ближайшего); под блокировкой"""
+        if not self._ready:
+            return None, None
+        now = time.monotonic()
+        self._global.refill(now)
+        if self._global.tokens < 1:
+            return None, self._global.wait_time()
+        delay = None
+        for chat_id in self._ready:
+            bucket = self._bucket(chat_id)
+            bucket.refill(now)
+            wait = max(self._paused.get(chat_id, 0.0) - now, bucket.wait_time())
+            if wait <= 0:
+                del self._ready[chat_id]
+                self._paused.pop(chat_id, None)
+                bucket.tokens -= 1
+                self._global.tokens -= 1
+                self._queued -= 1
+                self._busy += 1
+                return self._pending[chat_id].popleft(), None
+            delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job, delay = self._next_job()
+                while job is None:
+                    self._cond.wait(delay)
+                    job, delay = self._next_job()
+            self._deliver(job)
+
+    def _deliver(self, job: _Job):
+        chat_id = job.chat_id
+        try:
+            response = self.request(job.method, job.payload)
+        except Exception as e:
+            response = {"ok": False, "error_code": None, "description": str(e)}
+
+        retry_in = None
+        if response.get("ok"):
+            self.sent += 1
+            job.future.set_result(response.get("result"))
+        else:
+            code = response.get("error_code")
+            description = response.get("description") or ""
+            if code == 429:
+                # Пауза, которую назвал сам Telegram; попыткой не считается
+                self.throttled += 1
+                retry_in = float((response.get("parameters") or {}).get("retry_after") or 5)
+            elif "message is not modified" in description:
+                job.future.set_result(None)
+            elif code == 400 and "can't parse entities" in description and "parse_mode" in job.payload:
+                # Разметка разорвана при разбиении или сломана в тексте - шлём без неё
+                job.payload = {k: v for k, v in job.payload.items() if k != "parse_mode"}
+                retry_in = 0.0
+            elif (code is None or code >= 500) and job.attempts + 1 < self.max_attempts:
+                job.attempts += 1
+                retry_in = min(2.0 ** job.attempts, 30.0)
+                logging.warning(f"Ошибка Telegram {job.method} в чате {chat_id}: {code} - {description}, "
+                                f"повтор через {retry_in:.0f} с")
+            else:
+                self.failed += 1
+                logging.error(f"Ошибка Telegram {job.method} в чате {chat_id}: {code} - {description}")
+                job.future.set_exception(SendError(code, description))
+
+        with self._cond:
+            self._busy -= 1
+            jobs = self._pending[chat_id]
+            if retry_in is not None:
+                self.retried += 1
+                self._paused[chat_id] = time.monotonic() + retry_in
+                newer = job.key is not None and any(other.key == job.key for other in jobs)
+                if newer:
+                    job.future.set_result(None)  # устаревшая правка: за ней в очереди уже есть новая
+                else:
+                    jobs.appendleft(job)
+                    self._queued += 1
+            if jobs:
+                self._ready[chat_id] = None
+                self._cond.notify()
+            else:
+                del self._pending[chat_id]
+                self._paused.pop(chat_id, None)
+
+    def drain(self, timeout: float = 10) -> bool:
+        """Дождаться отправки уже принятых запросов (при остановке); False, если не успели"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queued or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.1))
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": self._queued,
+                "busy": self._busy,
+                "chats": len(self._pending),
+                "paused": sum(1 for until in self._paused.values() if until > time.monotonic()),
+                "sent": self.sent,
+                "retried": self.retried,
+                "throttled": self.throttled,
+                "coalesced": self.coalesced,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
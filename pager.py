@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Курсоры постраничного просмотра коллекции Qdrant (next_page_offset)"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class CursorSessions:
+    """Курсоры страниц, по сессии на каждое открытие списка.
+
+    Qdrant отдаёт только курсор следующей страницы, поэтому курсоры уже
+    открытых страниц запоминаются в сессии: по ним работает кнопка «назад».
+    В callback_data кнопки (до 64 байт) уходят только короткий токен сессии
+    и номер страницы. Сессия живёт ttl секунд с последнего обращения,
+    у пользователя хранится не больше max_per_user последних сессий.
+    """
+
+    def __init__(self, ttl: float = 3600, max_per_user: int = 3):
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self._sessions = OrderedDict()  # token -> [user_id, [курсор страницы 0, 1, ...], время обращения]
+        self._lock = threading.Lock()
+
+    def open(self, user_id: int) -> str:
+        """Новая сессия с курсором первой страницы"""
+        token = secrets.token_urlsafe(6)
+        with self._lock:
+            self._evict(time.monotonic())
+            own = [key for key, session in self._sessions.items() if session[0] == user_id]
+            for key in own[:max(0, len(own) - self.max_per_user + 1)]:
+                del self._sessions[key]
+            self._sessions[token] = [user_id, [None], time.monotonic()]
+        return token
+
+    def offset(self, token: str, user_id: int, page: int):
+        """(True, курсор страницы) или (False, None), если сессия устарела или страница ещё не открывалась"""
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None or session[0] != user_id or time.monotonic() - session[2] > self.ttl:
+                return False, None
+            if not 0 <= page < len(session[1]):
+                return False, None
+            session[2] = time.monotonic()
+            self._sessions.move_to_end(token)
+            return True, session[1][page]
+
+    def remember(self, token: str, page: int, next_offset):
+        """Курсор страницы page + 1 (None - страница последняя)"""
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return
+            offsets = session[1]
+            del offsets[page + 1:]
+            if next_offset is not None:
+                offsets.append(next_offset)
+
+    def _evict(self, now: float):
+        while self._sessions:
+            token, session = next(iter(self._sessions.items()))
+            if now - session[2] <= self.ttl:
+                return
+            del self._sessions[token]
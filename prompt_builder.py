@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Сборка промпта в пределах бюджета токенов"""
+import re
+
+WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+MESSAGE_OVERHEAD = 4  # служебные токены на сообщение (роль, разделители)
+
+
+def count_tokens(text: str) -> int:
+    """Оценка числа токенов без токенизатора модели.
+
+    Латиница - около 4-5 символов на токен, кириллица и прочее - около 3
+    (оценка с запасом, чтобы бюджет не превышался на русском тексте).
+    """
+    tokens = 0
+    for piece in WORD_RE.findall(text):
+        tokens += 1 + len(piece) // (5 if piece.isascii() else 3)
+    return tokens
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def truncate(text: str, budget: int) -> str:
+    """Начало текста, укладывающееся в budget токенов (по границе слова)"""
+    if count_tokens(text) <= budget:
+        return text
+    used = 0
+    end = 0
+    for match in re.finditer(r"\S+", text):
+        used += count_tokens(match.group())
+        if used > budget - 1:  # токен на многоточие
+            break
+        end = match.end()
+    return text[:end].rstrip() + "…" if end else ""
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = [word.lower() for word in re.findall(r"\w+", text)]
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _strip_overlap(text: str, previous: str, probe: int = 64) -> str:
+    """Убрать начало text, повторяющее конец previous (перекрытие соседних чанков)"""
+    head = text[:probe]
+    if len(head) < probe:
+        return text
+    pos = previous.find(head)
+    while pos != -1:
+        tail = previous[pos:]
+        if text.startswith(tail):
+            return text[len(tail):].lstrip()
+        pos = previous.find(head, pos + 1)
+    return text
+
+
+def dedupe_snippets(snippets: list, max_overlap: float = 0.6) -> list:
+    """Записи базы без повторов: порядок (по релевантности) сохраняется.
+
+    Запись отбрасывается, если не меньше max_overlap её словесных
+    шинглов уже есть в более релевантных записях; перекрывающееся
+    начало соседнего чанка обрезается.
+    """
+    kept = []
+    seen = []
+    for text in snippets:
+        text = text.strip()
+        for previous in kept:
+            text = _strip_overlap(text, previous)
+        shingles = _shingles(text)
+        if not shingles:
+            continue
+        if any(len(shingles & other) >= max_overlap * len(shingles) for other in seen):
+            continue
+        kept.append(text)
+        seen.append(shingles)
+    return kept
+
+
+def select_snippets(snippets: list, budget: int, min_tokens: int = 40) -> tuple:
+    """Лучшие записи в пределах бюджета: (тексты, израсходовано токенов).
+
+    Не влезающая целиком запись обрезается, если осталось хотя бы
+    min_tokens; на этом отбор заканчивается.
+    """
+    selected = []
+    used = 0
+    for text in dedupe_snippets(snippets):
+        cost = count_tokens(text) + 1  # перевод строки
+        if used + cost > budget:
+            if budget - used >= min_tokens:
+                text = truncate(text, budget - used - 1)
+                if text:
+                    selected.append(text)
+                    used += count_tokens(text) + 1
+            break
+        selected.append(text)
+        used += cost
+    return selected, used
+
+
+def select_turns(turns: list, budget: int) -> list:
+    """Последние реплики, влезающие в бюджет (в хронологическом порядке)"""
+    selected = []
+    for message in reversed(turns):
+        cost = message_tokens(message)
+        if cost > budget:
+            break
+        selected.append(message)
+        budget -= cost
+    return selected[::-1]
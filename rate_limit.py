@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Ограничение частоты запросов к модели: token bucket на пользователя и общий"""
+import threading
+import time
+from collections import OrderedDict, Counter, namedtuple
+
+# allowed - можно звать модель; scope - какой лимит сработал ("user" | "global");
+# retry_after - через сколько секунд появится токен
+Decision = namedtuple("Decision", "allowed scope retry_after")
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше burst"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float = 1.0) -> float:
+        return max(0.0, (cost - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """Лимиты на пользователя и на весь процесс.
+
+    Токен списывается только если хватает обоих лимитов, так что отказ
+    по общему лимиту не наказывает пользователя. Вёдра неактивных
+    пользователей вытесняются (не больше max_users в памяти).
+    """
+
+    def __init__(self, user_rate: float, user_burst: float, global_rate: float, global_burst: float,
+                 max_users: int = 10000, exempt=()):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.exempt = set(exempt)
+        self._global = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._users = OrderedDict()  # user_id -> TokenBucket
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.denied = Counter()  # scope -> отказов
+        self.denied_users = Counter()  # user_id -> отказов по личному лимиту
+        self.waited = 0
+
+    def _take(self, user_id: int, cost: float) -> Decision:
+        """Списание токена без учёта в статистике отказов (под блокировкой)"""
+        now = time.monotonic()
+        bucket = None
+        if self.user_rate > 0 and user_id is not None and user_id not in self.exempt:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            bucket.refill(now)
+            if bucket.tokens < cost:
+                return Decision(False, "user", bucket.wait_time(cost))
+        if self._global is not None:
+            self._global.refill(now)
+            if self._global.tokens < cost:
+                return Decision(False, "global", self._global.wait_time(cost))
+            self._global.tokens -= cost
+        if bucket is not None:
+            bucket.tokens -= cost
+        self.allowed += 1
+        return Decision(True, None, 0.0)
+
+    def _count(self, user_id: int, decision: Decision) -> Decision:
+        if not decision.allowed:
+            with self._lock:
+                self.denied[decision.scope] += 1
+                if decision.scope == "user":
+                    if len(self.denied_users) >= self.max_users:
+                        self.denied_users.clear()
+                    self.denied_users[user_id] += 1
+        return decision
+
+    def try_acquire(self, user_id: int, cost: float = 1.0) -> Decision:
+        """Попытка взять токен без ожидания (user_id=None - только общий лимит)"""
+        with self._lock:
+            decision = self._take(user_id, cost)
+        return self._count(user_id, decision)
+
+    def acquire(self, user_id: int, max_wait: float = 0.0, cost: float = 1.0) -> Decision:
+        """Токен с ожиданием до max_wait секунд, если упёрлись в общий лимит.
+
+        Превышение личного лимита возвращается сразу: ждать в воркере
+        ради одного пользователя нельзя.
+        """
+        deadline = time.monotonic() + max_wait
+        waited = False
+        while True:
+            with self._lock:
+                decision = self._take(user_id, cost)
+                if not decision.allowed and decision.scope == "global" and not waited:
+                    waited = decision.retry_after <= deadline - time.monotonic()
+                    self.waited += waited
+            if decision.allowed or decision.scope == "user" or decision.retry_after > deadline - time.monotonic():
+                return self._count(user_id, decision)
+            time.sleep(decision.retry_after)
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._global is not None:
+                self._global.refill(time.monotonic())
+            return {
+                "allowed": self.allowed,
+                "denied_user": self.denied["user"],
+                "denied_global": self.denied["global"],
+                "waited": self.waited,
+                "users": len(self._users),
+                "global_tokens": self._global.tokens if self._global is not None else None,
+                "global_burst": self._global.burst if self._global is not None else None,
+                "top_denied": self.denied_users.most_common(3),
+            }
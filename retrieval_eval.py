@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Офлайн-оценка политик поиска: полнота против стоимости промпта.
+
+Загружает базу знаний в локальный Qdrant (:memory:), прогоняет размеченные
+вопросы через каждую политику из retrieval_policy.py и печатает recall@k,
+MRR, среднее число записей и токенов записей в промпте.
+
+Пример:
+    python retrieval_eval.py --knowledge eval/knowledge.jsonl --questions eval/questions.jsonl
+    python retrieval_eval.py --knowledge faq.jsonl --questions labeled.jsonl --openai --output eval.json
+
+Формат вопросов (JSONL): {"question": "...", "expected": ["фрагмент нужной записи", ...]}.
+Пустой expected - вопрос, для которого база не нужна (приветствие, вопрос
+не по теме): для него считается, сколько записей попало в промпт зря.
+Без --openai эмбеддинги считаются локально по словам (быстро и бесплатно,
+но хуже настоящих) - годится для сравнения политик между собой.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+import types
+
+import numpy as np
+
+import ingest
+from embedding_cache import normalize_text
+from lexical_index import LexicalIndex, tokenize
+from prompt_builder import count_tokens, dedupe_snippets
+from retrieval_policy import POLICIES, get_policy
+
+COLLECTION = "retrieval_eval"
+
+
+class HashingEmbeddings:
+    """Локальная замена OpenAI embeddings: сумма псевдослучайных векторов слов (после стемминга)"""
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+        self._vectors = {}
+
+    def _token_vector(self, token: str) -> np.ndarray:
+        vector = self._vectors.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:4], "little")
+            vector = np.random.RandomState(seed).standard_normal(self.dimensions).astype(np.float32)
+            self._vectors[token] = vector
+        return vector
+
+    def create(self, model: str, input, **kwargs):
+        texts = [input] if isinstance(input, str) else input
+        data = []
+        for i, text in enumerate(texts):
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+            for token in tokenize(text) or [text]:
+                vector += self._token_vector(token)
+            norm = np.linalg.norm(vector)
+            data.append(types.SimpleNamespace(embedding=(vector / norm if norm else vector).tolist(), index=i))
+        return types.SimpleNamespace(data=data)
+
+
+def read_questions(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def first_match(expected: str, texts: list):
+    """Позиция (с 1) первой записи, содержащей ожидаемый фрагмент, или None"""
+    needle = normalize_text(expected)
+    for rank, text in enumerate(texts, 1):
+        if needle in normalize_text(text):
+            return rank
+    return None
+
+
+def evaluate(policy, questions: list, embed, dense_search, lexical_index,
+             lexical_min_coverage: float = 0.8, lexical_min_gap: float = 1.5) -> dict:
+    """Метрики одной политики по всем вопросам"""
+    recall = []
+    reciprocal_ranks = []
+    returned = []
+    tokens = []
+    noise = []
+    decisions = {}
+    elapsed = 0.0
+    for item in questions:
+        question = item["question"]
+        started = time.perf_counter()
+        hits, coverage, code_match = lexical_index.search(question, policy.candidates)
+        confident = LexicalIndex.confident(hits, coverage, code_match, lexical_min_coverage, lexical_min_gap)
+        result = policy.retrieve(question, embed, dense_search, lexical=(hits, confident))
+        elapsed += time.perf_counter() - started
+
+        texts = dedupe_snippets([hit.payload["text"] for hit in result.hits])
+        decisions[result.decision] = decisions.get(result.decision, 0) + 1
+        returned.append(len(texts))
+        tokens.append(count_tokens("\n".join(texts)) if texts else 0)
+        expected = item.get("expected") or []
+        if not expected:
+            noise.append(len(texts))
+            continue
+        ranks = [first_match(fragment, texts) for fragment in expected]
+        recall.append(sum(rank is not None for rank in ranks) / len(ranks))
+        found = [rank for rank in ranks if rank is not None]
+        reciprocal_ranks.append(1.0 / min(found) if found else 0.0)
+
+    def mean(values):
+        return float(np.mean(values)) if values else 0.0
+
+    return {
+        "policy": policy.name,
+        "recall": mean(recall),
+        "mrr": mean(reciprocal_ranks),
+        "avg_k": mean(returned),
+        "avg_tokens": mean(tokens),
+        "noise": mean(noise),
+        "decisions": decisions,
+        "ms_per_query": elapsed / max(len(questions), 1) * 1000,
+    }
+
+
+def format_report(results: list, questions: list) -> str:
+    positives = sum(1 for item in questions if item.get("expected"))
+    lines = [
+        f"Вопросов: {len(questions)} (с ожидаемыми записями {positives}, без - {len(questions) - positives})",
+        f"{'политика':<18}{'recall@k':>9}{'MRR':>7}{'записей':>9}{'токенов':>9}{'шум':>6}{'мс':>8}  решения",
+    ]
+    for r in results:
+        decisions = ", ".join(f"{name} {count}" for name, count in sorted(r["decisions"].items()))
+        lines.append(
+            f"{r['policy']:<18}{r['recall']:>9.2f}{r['mrr']:>7.2f}{r['avg_k']:>9.1f}{r['avg_tokens']:>9.0f}"
+            f"{r['noise']:>6.1f}{r['ms_per_query']:>8.1f}  {decisions}"
+        )
+    lines.append("шум - записей в промпте для вопросов, которым база не нужна")
+    return "\n".join(lines)
+
+
+# ----------------- Запуск из консоли -----------------
+def main():
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Офлайн-оценка политик поиска по базе знаний")
+    parser.add_argument("--knowledge", nargs="+", required=True, help="JSONL или текстовые файлы базы")
+    parser.add_argument("--questions", required=True, help="JSONL с размеченными вопросами")
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), help="политики для сравнения")
+    parser.add_argument("--qdrant", default=":memory:", help=":memory: или URL отдельного Qdrant")
+    parser.add_argument("--openai", action="store_true", help="настоящие эмбеддинги OpenAI (нужен OPENAI_API_KEY)")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", ingest.DEFAULT_MODEL))
+    parser.add_argument("--dimensions", type=int, default=int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    policies = [get_policy(name) for name in args.policies]
+
+    if args.openai:
+        from openai import OpenAI
+        openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    else:
+        openai_client = types.SimpleNamespace(embeddings=HashingEmbeddings(args.dimensions or 256))
+
+    if args.qdrant == ":memory:":
+        qdrant = QdrantClient(location=":memory:")
+    else:
+        qdrant = QdrantClient(url=args.qdrant, api_key=os.getenv("QDRANT_API_KEY"))
+        if ingest.collection_exists(qdrant, COLLECTION):
+            qdrant.delete_collection(COLLECTION)
+
+    for path in args.knowledge:
+        ingest.ingest(ingest.read_records(path), openai_client, qdrant, collection=COLLECTION,
+                      model=args.model, dimensions=args.dimensions, chunk_size=args.chunk_size,
+                      concurrency=1)
+    lexical_index = LexicalIndex()
+    lexical_index.pull(qdrant, COLLECTION)
+
+    # Эмбеддинг вопроса считается один раз для всех политик
+    vectors = {}
+
+    def embed(question):
+        if question not in vectors:
+            vectors[question] = ingest.embed_texts(openai_client, [question], args.model, dimensions=args.dimensions)[0]
+        return vectors[question]
+
+    def dense_search(vector, threshold, limit):
+        return qdrant.query_points(collection_name=COLLECTION, query=vector, limit=limit,
+                                   score_threshold=threshold).points
+
+    questions = read_questions(args.questions)
+    for item in questions:
+        embed(item["question"])
+    results = [evaluate(policy, questions, embed, dense_search, lexical_index) for policy in policies]
+    print(format_report(results, questions))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"knowledge": args.knowledge, "questions": args.questions, "openai": args.openai,
+                       "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
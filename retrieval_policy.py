@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Политики поиска по базе знаний: сколько записей брать и нужен ли поиск вообще"""
+import re
+from collections import namedtuple
+
+from lexical_index import rrf_fuse, tokenize
+from vector_mirror import Hit
+
+# Реплики без вопроса по существу: поиск по базе для них не нужен
+SMALLTALK_WORDS = {
+    "привет", "приветик", "здравствуй", "здравствуйте", "хай", "добрый", "доброе", "доброй",
+    "спасибо", "спс", "благодарю", "пасиб", "пока", "свидания", "ок", "окей", "ага", "угу",
+    "хорошо", "ладно", "понятно", "ясно", "норм", "отлично", "круто", "класс", "супер", "ха",
+    "хаха", "ахах", "лол", "дела", "hi", "hello", "hey", "thanks", "thank", "ok", "okay", "bye",
+    "lol", "cool", "nice",
+}
+# Слова, которые бывают и в вопросах по делу: реплика из них одних («да», «как?»,
+# «а все?») - не светская, рядом с ними нужно хотя бы одно слово из SMALLTALK_WORDS
+SMALLTALK_FILLERS = {
+    "день", "утро", "вечер", "ночи", "до", "да", "нет", "как", "ты", "тебе",
+    "очень", "большое", "и", "а", "все", "you", "yes", "no",
+}
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# hits - найденные точки; decision - как принято решение
+# ("skip" | "lexical" | "dense" | "hybrid" | "empty")
+Retrieval = namedtuple("Retrieval", "hits decision")
+
+
+def is_smalltalk(query: str, max_words: int = 5) -> bool:
+    """Приветствие, благодарность, «ок» и т.п. (или только эмодзи)"""
+    words = WORD_RE.findall(query.lower().replace("ё", "е"))
+    if not words:
+        return True
+    return (len(words) <= max_words and any(word in SMALLTALK_WORDS for word in words)
+            and all(word in SMALLTALK_WORDS or word in SMALLTALK_FILLERS for word in words))
+
+
+class RetrievalPolicy:
+    """Правила отбора записей базы знаний для промпта.
+
+    Из candidates лучших по косинусу остаются записи не ниже min_score
+    и не ниже relative * score лидера; список обрывается на первом
+    провале score больше max_gap. Лексические результаты добавляются
+    через RRF, затем (rerank) порядок уточняется по доле слов запроса
+    в записи. Реплики без вопроса (skip_smalltalk) не ищутся вовсе.
+    """
+
+    def __init__(self, name: str, limit: int = 5, candidates: int = None, min_score: float = 0.1,
+                 relative: float = 0.0, max_gap: float = None, rerank: bool = False,
+                 rerank_weight: float = 0.5, skip_smalltalk: bool = False):
+        self.name = name
+        self.limit = limit
+        self.candidates = candidates or limit
+        self.min_score = min_score
+        self.relative = relative
+        self.max_gap = max_gap
+        self.rerank = rerank
+        self.rerank_weight = rerank_weight
+        self.skip_smalltalk = skip_smalltalk
+
+    def __repr__(self):
+        return f"RetrievalPolicy({self.name})"
+
+    def cut(self, hits: list) -> list:
+        """Адаптивный top-k по score плотного поиска (hits отсортированы по убыванию)"""
+        if not hits:
+            return []
+        floor = max(self.min_score, hits[0].score * self.relative)
+        kept = [hits[0]] if hits[0].score >= self.min_score else []
+        for previous, hit in zip(hits, hits[1:]):
+            if not kept or hit.score < floor or len(kept) >= self.limit:
+                break
+            if self.max_gap is not None and previous.score - hit.score > self.max_gap:
+                break
+            kept.append(hit)
+        return kept
+
+    def rerank_hits(self, query: str, hits: list) -> list:
+        """Дешёвое переранжирование: позиция после слияния + доля слов запроса в записи"""
+        terms = set(tokenize(query))
+        if not terms or len(hits) < 2:
+            return hits
+        top = hits[0].score or 1.0
+        scored = []
+        for hit in hits:
+            overlap = len(terms & set(tokenize(hit.payload.get("text", "")))) / len(terms)
+            score = (1 - self.rerank_weight) * hit.score / top + self.rerank_weight * overlap
+            scored.append(Hit(hit.id, score, hit.payload))
+        return sorted(scored, key=lambda hit: -hit.score)
+
+    def retrieve(self, query: str, embed, dense_search, lexical: tuple = None, vector: list = None) -> Retrieval:
+        """Поиск записей для вопроса.
+
+        embed(query) -> вектор, dense_search(vector, threshold, limit) -> точки
+        по убыванию score; lexical - результат лексического поиска
+        (hits, уверенное ли совпадение) или None; готовый vector можно передать.
+        """
+        if self.skips(query):
+            return Retrieval([], "skip")
+        lexical_hits, confident = lexical or ([], False)
+        if confident:
+            return Retrieval(lexical_hits[:self.limit], "lexical")
+
+        if vector is None:
+            vector = embed(query)
+        dense = dense_search(vector, self.min_score, self.candidates) if vector else []
+        return self.combine(query, dense, lexical_hits)
+
+    def skips(self, query: str) -> bool:
+        """Поиск не нужен (реплика без вопроса)"""
+        return self.skip_smalltalk and is_smalltalk(query)
+
+    def combine(self, query: str, dense: list, lexical_hits: list) -> Retrieval:
+        """Отбор из результатов плотного и (неуверенного) лексического поиска"""
+        dense = self.cut(dense)
+        if lexical_hits and self.relative:
+            lexical_hits = [hit for hit in lexical_hits if hit.score >= lexical_hits[0].score * self.relative]
+        if not lexical_hits:
+            hits = dense
+        elif not dense:
+            hits = lexical_hits[:self.limit]
+        else:
+            hits = rrf_fuse([dense, lexical_hits], self.limit)
+        if self.rerank:
+            hits = self.rerank_hits(query, hits)
+        decision = "empty" if not hits else "hybrid" if lexical_hits and dense else "dense" if dense else "lexical"
+        return Retrieval(hits[:self.limit], decision)
+
+
+# Готовые политики; legacy - прежнее поведение (5 записей с порогом 0.1)
+POLICIES = {
+    "legacy": RetrievalPolicy("legacy", limit=5, min_score=0.1),
+    "adaptive": RetrievalPolicy("adaptive", limit=5, candidates=10, min_score=0.1, relative=0.6,
+                                max_gap=0.1, skip_smalltalk=True),
+    "adaptive-rerank": RetrievalPolicy("adaptive-rerank", limit=5, candidates=10, min_score=0.1,
+                                       relative=0.6, max_gap=0.1, rerank=True, skip_smalltalk=True),
+    "strict": RetrievalPolicy("strict", limit=3, candidates=6, min_score=0.35, relative=0.9,
+                              max_gap=0.05, skip_smalltalk=True),
+}
+
+
+def get_policy(name: str) -> RetrievalPolicy:
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестная политика поиска: {name} (есть: {', '.join(POLICIES)})") from None
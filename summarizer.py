@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Фоновое сворачивание старых реплик диалога в краткое резюме"""
+import logging
+import queue
+import threading
+
+
+def turns_after(turns: list, first: int, marker: int = None) -> list:
+    """Реплики с номером больше marker; first - номер turns[0]"""
+    if marker is None:
+        return turns
+    return turns[max(0, marker + 1 - first):]
+
+
+class ConversationSummarizer:
+    """Поддерживает резюме диалога для реплик, выходящих из окна промпта.
+
+    Последние keep_turns реплик идут в промпт дословно, более старые
+    сворачиваются в резюме, как только их набирается batch. Резюме
+    обновляется инкрементально: модель получает прежнее резюме и только
+    новые реплики. summarize(previous, turns) -> str делает запрос к модели,
+    allow() -> bool решает, можно ли звать её сейчас (иначе повтор при
+    следующем сообщении пользователя). Если следующая пара реплик вытеснит
+    из буфера ещё не свёрнутые, резюме обновляется сразу, без allow() и
+    без ожидания полного batch. Граница свёрнутой части - номер реплики.
+    """
+
+    def __init__(self, store, summarize, keep_turns: int = 4, batch: int = 4, allow=None,
+                 max_queue: int = 1000):
+        self.store = store
+        self.summarize = summarize
+        self.keep_turns = keep_turns
+        self.batch = batch
+        self.allow = allow
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self.updated = 0
+        self.deferred = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._loop, name="summarizer", daemon=True)
+        self._thread.start()
+
+    def pending(self, user_id: int) -> tuple:
+        """(номер первой, старые реплики, ещё не вошедшие в резюме, вытеснит ли их следующая пара реплик)"""
+        first, turns = self.store.get_window(user_id)
+        if len(turns) <= self.keep_turns:
+            return first, [], False
+        record = self.store.get_summary(user_id)
+        marker = record[1] if record else None
+        old = turns[:-self.keep_turns]
+        pending = turns_after(old, first, marker)
+        start = first + len(old) - len(pending)
+        evicted_next = len(turns) + 2 - self.store.max_turns
+        return start, pending, bool(pending) and start - first < evicted_next
+
+    def schedule(self, user_id: int):
+        """Проверить диалог после новой реплики (без ожидания)"""
+        with self._lock:
+            if user_id in self._queued:
+                return
+            try:
+                self._queue.put_nowait(user_id)
+            except queue.Full:
+                return
+            self._queued.add(user_id)
+
+    def update(self, user_id: int) -> bool:
+        """Свернуть накопившиеся старые реплики; True, если резюме обновлено"""
+        start, turns, urgent = self.pending(user_id)
+        if not turns or len(turns) < self.batch and not urgent:
+            return False
+        if not urgent and self.allow is not None and not self.allow():
+            self.deferred += 1
+            return False
+        record = self.store.get_summary(user_id)
+        summary = self.summarize(record[0] if record else "", turns)
+        if not summary:
+            self.failed += 1
+            return False
+        self.store.set_summary(user_id, summary, start + len(turns) - 1)
+        self.updated += 1
+        return True
+
+    def _loop(self):
+        while True:
+            user_id = self._queue.get()
+            with self._lock:
+                self._queued.discard(user_id)
+            try:
+                self.update(user_id)
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка обновления резюме диалога {user_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "updated": self.updated,
+            "deferred": self.deferred,
+            "failed": self.failed,
+        }
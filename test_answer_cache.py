@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Проверки кэша ответов: когда вернувшийся пользователь получает ответ из кэша"""
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from answer_cache import SemanticAnswerCache, context_allows, is_self_contained
+from context_store import ConversationStore, SQLiteBackend
+
+
+def vector(seed: int, dim: int = 16):
+    return np.random.default_rng(seed).standard_normal(dim).tolist()
+
+
+class SelfContainedTest(unittest.TestCase):
+    def test_full_question(self):
+        self.assertTrue(is_self_contained("Сколько стоит номер с видом на море?"))
+
+    def test_follow_up(self):
+        self.assertFalse(is_self_contained("А сколько это стоит?"))
+        self.assertFalse(is_self_contained("А завтра?"))
+        self.assertFalse(is_self_contained("Где он находится?"))
+
+
+class ReturningUserTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "context.db")
+        self.cache = SemanticAnswerCache(threshold=0.95)
+        self.question = "Во сколько заезд в отель?"
+        self.cache.store(self.question, vector(1), [1], "Заезд с 14:00")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def store(self):
+        return ConversationStore(SQLiteBackend(self.path))
+
+    def cacheable(self, store, user_id: int, question: str) -> bool:
+        store.append(user_id, "user", question)
+        return context_allows(len(store.get(user_id)) - 1, store.idle_before_last(user_id), question)
+
+    def test_hit_after_idle_gap(self):
+        # Вчерашний диалог из 10 реплик пережил перезапуск (SQLite)
+        store = self.store()
+        yesterday = time.time() - 86400
+        with mock.patch("context_store.time.time", return_value=yesterday):
+            for i in range(5):
+                store.append(42, "user", f"вопрос {i}")
+                store.append(42, "assistant", f"ответ {i}")
+        store.close()
+
+        store = self.store()
+        # Короткий вопрос, но пауза в сутки - старый диалог не меняет его смысла
+        self.assertTrue(self.cacheable(store, 42, "А заезд?"))
+        self.assertEqual(self.cache.lookup(vector(1)), "Заезд с 14:00")
+        store.close()
+
+    def test_hit_for_self_contained_question(self):
+        store = self.store()
+        for i in range(5):
+            store.append(7, "user", f"вопрос {i}")
+            store.append(7, "assistant", f"ответ {i}")
+        self.assertTrue(self.cacheable(store, 7, self.question))
+        self.assertEqual(self.cache.lookup(vector(1)), "Заезд с 14:00")
+        store.close()
+
+    def test_follow_up_in_live_dialog_skips_cache(self):
+        store = self.store()
+        store.append(7, "user", "Есть ли у вас номера с балконом?")
+        store.append(7, "assistant", "Да, есть")
+        self.assertFalse(self.cacheable(store, 7, "А сколько это стоит?"))
+        store.close()
+
+    def test_first_message(self):
+        store = self.store()
+        self.assertTrue(self.cacheable(store, 1, "Привет"))
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Локальное зеркало коллекции Qdrant для точного поиска в памяти процесса"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from qdrant_client.models import FieldCondition, Filter, Range
+
+# Совместимо с ScoredPoint из Qdrant в той части, что использует бот
+Hit = namedtuple("Hit", "id score payload")
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class VectorMirror:
+    """Точная копия векторов коллекции в виде одной матрицы float32.
+
+    Снимок хранится в файле и открывается через memmap: старт не требует
+    чтения всей матрицы, а воркеры на одной машине делят страницы памяти.
+    Точки, добавленные после снимка (write-through и инкрементальная
+    синхронизация), лежат в небольшой отдельной матрице до следующего save().
+    Векторы нормируются при добавлении, поиск - косинус через одно умножение.
+    """
+
+    def __init__(self, path: str, collection: str):
+        self.path = path                      # префикс файлов снимка
+        self.collection = collection
+        self.dim = None
+        self.synced_at = 0.0                  # максимальный created_at среди загруженных точек
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._base = np.zeros((0, 0), dtype=np.float32)
+        self._base_ids = []
+        self._base_payloads = []
+        self._base_alive = np.zeros(0, dtype=bool)
+        self._extra = np.zeros((0, 0), dtype=np.float32)
+        self._extra_ids = []
+        self._extra_payloads = []
+        self._extra_alive = np.zeros(0, dtype=bool)
+        self._rows = {}                       # id -> ("base" | "extra", номер строки)
+        self._journal = None                  # изменения во время save(): [(points, matrix) | ids, ...]
+        self.dirty = False
+        self.searches = 0
+
+    # ----------------- Снимок на диске -----------------
+    @property
+    def _meta_path(self):
+        return f"{self.path}.json"
+
+    def load(self) -> bool:
+        """Открытие последнего снимка; False, если снимка нет или он битый"""
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("collection") != self.collection:
+                return False
+            data_path = os.path.join(os.path.dirname(self.path) or ".", meta["data"])
+            count, dim = meta["count"], meta["dim"]
+            if count:
+                base = np.memmap(data_path, dtype=np.float32, mode="r", shape=(count, dim))
+            else:
+                base = np.zeros((0, dim), dtype=np.float32)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(f"Не удалось открыть снимок зеркала {self._meta_path}: {e}")
+            return False
+
+        with self._lock:
+            self.dim = dim
+            self.generation = meta["generation"]
+            self.synced_at = meta.get("synced_at", 0.0)
+            self._base = base
+            self._base_ids = meta["ids"]
+            self._base_payloads = meta["payloads"]
+            self._base_alive = np.ones(count, dtype=bool)
+            self._extra = np.zeros((0, dim), dtype=np.float32)
+            self._extra_ids, self._extra_payloads = [], []
+            self._extra_alive = np.zeros(0, dtype=bool)
+            self._rows = {point_id: ("base", i) for i, point_id in enumerate(self._base_ids)}
+            self.dirty = False
+        logging.info(f"Зеркало векторов загружено: {count} точек, поколение {self.generation}")
+        return True
+
+    def disk_generation(self) -> int:
+        """Поколение снимка на диске (его мог обновить другой воркер)"""
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                return json.load(f).get("generation", 0)
+        except Exception:
+            return 0
+
+    def save(self):
+        """Запись снимка: все живые точки в один файл, затем атомарная замена метаданных"""
+        with self._lock:
+            parts = [self._base[self._base_alive], self._extra[self._extra_alive]] if self.dim else []
+            ids = [i for i, alive in zip(self._base_ids, self._base_alive) if alive] + \
+                  [i for i, alive in zip(self._extra_ids, self._extra_alive) if alive]
+            payloads = [p for p, alive in zip(self._base_payloads, self._base_alive) if alive] + \
+                       [p for p, alive in zip(self._extra_payloads, self._extra_alive) if alive]
+            dim, synced_at = self.dim, self.synced_at
+            if dim is None:
+                return
+            self._journal = []
+        try:
+            generation = self._write_snapshot(ids, payloads, parts, dim, synced_at)
+            self.load()
+        finally:
+            with self._lock:
+                # Изменения, сделанные во время записи (добавления и удаления), повторяются поверх снимка
+                for change in self._journal:
+                    if isinstance(change, tuple):
+                        if change[1].shape[1] == self.dim:
+                            self._append(*change)
+                    else:
+                        for point_id in change:
+                            self._kill(point_id)
+                self.dirty = self.dirty or bool(self._journal)
+                self._journal = None
+        logging.info(f"Снимок зеркала сохранён: {len(ids)} точек, поколение {generation}")
+
+    def _write_snapshot(self, ids: list, payloads: list, parts: list, dim: int, synced_at: float) -> int:
+        """Запись файла данных и метаданных нового поколения; номер поколения"""
+        directory = os.path.dirname(self.path) or "."
+        with open(f"{self.path}.lock", "w") as lock_file:
+            # Снимок пишет один процесс за раз
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            generation = max(self.disk_generation(), self.generation) + 1
+            data_name = f"{os.path.basename(self.path)}.{generation}.f32"
+            matrix = np.concatenate(parts) if parts else np.zeros((0, dim), dtype=np.float32)
+            matrix.astype(np.float32).tofile(os.path.join(directory, data_name))
+            meta = {
+                "collection": self.collection,
+                "generation": generation,
+                "data": data_name,
+                "count": len(ids),
+                "dim": dim,
+                "synced_at": synced_at,
+                "ids": ids,
+                "payloads": payloads,
+            }
+            tmp = f"{self._meta_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, self._meta_path)
+            # Старые файлы данных можно удалять: открытые memmap продолжают работать
+            prefix = f"{os.path.basename(self.path)}."
+            for name in os.listdir(directory):
+                if name.startswith(prefix) and name.endswith(".f32") and name != data_name:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+        return generation
+
+    # ----------------- Изменения -----------------
+    def upsert(self, points) -> bool:
+        """Добавление или замена точек (PointStruct/Record с вектором и payload).
+
+        False, если размер векторов не совпадает с зеркалом (коллекцию
+        перенесли на другой размер - зеркало нужно пересобрать).
+        """
+        points = [p for p in points if p.vector is not None]
+        if not points:
+            return True
+        matrix = _normalize_rows(np.asarray([p.vector for p in points], dtype=np.float32))
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._base = np.zeros((0, self.dim), dtype=np.float32)
+                self._extra = np.zeros((0, self.dim), dtype=np.float32)
+            if matrix.shape[1] != self.dim:
+                logging.error(f"Размер вектора {matrix.shape[1]} не совпадает с зеркалом ({self.dim})")
+                return False
+            self._append(points, matrix)
+            if self._journal is not None:
+                self._journal.append((points, matrix))
+        return True
+
+    def _append(self, points: list, matrix):
+        """Запись точек в дополнительную матрицу (под блокировкой)"""
+        start = len(self._extra_ids)
+        for i, point in enumerate(points):
+            # Точки, которые эта запись заменила (дедупликация), удаляются и в других воркерах
+            for old_id in (point.payload or {}).get("replaces", ()):
+                if old_id != point.id:
+                    self._kill(old_id)
+            self._kill(point.id)
+            self._rows[point.id] = ("extra", start + i)
+            payload = dict(point.payload or {})
+            self._extra_ids.append(point.id)
+            self._extra_payloads.append(payload)
+            self.synced_at = max(self.synced_at, payload.get("created_at", 0.0))
+        self._extra = np.concatenate([self._extra, matrix])
+        self._extra_alive = np.concatenate([self._extra_alive, np.ones(len(points), dtype=bool)])
+        self.dirty = True
+
+    def remove(self, point_ids):
+        """Удаление точек"""
+        point_ids = list(point_ids)
+        with self._lock:
+            for point_id in point_ids:
+                self._kill(point_id)
+            if self._journal is not None:
+                self._journal.append(point_ids)
+            self.dirty = True
+
+    def _kill(self, point_id):
+        row = self._rows.pop(point_id, None)
+        if row is None:
+            return
+        where, index = row
+        if where == "base":
+            self._base_alive[index] = False
+        else:
+            self._extra_alive[index] = False
+
+    # ----------------- Синхронизация с Qdrant -----------------
+    def pull(self, qdrant, full: bool = False, page_size: int = 1000) -> int:
+        """Загрузка точек из коллекции; без full - только с created_at не старше synced_at"""
+        if full:
+            # Полная пересборка идёт в отдельном объекте, поиск тем временем работает по старым данным
+            fresh = VectorMirror(self.path, self.collection)
+            pulled = fresh.pull(qdrant, page_size=page_size)
+            with self._lock:
+                for name in ("dim", "synced_at", "_base", "_base_ids", "_base_payloads", "_base_alive",
+                             "_extra", "_extra_ids", "_extra_payloads", "_extra_alive", "_rows"):
+                    setattr(self, name, getattr(fresh, name))
+                self.dirty = True
+            return pulled
+
+        started = time.time()
+        scroll_filter = None
+        if self.synced_at:
+            scroll_filter = Filter(must=[FieldCondition(key="created_at", range=Range(gte=self.synced_at))])
+
+        pulled = 0
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
+                collection_name=self.collection,
+                scroll_filter=scroll_filter,
+                limit=page_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True
+            )
+            if not self.upsert(points):
+                raise ValueError(f"Размер векторов коллекции {self.collection} не совпадает с зеркалом ({self.dim})")
+            pulled += len(points)
+            if offset is None:
+                break
+        with self._lock:
+            # Старые точки могут не иметь created_at: следующая синхронизация всё равно
+            # должна быть инкрементальной (с запасом на расхождение часов)
+            self.synced_at = max(self.synced_at, started - 60)
+        return pulled
+
+    # ----------------- Поиск -----------------
+    @property
+    def size(self) -> int:
+        return len(self._rows)
+
+    def search(self, vector, limit: int = 5, threshold: float = 0.0):
+        """Точный top-k по косинусной близости (ValueError, если размер вектора не совпадает с зеркалом)"""
+        if self.dim is not None and len(vector) != self.dim:
+            raise ValueError(f"Размер вектора {len(vector)} не совпадает с зеркалом ({self.dim})")
+        with self._lock:
+            blocks = [
+                (self._base, self._base_alive, self._base_ids, self._base_payloads),
+                (self._extra, self._extra_alive, self._extra_ids, self._extra_payloads),
+            ]
+        self.searches += 1
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        candidates = []
+        for matrix, alive, ids, payloads in blocks:
+            if not len(ids) or matrix.shape[1] != len(query):
+                continue
+            scores = matrix @ query
+            scores[~alive[:len(scores)]] = -np.inf
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            for i in top:
+                if scores[i] >= threshold:
+                    candidates.append(Hit(ids[i], float(scores[i]), payloads[i]))
+        candidates.sort(key=lambda hit: hit.score, reverse=True)
+        return candidates[:limit]
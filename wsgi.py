@@ -1,4 +1,6 @@
-from bot import app
+from bot import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run()